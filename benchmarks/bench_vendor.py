@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+"""Reproducible benchmarks for vendoring, without GitHub or PyPI.
+
+Generates N local git (and hg, if installed) repos of varying size, some with
+version tags and some that are only pinned by commit, and serves a fake PyPI
+JSON API for them. GitHub URLs returned by the fake PyPI are rewritten to the
+local repos with git's url.<base>.insteadOf. Each scenario runs the real
+entry points in a child process whose HOME is a scratch directory, so the
+default package map, vendor dir and caches all live there.
+
+Example:
+  python3 benchmarks/bench_vendor.py --sizes 10,100 --output bench.json
+"""
+
+import argparse
+import http.server
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import textwrap
+import threading
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PIPSOURCE_DIR = os.path.join(REPO_ROOT, 'pipsource')
+
+FAKE_GITHUB = 'https://github.com/pipsource-bench/'
+
+GIT = ['git', '-c', 'user.name=bench', '-c', 'user.email=bench@example.com']
+
+# Counts the subprocesses each benchmarked Python process starts.
+_SITECUSTOMIZE = '''
+import atexit
+import os
+import subprocess
+
+_count = [0]
+_original_init = subprocess.Popen.__init__
+
+
+def _counting_init(self, *args, **kwargs):
+  _count[0] += 1
+  _original_init(self, *args, **kwargs)
+
+
+subprocess.Popen.__init__ = _counting_init
+
+
+@atexit.register
+def _write_count():
+  with open(os.environ['PIPSOURCE_BENCH_COUNT_FILE'], 'a') as count_file:
+    count_file.write('%d\\n' % _count[0])
+'''
+
+
+class _FakePypiHandler(http.server.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+  bytes_sent = 0
+  lock = threading.Lock()
+
+  def do_GET(self):
+    parts = self.path.strip('/').split('/')
+    if len(parts) != 3 or parts[0] != 'pypi' or parts[2] != 'json':
+      self.send_error(404)
+      return
+    body = json.dumps({'info': {
+        'home_page': FAKE_GITHUB + parts[1],
+        'description': '',
+    }}).encode()
+    self.send_response(200)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+    with _FakePypiHandler.lock:
+      _FakePypiHandler.bytes_sent += len(body)
+
+  def log_message(self, *args):
+    pass
+
+
+def _dir_size(path):
+  total = 0
+  for root, _, files in os.walk(path):
+    for name in files:
+      try:
+        total += os.lstat(os.path.join(root, name)).st_size
+      except OSError:
+        pass
+  return total
+
+
+class Workspace(object):
+  """Synthetic repos, a project requiring them and a scratch HOME."""
+
+  def __init__(self, root, count):
+    self.root = root
+    self.count = count
+    self.repos_dir = os.path.join(root, 'repos')
+    self.home = os.path.join(root, 'home')
+    self.project = os.path.join(root, 'project')
+    self.package_map_file = os.path.join(
+        self.home, 'ndotfiles/install/third_party/pip/package_map.json')
+    self.vendor_dir = os.path.join(self.home, 'ndotfiles/third_party/pip')
+    self.versions = {}
+    self.package_map = {}
+    self.use_hg = shutil.which('hg') is not None
+
+  def package_name(self, index):
+    return 'benchpkg%04d' % index
+
+  def _write_package(self, repo, name, version, index):
+    with open(os.path.join(repo, 'setup.py'), 'w') as f:
+      f.write(textwrap.dedent('''\
+          from setuptools import setup
+          setup(name=%r, version=%r, packages=[%r],
+                install_requires=%r)
+          ''') % (name, version, name, self._requires(index)))
+    package_dir = os.path.join(repo, name)
+    os.makedirs(package_dir, exist_ok=True)
+    # Vary tree sizes: between 2 and 200 modules of a few KB each.
+    for module in range(2 + (index * 37) % 199):
+      with open(os.path.join(package_dir, 'mod%d.py' % module), 'w') as f:
+        f.write('# %s %s\n' % (name, version))
+        f.write('VALUE = %r\n' % ('x' * (256 + (module * 97) % 4096)))
+
+  def _requires(self, index):
+    # A few dependency chains so the resolver has levels to build.
+    return [self.package_name(index + 1)] if index % 5 < 2 and (
+        index + 1 < self.count) else []
+
+  def _commit(self, repo, message, tag=None, hg=False):
+    if hg:
+      subprocess.run(['hg', 'commit', '-q', '-A', '-u', 'bench', '-m',
+                      message], cwd=repo, check=True)
+      if tag:
+        subprocess.run(['hg', 'tag', '-u', 'bench', tag], cwd=repo,
+                       check=True)
+      return None
+    subprocess.run(GIT + ['add', '-A'], cwd=repo, check=True)
+    subprocess.run(GIT + ['commit', '-qm', message], cwd=repo, check=True)
+    if tag:
+      subprocess.run(GIT + ['tag', tag], cwd=repo, check=True)
+    return subprocess.check_output(
+        ['git', 'rev-parse', 'HEAD'], cwd=repo).decode().strip()
+
+  def generate(self):
+    os.makedirs(self.repos_dir)
+    os.makedirs(self.project)
+    os.makedirs(os.path.dirname(self.package_map_file))
+    for index in range(self.count):
+      name = self.package_name(index)
+      version = '1.%d.0' % index
+      repo = os.path.join(self.repos_dir, name)
+      os.makedirs(repo)
+      hg = self.use_hg and index % 10 == 9
+      if hg:
+        kind = 'hg'
+      elif index % 4 == 3:
+        # Untagged: half are pinned in the package map, the rest are only
+        # found by matching the default branch HEAD.
+        kind = 'commit' if index % 8 == 3 else 'head'
+      else:
+        kind = 'tag'
+      if hg:
+        subprocess.run(['hg', 'init', repo], check=True)
+      else:
+        subprocess.run(['git', 'init', '-q', repo], check=True)
+      self._write_package(repo, name, version, index)
+      commit = self._commit(
+          repo, 'Release %s' % version,
+          tag=self.tag(index, version) if kind in ('tag', 'hg') else None,
+          hg=hg)
+      self.versions[name] = version
+      # Commit pinned and hg packages need map entries; the rest are found
+      # through the fake PyPI on the cold run.
+      if kind == 'commit':
+        self.package_map[name] = {
+            'git': FAKE_GITHUB + name,
+            'version-commits': {version: commit},
+        }
+      elif kind == 'hg':
+        self.package_map[name] = {'hg': 'file://' + repo}
+    with open(self.package_map_file, 'w') as f:
+      json.dump(self.package_map, f, sort_keys=True, indent=2)
+    self.write_requirements()
+
+  def write_requirements(self):
+    with open(os.path.join(self.project, 'requirements.txt'), 'w') as f:
+      for name in sorted(self.versions):
+        f.write('%s=%s\n' % (name, self.versions[name]))
+    config = {'packages': {}}
+    for name, version in self.versions.items():
+      entry = dict(self.package_map.get(name, {'git': FAKE_GITHUB + name}))
+      entry['vendored'] = version
+      config['packages'][name] = entry
+    with open(os.path.join(self.root, 'config.json'), 'w') as f:
+      json.dump(config, f, sort_keys=True, indent=2)
+
+  def tag(self, index, version):
+    """Tags use a mix of the naming schemes pipsource has to detect."""
+    tag_format = ('%s', 'v%s', self.package_name(index) + '-%s')[index % 3]
+    return tag_format % version
+
+  def bump(self, index=0):
+    """Releases a new patch version of one tagged package."""
+    name = self.package_name(index)
+    repo = os.path.join(self.repos_dir, name)
+    major, minor, patch = self.versions[name].split('.')
+    version = '%s.%s.%d' % (major, minor, int(patch) + 1)
+    self._write_package(repo, name, version, index)
+    self._commit(repo, 'Release %s' % version, tag=self.tag(index, version))
+    self.versions[name] = version
+    self.write_requirements()
+
+  def env(self, pypi_url, count_file, sitecustomize_dir):
+    env = dict(os.environ)
+    env['HOME'] = self.home
+    env['PYTHONPATH'] = sitecustomize_dir
+    env['PIPSOURCE_BENCH_COUNT_FILE'] = count_file
+    env['PIPSOURCE_BENCH_PYPI_URL'] = pypi_url
+    env['GIT_CONFIG_COUNT'] = '1'
+    env['GIT_CONFIG_KEY_0'] = 'url.file://%s/.insteadOf' % self.repos_dir
+    env['GIT_CONFIG_VALUE_0'] = FAKE_GITHUB
+    return env
+
+
+def _run_child(cmd, cwd, env, count_file, workspace):
+  """Runs cmd and returns its wall time, subprocess count and peak RSS."""
+  open(count_file, 'w').close()
+  fetched_before = _dir_size(os.path.join(workspace.home, '.pipsource'))
+  pypi_before = _FakePypiHandler.bytes_sent
+  start = time.monotonic()
+  proc = subprocess.Popen(cmd, cwd=cwd, env=env, stdout=subprocess.DEVNULL,
+                          stderr=subprocess.PIPE)
+  stderr = proc.stderr.read()
+  _, status, rusage = os.wait4(proc.pid, 0)
+  proc.returncode = os.waitstatus_to_exitcode(status)
+  wall = time.monotonic() - start
+  with open(count_file) as f:
+    counts = [int(line) for line in f if line.strip()]
+  fetched_after = _dir_size(os.path.join(workspace.home, '.pipsource'))
+  return {
+      'wall_seconds': round(wall, 4),
+      'exit_code': proc.returncode,
+      'subprocesses': sum(counts),
+      'peak_rss_kb': rusage.ru_maxrss,
+      'pypi_bytes': _FakePypiHandler.bytes_sent - pypi_before,
+      'cache_bytes_added': max(0, fetched_after - fetched_before),
+      'stderr_tail': stderr.decode(errors='replace')[-2000:]
+                     if proc.returncode else '',
+  }
+
+
+def _vendor_cmd(workspace, pypi_url):
+  return [sys.executable, os.path.join(PIPSOURCE_DIR, 'vendor_packages.py'),
+          workspace.project, sys.executable, '--pypi-url', pypi_url]
+
+
+def _cli_cmd(workspace):
+  return [sys.executable, os.path.join(PIPSOURCE_DIR, 'pipsource.py'),
+          'vendor', os.path.join(workspace.project, 'requirements.txt'),
+          '--config', os.path.join(workspace.root, 'config.json'),
+          '--vendor-path', workspace.vendor_dir]
+
+
+def run_size(count, keep=False):
+  root = tempfile.mkdtemp(prefix='pipsource-bench-%d-' % count)
+  workspace = Workspace(root, count)
+  server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _FakePypiHandler)
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  pypi_url = 'http://127.0.0.1:%d/pypi' % server.server_port
+  sitecustomize_dir = os.path.join(root, 'site')
+  os.makedirs(sitecustomize_dir)
+  with open(os.path.join(sitecustomize_dir, 'sitecustomize.py'), 'w') as f:
+    f.write(_SITECUSTOMIZE)
+  count_file = os.path.join(root, 'subprocess-count')
+  try:
+    start = time.monotonic()
+    workspace.generate()
+    results = {'packages': count,
+               'generate_seconds': round(time.monotonic() - start, 4),
+               'hg_repos': workspace.use_hg}
+    env = workspace.env(pypi_url, count_file, sitecustomize_dir)
+    vendor_cmd = _vendor_cmd(workspace, pypi_url)
+
+    def scenario(name, cmd):
+      print('  %s...' % name, file=sys.stderr)
+      results[name] = _run_child(cmd, REPO_ROOT, env, count_file, workspace)
+
+    scenario('cold_vendor', vendor_cmd)
+    scenario('warm_noop_vendor', vendor_cmd)
+    workspace.bump(0)
+    scenario('single_version_bump', vendor_cmd)
+    # Install script generation: everything is vendored, but version probes
+    # and dependency metadata have to be worked out again.
+    for cache in ('versions.json', 'dependencies.json'):
+      path = os.path.join(workspace.home, '.pipsource', cache)
+      if os.path.exists(path):
+        os.remove(path)
+    scenario('install_script_generation', vendor_cmd)
+    scenario('cli_vendor', _cli_cmd(workspace))
+    return results
+  finally:
+    server.shutdown()
+    server.server_close()
+    if keep:
+      print('Kept workspace %s' % root, file=sys.stderr)
+    else:
+      shutil.rmtree(root, ignore_errors=True)
+
+
+def _git_revision():
+  try:
+    return subprocess.check_output(
+        ['git', 'rev-parse', 'HEAD'], cwd=REPO_ROOT,
+        stderr=subprocess.DEVNULL).decode().strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+parser = argparse.ArgumentParser(
+    description='Benchmark pipsource against synthetic local repos.')
+parser.add_argument('--sizes', type=str, default='10,100,1000',
+                    help='Comma separated package counts to benchmark')
+parser.add_argument('--output', type=str, default='bench_output.json',
+                    help='JSON file to write results to')
+parser.add_argument('--keep', action='store_true',
+                    help='Keep the generated workspaces for inspection')
+
+
+def main():
+  args = parser.parse_args()
+  sizes = [int(size) for size in args.sizes.split(',') if size]
+  report = {
+      'revision': _git_revision(),
+      'python': platform.python_version(),
+      'platform': platform.platform(),
+      'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+      'runs': [],
+  }
+  for size in sizes:
+    print('Benchmarking %d packages' % size, file=sys.stderr)
+    report['runs'].append(run_size(size, args.keep))
+  with open(args.output, 'w') as f:
+    json.dump(report, f, sort_keys=True, indent=2)
+  for run in report['runs']:
+    print('%5d packages:' % run['packages'])
+    for name, result in sorted(run.items()):
+      if isinstance(result, dict):
+        print('  %-26s %8.3fs  %6d subprocesses  %8d KB peak RSS%s' % (
+            name, result['wall_seconds'], result['subprocesses'],
+            result['peak_rss_kb'],
+            '  (exit %d)' % result['exit_code'] if result['exit_code'] else ''))
+  print('Wrote %s' % args.output)
+
+
+if __name__ == '__main__':
+  main()
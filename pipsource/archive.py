@@ -0,0 +1,417 @@
+"""Packed archives of a vendor directory.
+
+A vendor dir with tens of thousands of small files is slow to commit, check
+out and sync. `pack` writes all of it into a single compressed zip archive,
+whose central directory serves as a random-access index. Packages can then be
+restored one at a time with `unpack`, or imported straight from the archive
+with `ArchiveImporter`. Both read the archive through a memory map.
+
+Members are named `<package>/<path>` and written in sorted order with fixed
+timestamps, so packing the same tree twice gives an identical archive. The
+vendor manifest entries of the packed packages are stored alongside them in
+an index member, as are their integrity records.
+"""
+
+import importlib.abc
+import importlib.machinery
+import json
+import mmap
+import os
+import posixpath
+import shutil
+import stat
+import sys
+import tempfile
+import zipfile
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
+
+try:
+  from . import content_store
+  from . import integrity
+  from . import manifest
+  from . import resolver
+  from . import vendor_gc
+except ImportError:
+  import content_store
+  import integrity
+  import manifest
+  import resolver
+  import vendor_gc
+
+INDEX_NAME = '.pipsource-archive.json'
+
+ARCHIVE_FORMAT_VERSION = 1
+
+# Zip can't store timestamps before 1980.
+_FIXED_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+# Suffixes not worth compressing again.
+_STORED_SUFFIXES = ('.gz', '.zip', '.whl', '.png', '.jpg', '.bz2', '.xz')
+
+# Symlinks followed when resolving a path, as the kernel limits them.
+_MAX_SYMLINK_HOPS = 40
+
+
+def _package_files(package_dir: str,
+                   excludes: Iterable[str]) -> List[str]:
+  """Returns the paths in package_dir, relative to it, sorted."""
+  paths = []
+  for root, dirs, files in os.walk(package_dir):
+    dirs[:] = [d for d in dirs if d not in excludes]
+    for name in dirs:
+      if os.path.islink(os.path.join(root, name)):
+        files.append(name)
+    for name in files:
+      paths.append(os.path.relpath(os.path.join(root, name), package_dir))
+  return sorted(paths)
+
+
+def _zip_info(name: str, mode: int) -> zipfile.ZipInfo:
+  info = zipfile.ZipInfo(name, date_time=_FIXED_DATE_TIME)
+  info.external_attr = (mode & 0xFFFF) << 16
+  info.create_system = 3  # Unix, so the mode bits are honored.
+  if stat.S_ISLNK(mode) or name.endswith(_STORED_SUFFIXES):
+    info.compress_type = zipfile.ZIP_STORED
+  else:
+    info.compress_type = zipfile.ZIP_DEFLATED
+  return info
+
+
+def pack(vendor_dir: str, archive_path: str,
+         packages: Optional[Iterable[str]] = None,
+         excludes: Iterable[str] = content_store.DEFAULT_EXCLUDES) -> int:
+  """Writes the packages in vendor_dir (default all) to archive_path.
+
+  Returns the number of packages packed.
+  """
+  excludes = tuple(excludes)
+  names = sorted(
+      name for name in os.listdir(vendor_dir)
+      if not name.startswith('.') and
+      os.path.isdir(os.path.join(vendor_dir, name)))
+  if packages is not None:
+    wanted = set(resolver.canonical_name(p) for p in packages)
+    names = [n for n in names if resolver.canonical_name(n) in wanted]
+  vendor_manifest = manifest.Manifest(
+      os.path.join(vendor_dir, manifest.MANIFEST_FILE_NAME)).packages()
+  record = integrity.IntegrityRecord(
+      os.path.join(vendor_dir, integrity.RECORD_FILE_NAME))
+
+  archive_dir = os.path.dirname(os.path.abspath(archive_path))
+  os.makedirs(archive_dir, exist_ok=True)
+  fd, tmp_path = tempfile.mkstemp(dir=archive_dir, suffix='.tmp')
+  os.close(fd)
+  index = {}
+  try:
+    with zipfile.ZipFile(tmp_path, 'w', allowZip64=True) as archive:
+      for name in names:
+        package_dir = os.path.join(vendor_dir, name)
+        files = _package_files(package_dir, excludes)
+        for relative_path in files:
+          path = os.path.join(package_dir, relative_path)
+          mode = os.lstat(path).st_mode
+          info = _zip_info('%s/%s' % (name, relative_path), mode)
+          if stat.S_ISLNK(mode):
+            archive.writestr(info, os.readlink(path))
+          else:
+            with open(path, 'rb') as source, archive.open(info, 'w') as dest:
+              shutil.copyfileobj(source, dest, 1024 * 1024)
+        entry = vendor_manifest.get(name)
+        index[name] = {
+            'files': len(files),
+            'manifest': entry._asdict() if entry else None,
+            'integrity': record.get(name),
+        }
+      archive.writestr(
+          _zip_info(INDEX_NAME, stat.S_IFREG | 0o644),
+          json.dumps({'version': ARCHIVE_FORMAT_VERSION, 'packages': index},
+                     sort_keys=True, indent=2))
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, archive_path)
+  except BaseException:
+    os.remove(tmp_path)
+    raise
+  return len(names)
+
+
+def _resolve(links: Dict[str, str], path: str) -> Optional[str]:
+  """Resolves path within a package whose symlinks are links.
+
+  Returns the path relative to the package's dir, or None if it leads
+  outside of it.
+  """
+  resolved = []  # type: List[str]
+  remaining = path.split('/')
+  hops = 0
+  while remaining:
+    part = remaining.pop(0)
+    if part in ('', '.'):
+      continue
+    if part == '..':
+      if not resolved:
+        return None
+      resolved.pop()
+      continue
+    resolved.append(part)
+    target = links.get('/'.join(resolved))
+    if target is None:
+      continue
+    hops += 1
+    if hops > _MAX_SYMLINK_HOPS or target.startswith('/'):
+      return None
+    resolved.pop()
+    remaining = target.split('/') + remaining
+  return '/'.join(resolved)
+
+
+def _check_members(package: str, members: Dict[str, bool],
+                   links: Dict[str, str]):
+  """Raises ValueError unless all of package's members stay inside it.
+
+  members maps each member's path within the package to whether it is a
+  symlink, and links maps the symlinks' paths to their targets.
+  """
+  if package in ('.', '..') or '\\' in package:
+    raise ValueError('Invalid package name %r in archive' % package)
+  for relative_path in members:
+    parts = relative_path.split('/')
+    if (relative_path.startswith('/') or '..' in parts or
+        posixpath.normpath(relative_path) != relative_path):
+      raise ValueError('Invalid path %s/%s in archive' %
+                       (package, relative_path))
+    for i in range(1, len(parts)):
+      if members.get('/'.join(parts[:i])):
+        raise ValueError('%s/%s is inside a symlink' %
+                         (package, relative_path))
+  for relative_path, target in links.items():
+    if target.startswith('/') or _resolve(links, posixpath.join(
+        posixpath.dirname(relative_path), target)) is None:
+      raise ValueError('Symlink %s/%s points outside the package' %
+                       (package, relative_path))
+
+
+class _MappedFile(object):
+  """Seekable file interface to a memory map, as zipfile expects."""
+
+  def __init__(self, mapped: mmap.mmap):
+    self._map = mapped
+    self.read = mapped.read
+    self.seek = mapped.seek
+    self.tell = mapped.tell
+
+  def seekable(self):
+    return True
+
+
+class Archive(object):
+  """A packed archive, read through a memory map."""
+
+  def __init__(self, path: str):
+    self.path = path
+    self._file = open(path, 'rb')
+    self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+    self._zip = zipfile.ZipFile(_MappedFile(self._map))
+    self._members = {}  # type: Dict[str, List[zipfile.ZipInfo]]
+    for info in self._zip.infolist():
+      package, _, relative_path = info.filename.partition('/')
+      if relative_path:
+        self._members.setdefault(package, []).append(info)
+    self.index = json.loads(self._zip.read(INDEX_NAME).decode())
+    if self.index.get('version') != ARCHIVE_FORMAT_VERSION:
+      raise ValueError('Unsupported archive format in %s' % path)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+  def close(self):
+    self._zip.close()
+    self._map.close()
+    self._file.close()
+
+  def packages(self) -> List[str]:
+    return sorted(self._members)
+
+  def find(self, package: str) -> Optional[str]:
+    """Returns the archive's spelling of package, if it holds it."""
+    canonical = resolver.canonical_name(package)
+    for name in self._members:
+      if resolver.canonical_name(name) == canonical:
+        return name
+    return None
+
+  def names(self, package: str) -> List[str]:
+    """Returns the paths in package, relative to its directory."""
+    return [info.filename[len(package) + 1:]
+            for info in self._members.get(package, [])]
+
+  def read(self, package: str, relative_path: str) -> bytes:
+    return self._zip.read('%s/%s' % (package, relative_path))
+
+  def extract(self, package: str, dest_dir: str):
+    """Writes package's files into dest_dir, keeping modes and symlinks.
+
+    Raises ValueError, before writing anything, if a member's path or
+    symlink would lead outside of dest_dir.
+    """
+    members = {}
+    links = {}
+    for info in self._members[package]:
+      relative_path = info.filename[len(package) + 1:]
+      members[relative_path] = stat.S_ISLNK(info.external_attr >> 16)
+      if members[relative_path]:
+        links[relative_path] = self._zip.read(info).decode()
+    _check_members(package, members, links)
+    for info in self._members[package]:
+      path = os.path.join(dest_dir, info.filename[len(package) + 1:])
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+      mode = info.external_attr >> 16
+      if stat.S_ISLNK(mode):
+        os.symlink(self._zip.read(info).decode(), path)
+        continue
+      with self._zip.open(info) as source, open(path, 'wb') as dest:
+        shutil.copyfileobj(source, dest, 1024 * 1024)
+      if mode & 0o777:
+        os.chmod(path, mode & 0o777)
+
+
+def unpack(archive_path: str, vendor_dir: str,
+           packages: Optional[Iterable[str]] = None) -> List[str]:
+  """Restores packages (default all) from the archive into vendor_dir.
+
+  Each package is extracted next to its dir and renamed into place, and its
+  manifest entry restored. Returns the packages unpacked.
+  """
+  os.makedirs(vendor_dir, exist_ok=True)
+  vendor_manifest = manifest.Manifest(
+      os.path.join(vendor_dir, manifest.MANIFEST_FILE_NAME))
+  record = integrity.IntegrityRecord(
+      os.path.join(vendor_dir, integrity.RECORD_FILE_NAME))
+  unpacked = []
+  with Archive(archive_path) as archive:
+    if packages is None:
+      names = archive.packages()
+    else:
+      names = []
+      for package in packages:
+        name = archive.find(package)
+        if name is None:
+          raise LookupError('%s is not in %s' % (package, archive_path))
+        names.append(name)
+    for name in names:
+      package_dir = os.path.join(vendor_dir, name)
+      tmp_dir = tempfile.mkdtemp(dir=vendor_dir, prefix='.%s.' % name)
+      try:
+        archive.extract(name, tmp_dir)
+        os.chmod(tmp_dir, 0o755)
+        if os.path.isdir(package_dir):
+          old_dir = tempfile.mkdtemp(dir=vendor_dir, prefix='.%s.old.' % name)
+          os.rename(package_dir, os.path.join(old_dir, name))
+          os.rename(tmp_dir, package_dir)
+          shutil.rmtree(old_dir)
+        else:
+          os.rename(tmp_dir, package_dir)
+      except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+      index_entry = archive.index['packages'].get(name, {})
+      entry = index_entry.get('manifest')
+      if entry:
+        vendor_manifest.record(
+            name, entry['version'], entry['source'], entry['label'],
+            entry['commit'], entry['tree'], package_dir)
+      recorded = index_entry.get('integrity')
+      if recorded:
+        record.record(name, recorded['tree'], recorded['commit'], recorded)
+      unpacked.append(name)
+  vendor_manifest.save()
+  record.save()
+  return unpacked
+
+
+def unpack_for_scripts(archive_path: str, vendor_dir: str,
+                       install_scripts: Iterable[str]) -> List[str]:
+  """Restores just the packages the given install scripts install."""
+  packages = set()  # type: Set[str]
+  for script in install_scripts:
+    packages.update(vendor_gc.roots_from_install_script(script))
+  return unpack(archive_path, vendor_dir, sorted(packages))
+
+
+class _ArchiveLoader(importlib.abc.Loader):
+
+  def __init__(self, archive: Archive, package: str, relative_path: str):
+    self._archive = archive
+    self._package = package
+    self._relative_path = relative_path
+
+  def create_module(self, spec):
+    return None
+
+  def get_source(self, fullname):
+    return self._archive.read(self._package, self._relative_path).decode()
+
+  def exec_module(self, module):
+    code = compile(
+        self._archive.read(self._package, self._relative_path),
+        module.__spec__.origin, 'exec', dont_inherit=True)
+    exec(code, module.__dict__)
+
+
+class ArchiveImporter(importlib.abc.MetaPathFinder):
+  """Imports pure Python modules of packages straight from an archive.
+
+  A package's modules are looked for at the root of its source tree, or
+  under src/ for projects using that layout. Extension modules can't be
+  loaded this way; unpack packages that have them.
+  """
+
+  def __init__(self, archive: Archive,
+               packages: Optional[Iterable[str]] = None):
+    self.archive = archive
+    # Module path within the archive ('a/b.py') -> (package, relative path).
+    self._modules = {}  # type: Dict[str, Tuple[str, str]]
+    names = archive.packages() if packages is None else [
+        archive.find(p) or p for p in packages]
+    for package in names:
+      files = archive.names(package)
+      prefix = 'src/' if any(
+          f.startswith('src/') and f.endswith('.py') for f in files) else ''
+      for relative_path in files:
+        if relative_path.startswith(prefix) and relative_path.endswith('.py'):
+          self._modules.setdefault(
+              relative_path[len(prefix):], (package, relative_path))
+
+  def find_spec(self, fullname, path=None, target=None):
+    base = fullname.replace('.', '/')
+    for module_path, is_package in (('%s/__init__.py' % base, True),
+                                    ('%s.py' % base, False)):
+      found = self._modules.get(module_path)
+      if found is None:
+        continue
+      package, relative_path = found
+      origin = os.path.join(self.archive.path, package, relative_path)
+      spec = importlib.machinery.ModuleSpec(
+          fullname, _ArchiveLoader(self.archive, package, relative_path),
+          origin=origin, is_package=is_package)
+      spec.has_location = True
+      if is_package:
+        spec.submodule_search_locations = [os.path.dirname(origin)]
+      return spec
+    return None
+
+
+def install_importer(archive_path: str,
+                     packages: Optional[Iterable[str]] = None
+                    ) -> ArchiveImporter:
+  """Makes the archive's packages importable; returns the importer."""
+  importer = ArchiveImporter(Archive(archive_path), packages)
+  sys.meta_path.append(importer)
+  return importer
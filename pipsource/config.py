@@ -1,12 +1,18 @@
 import logging
 import os
 import json
+import sys
 
 from typing import Optional
 from typing import Dict
 from typing import NamedTuple
 from typing import List
 
+try:
+  from . import package_map_store
+except ImportError:
+  import package_map_store
+
 DEFAULT_VERSION_TAG_FORMAT = '%s'
 
 class Package(NamedTuple):
@@ -17,10 +23,19 @@ class Package(NamedTuple):
     version_commits: Optional[Dict[str, str]]
     install_requires: List[str]
     version_tag_format: str
+    # Dir of the repo the package is in, for repos with several packages.
+    subdir: Optional[str] = None
 
 
 def parse(config_file: str) -> Dict[str, Package]:
-  """Loads package map from JSON file."""
+  """Loads package map from JSON file.
+
+  config_file may also be a directory of per-package JSON files, as written
+  by package_map_store, whose entries hold the same fields.
+  """
+  if os.path.isdir(config_file):
+    return _parse_packages(
+        package_map_store.ShardedPackageMap(config_file).to_dict())
   if not os.path.isfile(config_file):
     logging.info('Config file %s does not exist yet' % config_file)
     return {}
@@ -35,7 +50,10 @@ def parse(config_file: str) -> Dict[str, Package]:
   if not type(packages) is dict:
     logging.critical('Config JSON "packages" field must be an object')
     sys.exit(1)
+  return _parse_packages(packages)
+
 
+def _parse_packages(packages: Dict[str, Dict]) -> Dict[str, Package]:
   parsed_packages = {}
   for package in packages:
     package_json = packages[package]
@@ -47,5 +65,6 @@ def parse(config_file: str) -> Dict[str, Package]:
         version_tag_format=(
             package_json.get('version-tag-format', DEFAULT_VERSION_TAG_FORMAT)),
         version_commits=package_json.get('version-commits'),
-        install_requires=package_json.get('install_requires', []))
+        install_requires=package_json.get('install_requires', []),
+        subdir=package_json.get('subdir'))
   return parsed_packages
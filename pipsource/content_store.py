@@ -0,0 +1,422 @@
+"""Content-addressed store for vendored source trees.
+
+Every file is stored once under its SHA-256, and every imported tree is
+recorded as a manifest of (path, file hash, executable) entries, itself
+identified by a hash. Refs map package@version to the tree it was vendored as,
+so any number of versions can be kept side by side and a package directory can
+be switched between them by relinking files from the store, without fetching.
+"""
+
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import stat
+import threading
+import time
+from typing import Dict
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+
+try:
+  from . import locking
+  from . import manifest
+except ImportError:
+  import locking
+  import manifest
+
+DEFAULT_EXCLUDES = ('.git', '.git-moved', '.hg')
+
+LINK_MODES = ('hardlink', 'reflink', 'copy')
+
+# From linux/fs.h: _IOW(0x94, 9, int)
+_FICLONE = 0x40049409
+
+_CHUNK_SIZE = 1024 * 1024
+
+# Trees and objects newer than this are never swept: an import running
+# alongside may not have written the ref that keeps them yet.
+SWEEP_GRACE_SECONDS = 3600
+
+
+class Ref(NamedTuple):
+  tree: str
+  commit: Optional[str]
+
+
+class StoredRef(NamedTuple):
+  package: str
+  version: str
+  tree: str
+  # When the ref was last written or used.
+  used_at: float
+
+
+class SweepStats(NamedTuple):
+  trees: int
+  objects: int
+  bytes: int
+
+
+def hash_file(path: str) -> str:
+  """Returns the hex SHA-256 of the file's contents."""
+  digest = hashlib.sha256()
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(_CHUNK_SIZE), b''):
+      digest.update(chunk)
+  return digest.hexdigest()
+
+
+def tree_hash(tree: Dict) -> str:
+  """Returns the hash identifying a tree manifest."""
+  tree_json = json.dumps(tree, sort_keys=True, separators=(',', ':'))
+  return hashlib.sha256(tree_json.encode()).hexdigest()
+
+
+def walk_files(root: str, excludes: Sequence[str]) -> Iterator[str]:
+  """Yields paths relative to root for files and symlinks, sorted."""
+  for dirpath, dirnames, filenames in os.walk(root):
+    dirnames[:] = sorted(d for d in dirnames if d not in excludes)
+    rel_dir = os.path.relpath(dirpath, root)
+    for name in sorted(filenames):
+      yield os.path.normpath(os.path.join(rel_dir, name))
+    for name in dirnames:
+      if os.path.islink(os.path.join(dirpath, name)):
+        yield os.path.normpath(os.path.join(rel_dir, name))
+
+
+def _reflink(src: str, dst: str):
+  with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+    fcntl.ioctl(dst_file.fileno(), _FICLONE, src_file.fileno())
+
+
+def link_file(src: str, dest: str, link_mode: str):
+  """Creates dest as a hardlink, reflink or copy of src.
+
+  Hardlinks and reflinks fall back to a copy where the filesystem can't make
+  them.
+  """
+  if link_mode == 'hardlink':
+    try:
+      os.link(src, dest)
+      return
+    except OSError as e:
+      if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+        raise
+  elif link_mode == 'reflink':
+    try:
+      _reflink(src, dest)
+      shutil.copymode(src, dest)
+      return
+    except OSError:
+      pass
+  shutil.copy2(src, dest)
+
+
+class ContentStore(object):
+  """File-hash keyed object store plus tree manifests and package refs."""
+
+  def __init__(self, root: str, link_mode: str = 'hardlink'):
+    if link_mode not in LINK_MODES:
+      raise ValueError('Unknown link mode %s' % link_mode)
+    self.root = root
+    self.link_mode = link_mode
+    self._checkouts_path = os.path.join(root, 'checkouts.json')
+    # Held shared while trees are imported or linked from and exclusively by
+    # sweep, which would otherwise delete objects being linked.
+    self._store_lock_path = os.path.join(root, 'store.lock')
+
+  def _object_path(self, file_hash: str, executable: bool) -> str:
+    name = file_hash + ('.x' if executable else '')
+    return os.path.join(self.root, 'objects', file_hash[:2], name)
+
+  def _tree_path(self, tree_hash: str) -> str:
+    return os.path.join(self.root, 'trees', '%s.json' % tree_hash)
+
+  def _ref_path(self, package: str, version: str) -> str:
+    return os.path.join(self.root, 'refs', package, '%s.json' % version)
+
+  def _add_object(self, path: str, file_hash: str, executable: bool) -> str:
+    object_path = self._object_path(file_hash, executable)
+    if os.path.exists(object_path):
+      # Restart the sweep grace period, as a new tree will use it.
+      _touch(object_path)
+      return object_path
+    os.makedirs(os.path.dirname(object_path), exist_ok=True)
+    tmp_path = '%s.tmp.%d.%d' % (object_path, os.getpid(),
+                                 threading.get_ident())
+    shutil.copyfile(path, tmp_path)
+    # Objects are shared by every tree linked from them, so make them read
+    # only to stop an in-place edit of one checkout from changing the others.
+    os.chmod(tmp_path, 0o555 if executable else 0o444)
+    os.replace(tmp_path, object_path)
+    return object_path
+
+  def _link(self, object_path: str, dest: str):
+    link_file(object_path, dest, self.link_mode)
+
+  def import_tree(self, src: str,
+                  excludes: Sequence[str] = DEFAULT_EXCLUDES,
+                  relink: bool = True) -> str:
+    """Adds every file under src to the store and returns the tree hash.
+
+    With relink, the files in src are replaced by links to the stored objects
+    so the checkout itself takes no extra space.
+    """
+    with locking.file_lock(self._store_lock_path, shared=True):
+      return self._import_tree(src, excludes, relink)
+
+  def _import_tree(self, src: str, excludes: Sequence[str],
+                   relink: bool) -> str:
+    files = []  # type: List[Tuple[str, str, bool]]
+    symlinks = []  # type: List[Tuple[str, str]]
+    for rel_path in walk_files(src, excludes):
+      path = os.path.join(src, rel_path)
+      if os.path.islink(path):
+        symlinks.append((rel_path, os.readlink(path)))
+        continue
+      file_hash = hash_file(path)
+      executable = bool(os.stat(path).st_mode & stat.S_IXUSR)
+      object_path = self._add_object(path, file_hash, executable)
+      files.append((rel_path, file_hash, executable))
+      if relink and self.link_mode != 'copy':
+        tmp_path = path + '.pipsource-link'
+        self._link(object_path, tmp_path)
+        os.replace(tmp_path, path)
+    tree = {'files': files, 'symlinks': symlinks}
+    imported_hash = tree_hash(tree)
+    tree_path = self._tree_path(imported_hash)
+    if os.path.exists(tree_path):
+      _touch(tree_path)
+    else:
+      os.makedirs(os.path.dirname(tree_path), exist_ok=True)
+      _write_json(tree_path, tree)
+    return imported_hash
+
+  def has_tree(self, tree_hash: str) -> bool:
+    return os.path.isfile(self._tree_path(tree_hash))
+
+  def read_tree(self, tree_hash: str) -> Dict:
+    """Returns a stored tree manifest: its files and symlinks."""
+    with open(self._tree_path(tree_hash)) as tree_file:
+      return json.loads(tree_file.read())
+
+  def materialize(self, tree_hash: str, dest: str):
+    """Replaces dest with the stored tree, linking files from the store."""
+    tmp_dest = '%s.pipsource-tmp.%d' % (dest.rstrip('/'), os.getpid())
+    shutil.rmtree(tmp_dest, ignore_errors=True)
+    os.makedirs(tmp_dest)
+    with locking.file_lock(self._store_lock_path, shared=True):
+      tree = self.read_tree(tree_hash)
+      for rel_path, file_hash, executable in tree['files']:
+        path = os.path.join(tmp_dest, rel_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._link(self._object_path(file_hash, executable), path)
+    for rel_path, target in tree['symlinks']:
+      path = os.path.join(tmp_dest, rel_path)
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+      os.symlink(target, path)
+    shutil.rmtree(dest, ignore_errors=True)
+    os.rename(tmp_dest, dest)
+    self.record_checkout(dest, tree_hash)
+
+  def set_ref(self, package: str, version: str, label: Sequence[str],
+              tree_hash: str, commit: Optional[str] = None):
+    """Records that package@version, vendored from label, is tree_hash."""
+    path = self._ref_path(package, version)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    _write_json(path, {'label': list(label), 'tree': tree_hash,
+                       'commit': commit})
+
+  def get_ref(self, package: str, version: str,
+              label: Sequence[str]) -> Optional[Ref]:
+    """Returns the stored ref for package@version if it came from label."""
+    try:
+      with open(self._ref_path(package, version)) as ref_file:
+        ref = json.loads(ref_file.read())
+    except (OSError, ValueError):
+      return None
+    if ref['label'] != list(label) or not self.has_tree(ref['tree']):
+      return None
+    return Ref(tree=ref['tree'], commit=ref.get('commit'))
+
+  def touch_ref(self, package: str, version: str):
+    """Marks package@version as used now, for least recently used order."""
+    try:
+      os.utime(self._ref_path(package, version))
+    except OSError:
+      pass
+
+  def list_refs(self) -> List[StoredRef]:
+    """Returns every ref in the store."""
+    refs = []
+    refs_dir = os.path.join(self.root, 'refs')
+    for package in sorted(_listdir(refs_dir)):
+      for name in sorted(_listdir(os.path.join(refs_dir, package))):
+        if not name.endswith('.json'):
+          continue
+        version = name[:-len('.json')]
+        path = self._ref_path(package, version)
+        try:
+          with open(path) as ref_file:
+            tree = json.loads(ref_file.read())['tree']
+          used_at = os.stat(path).st_mtime
+        except (OSError, ValueError, KeyError):
+          continue
+        refs.append(StoredRef(package, version, tree, used_at))
+    return refs
+
+  def remove_ref(self, package: str, version: str):
+    try:
+      os.remove(self._ref_path(package, version))
+      os.rmdir(os.path.join(self.root, 'refs', package))
+    except OSError:
+      pass
+
+  def tree_objects(self, tree_hash: str) -> Dict[str, int]:
+    """Maps the objects the tree's files link to to their sizes.
+
+    Empty if the tree isn't in the store.
+    """
+    try:
+      tree = self.read_tree(tree_hash)
+    except (OSError, ValueError):
+      return {}
+    objects = {}
+    for _, file_hash, executable in tree['files']:
+      path = self._object_path(file_hash, executable)
+      if path not in objects:
+        try:
+          objects[path] = os.stat(path).st_size
+        except OSError:
+          objects[path] = 0
+    return objects
+
+  def checkouts(self) -> Dict[str, str]:
+    """Maps each dir a tree was materialized or imported at to the tree."""
+    return {dest: checkout['tree'] if isinstance(checkout, dict) else checkout
+            for dest, checkout in self._load_checkouts().items()}
+
+  def sweep(self, keep_trees: Iterable[str] = ()) -> SweepStats:
+    """Deletes the trees nothing uses, then the objects no tree uses.
+
+    Trees are used by refs, by keep_trees and by checkouts whose dir still
+    exists; checkouts of dirs that are gone are forgotten. Nothing newer than
+    SWEEP_GRACE_SECONDS is deleted.
+    """
+    if not os.path.isdir(self.root):
+      return SweepStats(0, 0, 0)
+    with locking.file_lock(self._store_lock_path):
+      return self._sweep(keep_trees)
+
+  def _sweep(self, keep_trees: Iterable[str]) -> SweepStats:
+    cutoff = time.time() - SWEEP_GRACE_SECONDS
+    with locking.file_lock(self._checkouts_path + '.lock'):
+      checkouts = self._load_checkouts()
+      live_checkouts = {dest: checkout for dest, checkout in checkouts.items()
+                        if os.path.isdir(dest)}
+      if live_checkouts != checkouts:
+        _write_json(self._checkouts_path, live_checkouts)
+    used = set(keep_trees)
+    used.update(ref.tree for ref in self.list_refs())
+    used.update(self.checkouts().values())
+
+    trees = 0
+    size = 0
+    used_objects = set()
+    trees_dir = os.path.join(self.root, 'trees')
+    for name in _listdir(trees_dir):
+      tree = name[:-len('.json')]
+      path = os.path.join(trees_dir, name)
+      if tree in used or _newer_than(path, cutoff):
+        used_objects.update(self.tree_objects(tree))
+        continue
+      size += _remove_file(path)
+      trees += 1
+
+    objects = 0
+    objects_dir = os.path.join(self.root, 'objects')
+    for prefix in _listdir(objects_dir):
+      for name in _listdir(os.path.join(objects_dir, prefix)):
+        path = os.path.join(objects_dir, prefix, name)
+        if path in used_objects or _newer_than(path, cutoff):
+          continue
+        size += _remove_file(path)
+        objects += 1
+    return SweepStats(trees, objects, size)
+
+  def _load_checkouts(self) -> Dict[str, str]:
+    try:
+      with open(self._checkouts_path) as checkouts_file:
+        return json.loads(checkouts_file.read())
+    except (OSError, ValueError):
+      return {}
+
+  def record_checkout(self, dest: str, tree_hash: str):
+    """Records that dest, as it is on disk now, holds the tree."""
+    fingerprint = manifest.fingerprint(dest)
+    # Other processes record their checkouts in the same file.
+    with locking.file_lock(self._checkouts_path + '.lock'):
+      checkouts = self._load_checkouts()
+      checkouts[os.path.abspath(dest)] = {'tree': tree_hash,
+                                          'fingerprint': fingerprint}
+      _write_json(self._checkouts_path, checkouts)
+
+  def checkout_tree(self, dest: str) -> Optional[str]:
+    """Returns the tree last materialized or imported at dest, if any.
+
+    None unless dest still exists and is unchanged since then, as far as its
+    stat fingerprint tells.
+    """
+    checkout = self._load_checkouts().get(os.path.abspath(dest))
+    # Entries written before fingerprints were recorded are just tree hashes.
+    if not isinstance(checkout, dict) or not checkout['fingerprint']:
+      return None
+    if manifest.fingerprint(dest) != checkout['fingerprint']:
+      return None
+    return checkout['tree']
+
+
+def _listdir(path: str) -> List[str]:
+  try:
+    return os.listdir(path)
+  except FileNotFoundError:
+    return []
+
+
+def _touch(path: str):
+  try:
+    os.utime(path)
+  except OSError:
+    pass
+
+
+def _newer_than(path: str, cutoff: float) -> bool:
+  try:
+    return os.stat(path).st_mtime > cutoff
+  except OSError:
+    return False
+
+
+def _remove_file(path: str) -> int:
+  """Removes path and returns its size, or 0 if it was already gone."""
+  try:
+    size = os.stat(path).st_size
+    os.remove(path)
+  except FileNotFoundError:
+    return 0
+  return size
+
+
+def _write_json(path: str, value):
+  tmp_path = '%s.tmp.%d.%d' % (path, os.getpid(), threading.get_ident())
+  with open(tmp_path, 'w') as f:
+    json.dump(value, f, sort_keys=True, indent=2)
+  os.replace(tmp_path, path)
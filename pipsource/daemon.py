@@ -0,0 +1,141 @@
+"""A local daemon that serves pipsource requests from warm in-memory state.
+
+The daemon listens on a Unix socket and handles each connection on its own
+thread. A client sends one JSON request line, e.g. `{"op": "vendor", ...}`,
+and reads back one JSON response line. Because all requests run in the same
+process, the package map, PyPI metadata and repo state loaded for one request
+are reused by the next, and concurrent requests for the same work can share
+it (see `pipeline.SingleFlight`).
+
+Clients call `request`, which raises `DaemonUnavailable` if no daemon is
+listening or the daemon can't serve the request, so that callers can fall
+back to doing the work in-process.
+"""
+
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import threading
+from typing import Any
+from typing import Callable
+from typing import Dict
+
+DEFAULT_SOCKET_PATH = os.path.expanduser('~/.pipsource/daemon.sock')
+
+CONNECT_TIMEOUT_SECONDS = 1.0
+
+Handler = Callable[[Dict[str, Any]], Any]
+
+
+class DaemonUnavailable(Exception):
+  """No daemon is running, or it can't serve this request."""
+
+
+class DaemonError(RuntimeError):
+  """The daemon failed while handling a request."""
+
+
+class Unavailable(Exception):
+  """Raised by handlers that the client should handle the request itself."""
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+
+  def handle(self):
+    line = self.rfile.readline()
+    if not line:
+      return
+    try:
+      message = json.loads(line.decode())
+      handler = self.server.handlers.get(message.get('op'))
+      if handler is None:
+        raise Unavailable('Unknown op %r' % message.get('op'))
+      response = {'ok': True, 'result': handler(message)}
+    except Unavailable as e:
+      response = {'ok': False, 'unavailable': True, 'error': str(e)}
+    except Exception as e:  # pylint: disable=broad-except
+      logging.exception('Request failed')
+      response = {'ok': False, 'error': '%s: %s' % (type(e).__name__, e)}
+    self.wfile.write(json.dumps(response).encode() + b'\n')
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+  daemon_threads = True
+
+
+def _is_listening(socket_path: str) -> bool:
+  client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  client.settimeout(CONNECT_TIMEOUT_SECONDS)
+  try:
+    client.connect(socket_path)
+    return True
+  except OSError:
+    return False
+  finally:
+    client.close()
+
+
+def _raise_interrupt(signum, frame):
+  raise KeyboardInterrupt()
+
+
+def serve(socket_path: str, handlers: Dict[str, Handler]):
+  """Serves requests on socket_path until interrupted.
+
+  handlers maps each request op to a function taking the request message and
+  returning a JSON-serializable result. A 'ping' op is always handled.
+  """
+  if os.path.exists(socket_path):
+    if _is_listening(socket_path):
+      raise RuntimeError('A daemon is already listening on %s' % socket_path)
+    os.remove(socket_path)
+  socket_dir = os.path.dirname(os.path.abspath(socket_path))
+  os.makedirs(socket_dir, mode=0o700, exist_ok=True)
+  server = _Server(socket_path, _RequestHandler)
+  server.handlers = dict(handlers)
+  server.handlers.setdefault('ping', lambda message: os.getpid())
+  os.chmod(socket_path, 0o600)
+  if threading.current_thread() is threading.main_thread():
+    # Stop on SIGTERM too, so the socket is removed.
+    signal.signal(signal.SIGTERM, _raise_interrupt)
+  print('Listening on %s' % socket_path)
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+    os.remove(socket_path)
+
+
+def request(socket_path: str, message: Dict[str, Any]) -> Any:
+  """Sends message to the daemon and returns the result.
+
+  Raises DaemonUnavailable if no daemon is listening or it can't serve the
+  request, and DaemonError if the request failed in the daemon.
+  """
+  client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    client.settimeout(CONNECT_TIMEOUT_SECONDS)
+    try:
+      client.connect(socket_path)
+    except OSError as e:
+      raise DaemonUnavailable(str(e))
+    # Requests may take as long as vendoring does.
+    client.settimeout(None)
+    client.sendall(json.dumps(message).encode() + b'\n')
+    with client.makefile('rb') as responses:
+      line = responses.readline()
+  finally:
+    client.close()
+  if not line:
+    raise DaemonUnavailable('The daemon closed the connection')
+  response = json.loads(line.decode())
+  if response.get('unavailable'):
+    raise DaemonUnavailable(response['error'])
+  if not response['ok']:
+    raise DaemonError(response['error'])
+  return response['result']
@@ -0,0 +1,280 @@
+"""Builds and installs vendored packages into a venv, a level at a time.
+
+Packages are grouped into dependency levels (see `resolver.levels`). The
+wheels of one level are built in parallel, each in its own short-lived
+process of the venv's interpreter that calls the package's PEP 517 build
+backend directly. Builds don't use build isolation, so they can use the
+packages installed by earlier levels. All of a level's wheels are then
+installed with a single pip invocation. Wheels are kept in the wheel cache,
+so a package is only built once per source tree and interpreter. The venv
+records the source key each package was installed from, and a package whose
+source changed is reinstalled even if its version string did not.
+
+A package that fails to build or install is reported, along with the
+packages that depend on it, which are skipped. Everything else is still
+built and installed.
+"""
+
+import json
+import os
+import shutil
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Mapping
+from typing import NamedTuple
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+
+try:
+  from . import manifest
+  from . import resolver
+  from . import version_probe
+  from . import wheel_cache
+except ImportError:
+  import manifest
+  import resolver
+  import version_probe
+  import wheel_cache
+
+DEFAULT_JOBS = os.cpu_count() or 1
+
+# In the venv: the source key each vendored package was installed from.
+INSTALLED_FILE_NAME = 'pipsource-installed.json'
+
+# Lines of build output kept for failure reports.
+_ERROR_TAIL_LINES = 20
+
+# Run by the venv's interpreter as `python -c _BUILD_SCRIPT SOURCE WHEEL_DIR`.
+# It must also run on Python 2.7, and can't rely on a TOML parser.
+_BUILD_SCRIPT = r'''
+import importlib, os, re, sys
+source, wheel_dir = os.path.abspath(sys.argv[1]), os.path.abspath(sys.argv[2])
+backend, backend_path = 'setuptools.build_meta:__legacy__', []
+try:
+  with open(os.path.join(source, 'pyproject.toml')) as f:
+    text = f.read()
+except (IOError, OSError):
+  text = ''
+match = re.search(r'^\[build-system\][ \t]*$(.*?)(?=^\[[^\]\n]*\][ \t]*$|\Z)',
+                  text, re.M | re.S)
+if match:
+  found = re.search(r'^build-backend\s*=\s*["\']([^"\']+)["\']',
+                    match.group(1), re.M)
+  if found:
+    backend = found.group(1)
+  found = re.search(r'^backend-path\s*=\s*\[([^\]]*)\]', match.group(1), re.M)
+  if found:
+    backend_path = re.findall(r'["\']([^"\']+)["\']', found.group(1))
+os.chdir(source)
+sys.path[:0] = [os.path.join(source, path) for path in backend_path]
+module_name, _, attrs = backend.partition(':')
+hooks = importlib.import_module(module_name)
+for attr in filter(None, attrs.split('.')):
+  hooks = getattr(hooks, attr)
+hooks.build_wheel(wheel_dir)
+'''
+
+
+class Outcome(NamedTuple):
+  package: str
+  version: str
+  # 'built', 'cached', 'failed', or 'skipped' if a dependency failed.
+  status: str
+  seconds: float
+  wheel: Optional[str] = None
+  error: Optional[str] = None
+  # The wheel cache key of the source the wheel was built from.
+  key: Optional[str] = None
+
+
+def _tail(output: bytes) -> str:
+  lines = output.decode(errors='replace').strip().splitlines()
+  return '\n'.join(lines[-_ERROR_TAIL_LINES:])
+
+
+def venv_python(venv_dir: str) -> str:
+  return os.path.join(venv_dir, 'bin', 'python')
+
+
+def ensure_venv(venv_dir: str, python_bin: str = 'python'):
+  """Creates the venv with python_bin unless it exists."""
+  if os.path.exists(venv_python(venv_dir)):
+    return
+  try:
+    subprocess.run(['virtualenv', '--no-download', venv_dir,
+                    '--python=%s' % python_bin], check=True)
+  except FileNotFoundError:
+    subprocess.run([python_bin, '-m', 'venv', venv_dir], check=True)
+
+
+class Installer(object):
+  """Installs vendored packages into one venv."""
+
+  def __init__(self, vendor_dir: str, venv_dir: str,
+               cache_dir: str = wheel_cache.DEFAULT_CACHE_DIR,
+               jobs: int = DEFAULT_JOBS):
+    self.vendor_dir = vendor_dir
+    self.venv_dir = venv_dir
+    self.cache_dir = cache_dir
+    self.jobs = jobs
+    self.python = venv_python(venv_dir)
+    self._abi = wheel_cache.abi_tag(self.python)
+    self._manifest = manifest.Manifest(
+        os.path.join(vendor_dir, manifest.MANIFEST_FILE_NAME))
+    self._print_lock = threading.Lock()
+    self._installed_path = os.path.join(venv_dir, INSTALLED_FILE_NAME)
+    self._installed = self._load_installed()
+
+  def _load_installed(self) -> Dict[str, str]:
+    try:
+      with open(self._installed_path) as installed_file:
+        return json.loads(installed_file.read())
+    except (OSError, ValueError):
+      return {}
+
+  def _save_installed(self):
+    tmp_path = '%s.tmp.%d' % (self._installed_path, os.getpid())
+    with open(tmp_path, 'w') as installed_file:
+      json.dump(self._installed, installed_file, sort_keys=True, indent=2)
+    os.replace(tmp_path, self._installed_path)
+
+  def _report(self, outcome: Outcome):
+    with self._print_lock:
+      print('%-7s %s %s (%.1fs)' % (outcome.status, outcome.package,
+                                    outcome.version, outcome.seconds))
+
+  def _source_key(self, package: str, version: str) -> str:
+    entry = self._manifest.get(package)
+    if entry and entry.version == version:
+      return wheel_cache.source_key(package, version, entry.tree,
+                                    entry.commit)
+    return wheel_cache.source_key(package, version)
+
+  def _build(self, package: str, version: str) -> Outcome:
+    """Returns the package's wheel from the cache, building it if needed."""
+    start = time.monotonic()
+    package_dir = os.path.join(self.vendor_dir, package)
+    if not os.path.isdir(package_dir):
+      return Outcome(package, version, 'failed', 0.0,
+                     error='%s is not vendored' % package_dir)
+    key = self._source_key(package, version)
+    wheel = wheel_cache.cached_wheel(self.cache_dir, key, self._abi)
+    if wheel:
+      return Outcome(package, version, 'cached',
+                     time.monotonic() - start, wheel, key=key)
+
+    wheel_dir = wheel_cache.wheel_dir(self.cache_dir, key, self._abi)
+    tmp_dir = '%s.tmp.%d.%d' % (wheel_dir, os.getpid(), threading.get_ident())
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    env = os.environ.copy()
+    info = version_probe.detect(package_dir)
+    if info is not None and info.scm:
+      # The vendored tree has no VCS metadata to take its version from.
+      env['SETUPTOOLS_SCM_PRETEND_VERSION'] = version
+      env['PBR_VERSION'] = version
+    result = subprocess.run(
+        [self.python, '-c', _BUILD_SCRIPT, package_dir, tmp_dir], env=env,
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    wheels = [name for name in os.listdir(tmp_dir) if name.endswith('.whl')]
+    if result.returncode or not wheels:
+      shutil.rmtree(tmp_dir, ignore_errors=True)
+      return Outcome(package, version, 'failed', time.monotonic() - start,
+                     error=_tail(result.stdout) or 'No wheel was built')
+    shutil.rmtree(wheel_dir, ignore_errors=True)
+    os.rename(tmp_dir, wheel_dir)
+    return Outcome(package, version, 'built', time.monotonic() - start,
+                   os.path.join(wheel_dir, sorted(wheels)[0]), key=key)
+
+  def _pip_install(self, outcomes: Sequence[Outcome]) -> Optional[bytes]:
+    """Installs the outcomes' wheels; returns pip's output if it failed.
+
+    pip leaves an installed version alone, so wheels of packages whose source
+    changed since they were installed are reinstalled by force.
+    """
+    changed = [o.wheel for o in outcomes
+               if self._installed.get(o.package) != o.key]
+    unchanged = [o.wheel for o in outcomes
+                 if self._installed.get(o.package) == o.key]
+    for wheels, flags in ((changed, ['--force-reinstall']), (unchanged, [])):
+      if not wheels:
+        continue
+      result = subprocess.run(
+          [self.python, '-m', 'pip', 'install', '--quiet', '--no-index',
+           '--no-deps'] + flags + wheels,
+          stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+      if result.returncode:
+        return result.stdout
+    for outcome in outcomes:
+      self._installed[outcome.package] = outcome.key
+    return None
+
+  def _install_level(self, built: List[Outcome]) -> List[Outcome]:
+    """Installs the level's wheels, failing just the ones pip rejects."""
+    if not built:
+      return built
+    if self._pip_install(built) is None:
+      return built
+    # Install one at a time to find out which wheels pip rejects.
+    outcomes = []
+    for outcome in built:
+      output = self._pip_install([outcome])
+      if output is not None:
+        outcome = outcome._replace(status='failed', error=_tail(output))
+      outcomes.append(outcome)
+    return outcomes
+
+  def install(self, packages_and_versions: Sequence[Tuple[str, str]],
+              graph: Mapping[str, Iterable[str]]) -> List[Outcome]:
+    """Builds and installs the packages; graph maps each to its deps."""
+    versions = dict(packages_and_versions)
+    outcomes = {}  # type: Dict[str, Outcome]
+    with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+      for level in resolver.levels(
+          {p: set(graph.get(p, ())) for p in versions}):
+        to_build = []
+        for package in level:
+          failed_deps = sorted(
+              d for d in graph.get(package, ())
+              if d in outcomes and outcomes[d].status in ('failed', 'skipped'))
+          if failed_deps:
+            outcome = Outcome(
+                package, versions[package], 'skipped', 0.0,
+                error='Depends on %s, which failed' % ', '.join(failed_deps))
+            outcomes[package] = outcome
+            self._report(outcome)
+          else:
+            to_build.append(package)
+        built = []
+        for outcome in executor.map(
+            lambda package: self._build(package, versions[package]),
+            to_build):
+          self._report(outcome)
+          if outcome.status == 'failed':
+            outcomes[outcome.package] = outcome
+          else:
+            built.append(outcome)
+        for outcome in self._install_level(built):
+          outcomes[outcome.package] = outcome
+    self._save_installed()
+    return [outcomes[package] for package in versions]
+
+
+def print_summary(outcomes: List[Outcome]):
+  """Prints counts by status and the error of each failed package."""
+  counts = {}  # type: Dict[str, int]
+  for outcome in outcomes:
+    counts[outcome.status] = counts.get(outcome.status, 0) + 1
+    if outcome.error:
+      print('%s %s %s: %s' % (outcome.status.capitalize(), outcome.package,
+                              outcome.version, outcome.error))
+  installed = counts.get('built', 0) + counts.get('cached', 0)
+  print('Installed %d packages (%d built, %d cached), %d failed, %d skipped' %
+        (installed, counts.get('built', 0), counts.get('cached', 0),
+         counts.get('failed', 0), counts.get('skipped', 0)))
@@ -0,0 +1,289 @@
+"""Integrity verification of vendored package trees.
+
+When a package is vendored, the SHA-256 of each of its files is written to an
+integrity record in the vendor dir, along with the tree hash those files make
+up and the commit the tree came from. `verify` checks the vendor dir against
+that record and reports any drift: changed, missing or extra files, changed
+executable bits or symlinks, and records that don't match their tree, the
+vendor manifest or, given the content store, the store's ref for the package's
+version.
+
+Re-hashing gigabytes of sources on every run would be slow, so verified hashes
+are cached per file along with the file's size, mtime, ctime and inode. Only
+files whose stat changed are hashed again, using a process pool and memory
+mapped reads when there is enough to hash.
+"""
+
+import hashlib
+import json
+import mmap
+import os
+import stat
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Tuple
+
+try:
+  from . import content_store
+  from . import locking
+  from . import manifest
+except ImportError:
+  import content_store
+  import locking
+  import manifest
+
+RECORD_FILE_NAME = '.pipsource-integrity.json'
+
+RECORD_FORMAT_VERSION = 1
+
+DEFAULT_STAT_CACHE_FILE = os.path.expanduser('~/.pipsource/verify-stats.json')
+
+DEFAULT_JOBS = os.cpu_count() or 1
+
+# Below this much to hash, starting worker processes costs more than it saves.
+_POOL_MIN_BYTES = 16 * 1024 * 1024
+
+
+class Drift(NamedTuple):
+  package: str
+  # Path within the package dir, or '' for the package as a whole.
+  path: str
+  problem: str
+
+
+def hash_file(path: str) -> str:
+  """Returns the hex SHA-256 of the file, read through a memory map."""
+  digest = hashlib.sha256()
+  with open(path, 'rb') as f:
+    if os.fstat(f.fileno()).st_size:
+      with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        digest.update(mapped)
+  return digest.hexdigest()
+
+
+class IntegrityRecord(object):
+  """Recorded file hashes of each package in one vendor directory."""
+
+  def __init__(self, path: str):
+    self.path = path
+    self._lock = threading.Lock()
+    self._entries = self._load()
+    # Entries changed since the last save; None for removed ones.
+    self._changes = {}  # type: Dict[str, Optional[Dict]]
+
+  def _load(self) -> Dict[str, Dict]:
+    if not os.path.isfile(self.path):
+      return {}
+    with open(self.path) as record_file:
+      record_json = json.loads(record_file.read())
+    if record_json.get('version') != RECORD_FORMAT_VERSION:
+      return {}
+    return record_json['packages']
+
+  def get(self, package: str) -> Optional[Dict]:
+    with self._lock:
+      return self._entries.get(package)
+
+  def record(self, package: str, tree_hash: str, commit: Optional[str],
+             tree: Dict):
+    """Records package as tree (a content store tree manifest)."""
+    with self._lock:
+      self._entries[package] = {
+          'tree': tree_hash,
+          'commit': commit,
+          'files': tree['files'],
+          'symlinks': tree['symlinks'],
+      }
+      self._changes[package] = self._entries[package]
+
+  def remove(self, package: str):
+    with self._lock:
+      if self._entries.pop(package, None) is not None:
+        self._changes[package] = None
+
+  def _apply_changes(self, entries: Dict[str, Dict]) -> Dict[str, Dict]:
+    for package, entry in self._changes.items():
+      if entry is None:
+        entries.pop(package, None)
+      else:
+        entries[package] = entry
+    return entries
+
+  def reload(self):
+    """Re-reads the file, keeping changes not saved yet."""
+    entries = self._load()
+    with self._lock:
+      self._entries = self._apply_changes(entries)
+
+  def packages(self) -> Dict[str, Dict]:
+    with self._lock:
+      return dict(self._entries)
+
+  def save(self):
+    """Merges this process's changes into the file."""
+    with self._lock:
+      if not self._changes:
+        return
+      directory = os.path.dirname(os.path.abspath(self.path))
+      os.makedirs(directory, exist_ok=True)
+      with locking.file_lock(directory):
+        self._entries = self._apply_changes(self._load())
+        tmp_path = '%s.tmp.%d' % (self.path, os.getpid())
+        with open(tmp_path, 'w') as record_file:
+          json.dump({'version': RECORD_FORMAT_VERSION,
+                     'packages': self._entries},
+                    record_file, sort_keys=True, indent=1)
+        os.replace(tmp_path, self.path)
+      self._changes = {}
+
+
+def _stat_key(file_stat: os.stat_result) -> List[int]:
+  return [file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ctime_ns,
+          file_stat.st_ino]
+
+
+class StatCache(object):
+  """File hashes remembered by path, valid while the file's stat is unchanged.
+
+  Inodes and ctimes are machine specific, so this lives outside the vendor dir.
+  """
+
+  def __init__(self, path: Optional[str]):
+    self.path = path
+    self._entries = {}  # type: Dict[str, List]
+    if path and os.path.isfile(path):
+      try:
+        with open(path) as cache_file:
+          self._entries = json.loads(cache_file.read())
+      except ValueError:
+        pass
+
+  def get(self, path: str, file_stat: os.stat_result) -> Optional[str]:
+    entry = self._entries.get(path)
+    if entry and entry[:-1] == _stat_key(file_stat):
+      return entry[-1]
+    return None
+
+  def put(self, path: str, file_stat: os.stat_result, file_hash: str):
+    self._entries[path] = _stat_key(file_stat) + [file_hash]
+
+  def save(self):
+    if not self.path:
+      return
+    os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+    tmp_path = '%s.tmp.%d' % (self.path, os.getpid())
+    with open(tmp_path, 'w') as cache_file:
+      json.dump(self._entries, cache_file)
+    os.replace(tmp_path, self.path)
+
+
+def _hash_files(paths: List[str], total_bytes: int,
+                jobs: int) -> List[str]:
+  if jobs <= 1 or total_bytes < _POOL_MIN_BYTES:
+    return [hash_file(path) for path in paths]
+  with ProcessPoolExecutor(max_workers=jobs) as executor:
+    return list(executor.map(hash_file, paths,
+                             chunksize=max(1, len(paths) // (jobs * 4))))
+
+
+def _check_record(package: str, entry: Dict,
+                  vendor_manifest: manifest.Manifest,
+                  store: Optional[content_store.ContentStore]) -> List[Drift]:
+  drift = []
+  tree = {'files': entry['files'], 'symlinks': entry['symlinks']}
+  if content_store.tree_hash(tree) != entry['tree']:
+    drift.append(Drift(package, '', 'record does not match its tree hash'))
+  manifest_entry = vendor_manifest.get(package)
+  if manifest_entry and (manifest_entry.tree != entry['tree'] or
+                         manifest_entry.commit != entry['commit']):
+    drift.append(Drift(package, '',
+                       'record does not match the vendor manifest'))
+  if manifest_entry and store:
+    # Stores are per machine, so a version the store lacks isn't drift.
+    ref = store.get_ref(package, manifest_entry.version, manifest_entry.label)
+    if ref and ref.tree != entry['tree']:
+      drift.append(Drift(package, '',
+                         'record does not match the content store'))
+  return drift
+
+
+def verify(vendor_dir: str, packages: Optional[Iterable[str]] = None,
+           stat_cache_path: Optional[str] = DEFAULT_STAT_CACHE_FILE,
+           jobs: int = DEFAULT_JOBS,
+           excludes: Iterable[str] = content_store.DEFAULT_EXCLUDES,
+           store_dir: Optional[str] = None) -> List[Drift]:
+  """Checks the vendored packages (default all recorded) against the record.
+
+  With store_dir, each record is also checked against the content store's ref
+  for the package's vendored version. Returns the drift found, which is empty
+  if every package is intact.
+  """
+  excludes = tuple(excludes)
+  record = IntegrityRecord(os.path.join(vendor_dir, RECORD_FILE_NAME))
+  vendor_manifest = manifest.Manifest(
+      os.path.join(vendor_dir, manifest.MANIFEST_FILE_NAME))
+  store = None
+  if store_dir and os.path.isdir(store_dir):
+    store = content_store.ContentStore(store_dir)
+  entries = record.packages()
+  if packages is None:
+    packages = sorted(entries)
+  stat_cache = StatCache(stat_cache_path)
+
+  drift = []
+  # (package, relative path, absolute path, stat, expected hash)
+  to_hash = []  # type: List[Tuple[str, str, str, os.stat_result, str]]
+  for package in packages:
+    entry = entries.get(package)
+    if entry is None:
+      drift.append(Drift(package, '', 'not in the integrity record'))
+      continue
+    package_dir = os.path.join(vendor_dir, package)
+    if not os.path.isdir(package_dir):
+      drift.append(Drift(package, '', 'package dir is missing'))
+      continue
+    drift += _check_record(package, entry, vendor_manifest, store)
+    found = set(content_store.walk_files(package_dir, excludes))
+    expected = set()
+    for rel_path, target in entry['symlinks']:
+      expected.add(rel_path)
+      path = os.path.join(package_dir, rel_path)
+      if not os.path.islink(path):
+        drift.append(Drift(package, rel_path, 'symlink is missing'))
+      elif os.readlink(path) != target:
+        drift.append(Drift(package, rel_path, 'symlink target changed'))
+    for rel_path, file_hash, executable in entry['files']:
+      expected.add(rel_path)
+      path = os.path.join(package_dir, rel_path)
+      try:
+        file_stat = os.lstat(path)
+      except FileNotFoundError:
+        drift.append(Drift(package, rel_path, 'file is missing'))
+        continue
+      if not stat.S_ISREG(file_stat.st_mode):
+        drift.append(Drift(package, rel_path, 'is no longer a regular file'))
+        continue
+      if bool(file_stat.st_mode & stat.S_IXUSR) != executable:
+        drift.append(Drift(package, rel_path, 'executable bit changed'))
+      cached_hash = stat_cache.get(path, file_stat)
+      if cached_hash is None:
+        to_hash.append((package, rel_path, path, file_stat, file_hash))
+      elif cached_hash != file_hash:
+        drift.append(Drift(package, rel_path, 'contents changed'))
+    for rel_path in sorted(found - expected):
+      drift.append(Drift(package, rel_path, 'unexpected file'))
+
+  hashes = _hash_files([item[2] for item in to_hash],
+                       sum(item[3].st_size for item in to_hash), jobs)
+  for (package, rel_path, path, file_stat, expected_hash), actual_hash in zip(
+      to_hash, hashes):
+    stat_cache.put(path, file_stat, actual_hash)
+    if actual_hash != expected_hash:
+      drift.append(Drift(package, rel_path, 'contents changed'))
+  stat_cache.save()
+  return sorted(drift)
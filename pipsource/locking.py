@@ -0,0 +1,37 @@
+"""Advisory file locks for state shared by concurrent pipsource processes.
+
+The daemon, CLI runs and CI jobs on one host share the same caches and vendor
+dirs. Locks are flock(2) locks, which also serialize threads of one process,
+since each acquisition opens the file anew.
+"""
+
+import contextlib
+import fcntl
+import os
+from typing import Iterator
+
+
+@contextlib.contextmanager
+def file_lock(path: str, shared: bool = False,
+              blocking: bool = True) -> Iterator[bool]:
+  """Holds an exclusive (or shared) lock on path while in the context.
+
+  path is a lock file, created if needed, or an existing dir, which is locked
+  without adding anything to it. Yields whether the lock is held, which is
+  only ever False when not blocking and someone else holds it.
+  """
+  if os.path.isdir(path):
+    fd = os.open(path, os.O_RDONLY)
+  else:
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    fd = os.open(path, os.O_RDONLY | os.O_CREAT, 0o644)
+  try:
+    operation = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+    try:
+      fcntl.flock(fd, operation if blocking else operation | fcntl.LOCK_NB)
+    except BlockingIOError:
+      yield False
+      return
+    yield True
+  finally:
+    os.close(fd)
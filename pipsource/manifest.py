@@ -0,0 +1,164 @@
+"""Lockfile recording exactly what each vendored package directory holds.
+
+For every package the manifest stores the version, source URL, version label,
+resolved commit and content tree hash, plus a stat fingerprint of the package
+directory's top level. A later run can confirm a package is current by comparing these
+fields and re-statting the directory, without starting git or hg.
+
+Several processes (vendor runs, the daemon, gc, unpack) update the manifest,
+so saving re-reads it while holding a lock on its dir and writes back only the
+entries this process changed.
+"""
+
+import hashlib
+import json
+import os
+import threading
+from typing import Dict
+from typing import NamedTuple
+from typing import Optional
+from typing import Sequence
+
+try:
+  from . import locking
+except ImportError:
+  import locking
+
+MANIFEST_FILE_NAME = '.pipsource-lock.json'
+
+MANIFEST_FORMAT_VERSION = 1
+
+# What building a package in its own dir (e.g. `pip wheel`) leaves behind.
+BUILD_ARTIFACTS = ('build', 'dist', '.eggs', '__pycache__', 'pip-egg-info')
+
+
+class Entry(NamedTuple):
+  version: str
+  source: str
+  label: Sequence[str]
+  commit: Optional[str]
+  tree: str
+  fingerprint: str
+
+
+def fingerprint(package_dir: str) -> str:
+  """Returns a cheap stat-based fingerprint of a package directory.
+
+  It covers the names, types and file sizes of the top level entries, so it is
+  the same for any checkout of the same tree, however and whenever it was
+  made, and ignores build artifacts. Detecting edits deeper in the tree is
+  left to full integrity verification. Empty if the directory is missing.
+  """
+  stats = []
+  try:
+    with os.scandir(package_dir) as entries:
+      for entry in entries:
+        if (entry.name in BUILD_ARTIFACTS or
+            entry.name.endswith('.egg-info')):
+          continue
+        if entry.is_symlink():
+          stats.append((entry.name, 'link', os.readlink(entry.path)))
+        elif entry.is_dir():
+          stats.append((entry.name, 'dir', 0))
+        else:
+          stats.append((entry.name, 'file',
+                        entry.stat(follow_symlinks=False).st_size))
+  except FileNotFoundError:
+    return ''
+  stats.sort()
+  return hashlib.sha1(repr(stats).encode()).hexdigest()
+
+
+class Manifest(object):
+  """The set of manifest entries for one vendor directory."""
+
+  def __init__(self, path: str):
+    self.path = path
+    self._lock = threading.Lock()
+    self._entries = self._load()
+    # Entries changed since the last save; None for removed ones.
+    self._changes = {}  # type: Dict[str, Optional[Entry]]
+
+  def _load(self) -> Dict[str, Entry]:
+    if not os.path.isfile(self.path):
+      return {}
+    with open(self.path) as manifest_file:
+      manifest_json = json.loads(manifest_file.read())
+    if manifest_json.get('version') != MANIFEST_FORMAT_VERSION:
+      return {}
+    return {
+        package: Entry(**entry)
+        for package, entry in manifest_json['packages'].items()
+    }
+
+  def get(self, package: str) -> Optional[Entry]:
+    with self._lock:
+      return self._entries.get(package)
+
+  def is_current(self, package: str, version: str, source: str,
+                 label: Sequence[str], package_dir: str) -> bool:
+    """Whether package_dir still holds what was recorded for this request."""
+    entry = self.get(package)
+    if entry is None or not entry.fingerprint:
+      return False
+    return (entry.version == version and entry.source == source and
+            list(entry.label) == list(label) and
+            entry.fingerprint == fingerprint(package_dir))
+
+  def record(self, package: str, version: str, source: str,
+             label: Sequence[str], commit: Optional[str], tree: str,
+             package_dir: str):
+    """Records what package_dir holds; raises ValueError if it's missing."""
+    dir_fingerprint = fingerprint(package_dir)
+    if not dir_fingerprint:
+      raise ValueError('Package dir %s does not exist' % package_dir)
+    entry = Entry(version=version, source=source, label=list(label),
+                  commit=commit, tree=tree, fingerprint=dir_fingerprint)
+    with self._lock:
+      self._entries[package] = entry
+      self._changes[package] = entry
+
+  def remove(self, package: str):
+    with self._lock:
+      self._entries.pop(package, None)
+      self._changes[package] = None
+
+  def _apply_changes(self, entries: Dict[str, Entry]) -> Dict[str, Entry]:
+    for package, entry in self._changes.items():
+      if entry is None:
+        entries.pop(package, None)
+      else:
+        entries[package] = entry
+    return entries
+
+  def reload(self):
+    """Re-reads the file, e.g. when other processes may have saved it.
+
+    Changes not saved yet are kept.
+    """
+    entries = self._load()
+    with self._lock:
+      self._entries = self._apply_changes(entries)
+
+  def packages(self) -> Dict[str, Entry]:
+    with self._lock:
+      return dict(self._entries)
+
+  def save(self):
+    """Merges this process's changes into the file."""
+    directory = os.path.dirname(os.path.abspath(self.path))
+    os.makedirs(directory, exist_ok=True)
+    with self._lock, locking.file_lock(directory):
+      self._entries = self._apply_changes(self._load())
+      manifest_json = {
+          'version': MANIFEST_FORMAT_VERSION,
+          'packages': {
+              package: entry._asdict()
+              for package, entry in self._entries.items()
+          },
+      }
+      tmp_path = '%s.tmp.%d' % (self.path, os.getpid())
+      with open(tmp_path, 'w') as manifest_file:
+        json.dump(manifest_json, manifest_file, sort_keys=True, indent=2)
+      os.replace(tmp_path, self.path)
+      self._changes = {}
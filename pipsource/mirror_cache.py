@@ -0,0 +1,335 @@
+"""Local cache of bare git and hg mirrors, one per source URL.
+
+Package directories are fetched from these mirrors instead of from the
+network, and evicting a mirror never breaks a package directory that was
+fetched from it. Each mirror has a lock file next to it, held while the mirror
+is updated or fetched from, and the index of mirrors is updated under a lock
+too, so several processes can share one cache dir.
+
+Git mirrors are shallow: each tag or commit is fetched on its own with depth
+1, so vendoring one version of a project with a long history only transfers
+that version's tree. Servers that refuse requests for unadvertised commits
+(protocol v0 without uploadpack.allowAnySHA1InWant) get a fallback that
+deepens the default branch's history in steps until the commit turns up, and
+fetches the full history of every branch only if it isn't there.
+"""
+
+import contextlib
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess
+import threading
+import time
+from typing import Dict
+from typing import Iterator
+from typing import Optional
+
+try:
+  from . import locking
+  from . import tracing
+except ImportError:
+  import locking
+  import tracing
+
+DEFAULT_MAX_BYTES = 10 * 1024 ** 3
+
+INDEX_FILE_NAME = 'index.json'
+
+# History depths tried, in order, when a commit can't be fetched directly.
+DEEPEN_STEPS = (50, 200, 1000)
+
+# Where commits fetched by hash are kept so they stay reachable in the mirror.
+COMMIT_REF_PREFIX = 'refs/pipsource/commits/'
+
+_FULL_SHA_RE = re.compile(r'^[0-9a-f]{40}([0-9a-f]{24})?$')
+
+_ABBREVIATED_SHA_RE = re.compile(r'^[0-9a-f]{4,64}$')
+
+_ALL_REFSPECS = ['+refs/heads/*:refs/heads/*', '+refs/tags/*:refs/tags/*']
+
+_SIZE_SUFFIXES = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3,
+                  'T': 1024 ** 4}
+
+
+def parse_size(size: str) -> int:
+  """Parses a human readable size like "500M" or "10G" into bytes."""
+  match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*$', size.upper())
+  if not match:
+    raise ValueError('Invalid size %s' % size)
+  number, suffix = match.groups()
+  return int(float(number) * _SIZE_SUFFIXES[suffix])
+
+
+def format_size(size: int) -> str:
+  """Formats a size in bytes for people, e.g. "1.5M"."""
+  for suffix in ('B', 'K', 'M', 'G'):
+    if size < 1024 or suffix == 'G':
+      return ('%d%s' if suffix == 'B' else '%.1f%s') % (size, suffix)
+    size /= 1024.0
+
+
+def dir_size(path: str) -> int:
+  """Returns the total size in bytes of the files under path."""
+  total = 0
+  for root, dirs, files in os.walk(path):
+    for name in files:
+      try:
+        total += os.lstat(os.path.join(root, name)).st_size
+      except OSError:
+        pass
+  return total
+
+
+def _mirror_name(url: str) -> str:
+  digest = hashlib.sha1(url.encode()).hexdigest()[:16]
+  base = re.sub(r'[^A-Za-z0-9_.-]+', '_', url.rstrip('/').split('/')[-1])
+  return '%s-%s' % (base or 'repo', digest)
+
+
+class MirrorCache(object):
+  """Bare mirrors of source repos with a total size cap and LRU eviction."""
+
+  def __init__(self, cache_dir: str, max_bytes: int = DEFAULT_MAX_BYTES):
+    self.cache_dir = cache_dir
+    self.max_bytes = max_bytes
+    self._index_path = os.path.join(cache_dir, INDEX_FILE_NAME)
+    self._index_lock = threading.Lock()
+    self._index = self._load_index()
+
+  def _load_index(self) -> Dict[str, Dict]:
+    if not os.path.isfile(self._index_path):
+      return {}
+    with open(self._index_path) as index_file:
+      return json.loads(index_file.read())
+
+  def _save_index(self):
+    os.makedirs(self.cache_dir, exist_ok=True)
+    tmp_path = self._index_path + '.tmp.%d' % os.getpid()
+    with open(tmp_path, 'w') as index_file:
+      json.dump(self._index, index_file, sort_keys=True, indent=2)
+    os.replace(tmp_path, self._index_path)
+
+  @contextlib.contextmanager
+  def _locked_index(self) -> Iterator[None]:
+    """Locks the index and brings it up to date with other processes'."""
+    with self._index_lock, locking.file_lock(self._index_path + '.lock'):
+      self._index = self._load_index()
+      yield
+
+  def _url_lock(self, url: str):
+    return locking.file_lock(self.mirror_path(url) + '.lock')
+
+  def mirror_path(self, url: str) -> str:
+    return os.path.join(self.cache_dir, _mirror_name(url))
+
+  @contextlib.contextmanager
+  def git_mirror(self, url: str, ref: Optional[str] = None) -> Iterator[str]:
+    """Yields a bare git mirror of url that contains ref.
+
+    ref is a tag or a (possibly abbreviated) commit hash; without one, the
+    tips of all branches and tags are fetched. If ref is already present in
+    the mirror, no network access happens. The mirror is locked against
+    updates and eviction until the context exits, so fetch from it inside the
+    `with` block.
+    """
+    with self._url_lock(url):
+      path = self.mirror_path(url)
+      changed = not os.path.isdir(path)
+      if changed:
+        self._create_git(path, url)
+      if ref is None:
+        with tracing.span('mirror-fetch'):
+          _git_fetch(path, ['--depth', '1', 'origin'] + _ALL_REFSPECS,
+                     check=True)
+        changed = True
+      elif not _git_has_ref(path, ref):
+        with tracing.span('mirror-fetch'):
+          _fetch_git_ref(path, url, ref)
+        changed = True
+      self._touch(url, path, changed)
+      yield path
+    self.evict()
+
+  @contextlib.contextmanager
+  def hg_mirror(self, url: str, rev: Optional[str] = None) -> Iterator[str]:
+    """Yields an up to date hg mirror (a repo without a working copy)."""
+    with self._url_lock(url):
+      path = self.mirror_path(url)
+      changed = True
+      if not os.path.isdir(path):
+        self._create(path, ['hg', 'clone', '--noupdate', '--quiet', url])
+      elif rev is None or not _hg_has_rev(path, rev):
+        with tracing.span('mirror-fetch'):
+          tracing.run_subprocess(['hg', 'pull', '--quiet'], cwd=path,
+                                 check=True)
+      else:
+        changed = False
+      self._touch(url, path, changed)
+      yield path
+    self.evict()
+
+  def _create_git(self, path: str, url: str):
+    def init(tmp_path):
+      tracing.run_subprocess(['git', 'init', '--bare', '--quiet', tmp_path],
+                             check=True)
+      for key, value in (('remote.origin.url', url),
+                         # Package dirs fetch single commits from the mirror.
+                         ('uploadpack.allowAnySHA1InWant', 'true')):
+        tracing.run_subprocess(['git', 'config', key, value], cwd=tmp_path,
+                               check=True)
+
+    self._create(path, init)
+
+  def _create(self, path: str, clone_cmd):
+    # Clone next to the final location and rename it into place so that an
+    # interrupted clone never leaves a half-populated mirror behind.
+    os.makedirs(self.cache_dir, exist_ok=True)
+    tmp_path = '%s.tmp.%d' % (path, os.getpid())
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    with tracing.span('mirror-clone'):
+      if callable(clone_cmd):
+        clone_cmd(tmp_path)
+      else:
+        tracing.run_subprocess(clone_cmd + [tmp_path], check=True)
+    os.rename(tmp_path, path)
+
+  def _touch(self, url: str, path: str, changed: bool):
+    """Marks the mirror as used now, and records its size if it changed.
+
+    A mirror used without changing only has its lock file's mtime updated, so
+    that cache hits neither walk the mirror nor rewrite the index.
+    """
+    with self._index_lock:
+      indexed = url in self._index
+    if indexed and not changed:
+      os.utime(path + '.lock')
+      return
+    size = dir_size(path)
+    with self._locked_index():
+      self._index[url] = {
+          'dir': os.path.basename(path),
+          'last_used': time.time(),
+          'bytes': size,
+      }
+      self._save_index()
+
+  def total_bytes(self) -> int:
+    with self._locked_index():
+      return sum(entry['bytes'] for entry in self._index.values())
+
+  def _last_used(self, entry: Dict) -> float:
+    lock_path = os.path.join(self.cache_dir, entry['dir']) + '.lock'
+    try:
+      return max(entry['last_used'], os.stat(lock_path).st_mtime)
+    except OSError:
+      return entry['last_used']
+
+  def evict(self):
+    """Removes least recently used mirrors until the cache fits its cap.
+
+    Mirrors that are currently locked, by this or another process, are
+    skipped.
+    """
+    with self._locked_index():
+      total = sum(entry['bytes'] for entry in self._index.values())
+      if total <= self.max_bytes:
+        return
+      entries = sorted(self._index.items(),
+                       key=lambda e: self._last_used(e[1]))
+      for url, entry in entries:
+        if total <= self.max_bytes:
+          break
+        with locking.file_lock(
+            os.path.join(self.cache_dir, entry['dir']) + '.lock',
+            blocking=False) as locked:
+          if not locked:
+            continue
+          shutil.rmtree(os.path.join(self.cache_dir, entry['dir']),
+                        ignore_errors=True)
+          del self._index[url]
+          total -= entry['bytes']
+      self._save_index()
+
+
+def _git_fetch(mirror: str, args, check: bool = False) -> bool:
+  result = tracing.run_subprocess(
+      ['git', 'fetch', '--quiet'] + args, cwd=mirror,
+      stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+  if check and result.returncode != 0:
+    raise subprocess.CalledProcessError(
+        result.returncode, ['git', 'fetch'] + args, stderr=result.stderr)
+  return result.returncode == 0
+
+
+def _fetch_git_ref(mirror: str, url: str, ref: str):
+  """Fetches just ref into the mirror, deepening history only if needed."""
+  if _FULL_SHA_RE.match(ref):
+    refspec = '%s:%s%s' % (ref, COMMIT_REF_PREFIX, ref)
+  else:
+    refspec = '+refs/tags/%s:refs/tags/%s' % (ref, ref)
+  if _git_fetch(mirror, ['--depth', '1', 'origin', refspec]) and (
+      _git_has_ref(mirror, ref)):
+    return
+  if not _ABBREVIATED_SHA_RE.match(ref):
+    raise LookupError('Tag %s not found in %s' % (ref, url))
+  # Either the server won't hand out unadvertised commits or ref is an
+  # abbreviated hash, so look for it in the branch history instead. Most
+  # pinned commits are on the default branch, so deepen only that one first.
+  found = False
+  branch = _default_branch(mirror)
+  if branch:
+    refspec = '+refs/heads/%s:refs/heads/%s' % (branch, branch)
+    for depth in DEEPEN_STEPS:
+      _git_fetch(mirror, ['--no-tags', '--depth', str(depth), 'origin',
+                          refspec])
+      if _git_has_ref(mirror, ref):
+        found = True
+        break
+  if not found:
+    unshallow = (['--unshallow'] if os.path.exists(
+        os.path.join(mirror, 'shallow')) else [])
+    _git_fetch(mirror, unshallow + ['origin'] + _ALL_REFSPECS)
+    if not _git_has_ref(mirror, ref):
+      raise LookupError('%s not found in %s' % (ref, url))
+  if _FULL_SHA_RE.match(ref):
+    tracing.run_subprocess(
+        ['git', 'update-ref', COMMIT_REF_PREFIX + ref, ref], cwd=mirror,
+        check=True)
+
+
+def _default_branch(mirror: str) -> Optional[str]:
+  """Returns the name of the remote's default branch, if it tells."""
+  result = tracing.run_subprocess(
+      ['git', 'ls-remote', '--symref', 'origin', 'HEAD'], cwd=mirror,
+      stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+      universal_newlines=True)
+  match = re.match(r'ref: refs/heads/(\S+)\tHEAD', result.stdout)
+  return match.group(1) if match else None
+
+
+def _git_has_ref(mirror: str, ref: str) -> bool:
+  """Whether the mirror has ref as a tag or as a (abbreviated) commit.
+
+  A bare name could also resolve to a branch, so tags are looked up by their
+  full ref name.
+  """
+  names = ['refs/tags/%s' % ref]
+  if _ABBREVIATED_SHA_RE.match(ref):
+    names.append(ref)
+  for name in names:
+    result = tracing.run_subprocess(
+        ['git', 'rev-parse', '--verify', '--quiet', '%s^{commit}' % name],
+        cwd=mirror, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    if result.returncode == 0:
+      return True
+  return False
+
+
+def _hg_has_rev(mirror: str, rev: str) -> bool:
+  result = tracing.run_subprocess(
+      ['hg', 'log', '--quiet', '-r', rev], cwd=mirror,
+      stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+  return result.returncode == 0
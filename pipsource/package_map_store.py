@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+"""Package map storage: package name -> source info (git/hg URL, labels).
+
+Two backends share one dict-like interface:
+
+- A sharded directory with one JSON file per package at
+  `<dir>/<first two letters>/<canonical name>.json`. Entries are read only
+  when looked up, so a lookup costs one small file read however big the map
+  is, and saving rewrites only the entries that changed.
+- The original single JSON file, which is read and written as a whole.
+
+Lookups match names canonically (PEP 503), so "PyYAML" finds "pyyaml". Saving
+takes an exclusive file lock and re-reads each changed entry from disk first,
+then applies only the fields this process changed. Concurrent writers that
+touch different packages or fields therefore never lose each other's
+updates.
+
+Run as a script to convert between the two forms:
+  package_map_store.py convert package_map.json package_map/
+  package_map_store.py convert package_map/ exported.json
+"""
+
+import abc
+import collections.abc
+import contextlib
+import copy
+import json
+import os
+import sys
+import threading
+from typing import Any
+from typing import Dict
+from typing import Iterator
+from typing import Optional
+from typing import Set
+
+try:
+  from . import locking
+  from . import resolver
+except ImportError:
+  import locking
+  import resolver
+
+LOCK_FILE_NAME = '.lock'
+
+_MISSING = object()
+
+
+def _dumps(value: Any) -> str:
+  return json.dumps(value, sort_keys=True, indent=2)
+
+
+def _write_atomic(path: str, content: str):
+  tmp_path = '%s.tmp.%d.%d' % (path, os.getpid(), threading.get_ident())
+  with open(tmp_path, 'w') as f:
+    f.write(content)
+  os.replace(tmp_path, path)
+
+
+def _merge(base: Any, ours: Any, theirs: Any) -> Any:
+  """Applies the top level fields changed from base to ours onto theirs."""
+  if not isinstance(theirs, dict) or not isinstance(ours, dict):
+    return ours
+  base = base if isinstance(base, dict) else {}
+  merged = dict(theirs)
+  for key in set(base) | set(ours):
+    if base.get(key, _MISSING) != ours.get(key, _MISSING):
+      if key in ours:
+        merged[key] = ours[key]
+      else:
+        merged.pop(key, None)
+  return merged
+
+
+class PackageMap(collections.abc.MutableMapping):
+  """Dict-like package map that tracks which entries changed.
+
+  Values are the entries' JSON objects and may be modified in place; changes
+  are found at save time by comparing against the entries as loaded.
+  """
+
+  def __init__(self, path: str):
+    self.path = path
+    self._lock = threading.RLock()
+    # Entries read or set so far, keyed by canonical name.
+    self._entries = {}  # type: Dict[str, Any]
+    self._names = {}  # type: Dict[str, str]
+    # Serialized entries as last read from or written to disk.
+    self._snapshots = {}  # type: Dict[str, Optional[str]]
+    # What _stamp returned when each entry was read or written.
+    self._stamps = {}  # type: Dict[str, Any]
+    self._deleted = set()  # type: Set[str]
+
+  # Backend hooks.
+
+  @abc.abstractmethod
+  def _read(self, key: str):
+    """Returns the (name, entry) stored for a canonical key, or None."""
+
+  @abc.abstractmethod
+  def _list_keys(self) -> Iterator[str]:
+    """Returns the canonical keys of the stored entries."""
+
+  @abc.abstractmethod
+  def _write(self, changes: Dict[str, Any]):
+    """Stores entries (None deletes) while holding the write lock."""
+
+  @abc.abstractmethod
+  def _lock_path(self) -> str:
+    """Returns the path of the file locked while writing."""
+
+  @abc.abstractmethod
+  def _stamp(self, key: str) -> Any:
+    """Returns what changes whenever the stored entry for key changes."""
+
+  # Mapping interface.
+
+  def _load(self, key: str) -> bool:
+    if key in self._entries:
+      return True
+    if key in self._deleted:
+      return False
+    # Stamped first, so a write racing the read at worst reloads it again.
+    stamp = self._stamp(key)
+    stored = self._read(key)
+    if stored is None:
+      return False
+    name, entry = stored
+    self._names[key] = name
+    self._entries[key] = entry
+    self._snapshots[key] = _dumps(entry)
+    self._stamps[key] = stamp
+    return True
+
+  def refresh(self):
+    """Forgets the entries changed on disk since they were read.
+
+    They are read again when next looked up. Entries with unsaved changes are
+    kept; saving merges them with what is on disk.
+    """
+    with self._lock:
+      for key in list(self._entries):
+        if (_dumps(self._entries[key]) == self._snapshots.get(key) and
+            self._stamp(key) != self._stamps.get(key)):
+          del self._entries[key]
+          del self._names[key]
+          del self._snapshots[key]
+          del self._stamps[key]
+
+  def find(self, package: str) -> Optional[str]:
+    """Returns the map's spelling of package, if it has an entry for it."""
+    key = resolver.canonical_name(package)
+    with self._lock:
+      return self._names[key] if self._load(key) else None
+
+  def __getitem__(self, package: str) -> Any:
+    key = resolver.canonical_name(package)
+    with self._lock:
+      if not self._load(key):
+        raise KeyError(package)
+      return self._entries[key]
+
+  def __setitem__(self, package: str, entry: Any):
+    key = resolver.canonical_name(package)
+    with self._lock:
+      if key not in self._snapshots:
+        # Remember what is on disk so save() can tell what changed.
+        self._load(key)
+        self._snapshots.setdefault(key, None)
+      self._deleted.discard(key)
+      self._names[key] = package
+      self._entries[key] = entry
+
+  def __delitem__(self, package: str):
+    key = resolver.canonical_name(package)
+    with self._lock:
+      if not self._load(key):
+        raise KeyError(package)
+      del self._entries[key]
+      self._deleted.add(key)
+
+  def __contains__(self, package: object) -> bool:
+    if not isinstance(package, str):
+      return False
+    with self._lock:
+      return self._load(resolver.canonical_name(package))
+
+  def __iter__(self) -> Iterator[str]:
+    with self._lock:
+      keys = set(self._list_keys()) | set(self._entries)
+      keys -= self._deleted
+      names = []
+      for key in sorted(keys):
+        if self._load(key):
+          names.append(self._names[key])
+    return iter(names)
+
+  def __len__(self) -> int:
+    return len(list(iter(self)))
+
+  def to_dict(self) -> Dict[str, Any]:
+    return {name: copy.deepcopy(self[name]) for name in self}
+
+  def dirty(self) -> Dict[str, Any]:
+    """Returns the changed entries by canonical key (None if deleted)."""
+    with self._lock:
+      changes = {}
+      for key, entry in self._entries.items():
+        if _dumps(entry) != self._snapshots.get(key):
+          changes[key] = entry
+      for key in self._deleted:
+        if self._snapshots.get(key) is not None:
+          changes[key] = None
+      return changes
+
+  def save(self) -> int:
+    """Writes the changed entries and returns how many there were."""
+    with self._lock:
+      changes = self.dirty()
+      if not changes:
+        return 0
+      os.makedirs(os.path.dirname(os.path.abspath(self._lock_path())),
+                  exist_ok=True)
+      with locking.file_lock(self._lock_path()):
+        merged = {}
+        for key, entry in changes.items():
+          snapshot = self._snapshots.get(key)
+          base = json.loads(snapshot) if snapshot is not None else None
+          stored = self._read(key)
+          theirs = stored[1] if stored is not None else None
+          if entry is None or theirs is None or theirs == base:
+            merged[key] = entry
+          else:
+            merged[key] = _merge(base, entry, theirs)
+        self._write(merged)
+        stamps = {key: self._stamp(key) for key in merged}
+      for key, entry in merged.items():
+        if entry is None:
+          self._stamps.pop(key, None)
+          self._snapshots.pop(key, None)
+          self._deleted.discard(key)
+          self._names.pop(key, None)
+        else:
+          current = self._entries.get(key)
+          if isinstance(current, dict) and isinstance(entry, dict):
+            # Keep the object callers hold, now with the merged fields.
+            if current is not entry:
+              current.clear()
+              current.update(entry)
+          else:
+            self._entries[key] = entry
+          self._snapshots[key] = _dumps(entry)
+          self._stamps[key] = stamps[key]
+      return len(merged)
+
+  def export_json(self, path: str):
+    """Writes the whole map in the single JSON file form."""
+    _write_atomic(path, _dumps(self.to_dict()))
+
+
+class JsonPackageMap(PackageMap):
+  """The package map as one JSON object in one file."""
+
+  def __init__(self, path: str):
+    super().__init__(path)
+    self._file_mtime = None  # type: Optional[int]
+    self._file = {}  # type: Dict[str, Any]
+
+  def _lock_path(self) -> str:
+    return self.path + LOCK_FILE_NAME
+
+  def _stamp(self, key: str) -> Any:
+    try:
+      file_stat = os.stat(self.path)
+    except FileNotFoundError:
+      return None
+    return [file_stat.st_mtime_ns, file_stat.st_size, file_stat.st_ino]
+
+  def _file_entries(self) -> Dict[str, Any]:
+    """Returns the file's entries by canonical key, re-reading on change."""
+    try:
+      mtime = os.stat(self.path).st_mtime_ns
+    except FileNotFoundError:
+      return {}
+    if mtime != self._file_mtime:
+      with open(self.path) as package_map_file:
+        data = json.loads(package_map_file.read())
+      self._file = {resolver.canonical_name(name): (name, entry)
+                    for name, entry in data.items()}
+      self._file_mtime = mtime
+    return self._file
+
+  def _read(self, key: str):
+    stored = self._file_entries().get(key)
+    return copy.deepcopy(stored) if stored is not None else None
+
+  def _list_keys(self) -> Iterator[str]:
+    return iter(self._file_entries())
+
+  def _write(self, changes: Dict[str, Any]):
+    entries = {key: copy.deepcopy(value)
+               for key, value in self._file_entries().items()}
+    for key, entry in changes.items():
+      if entry is None:
+        entries.pop(key, None)
+      else:
+        entries[key] = (self._names[key], entry)
+    _write_atomic(self.path, _dumps(dict(entries.values())))
+    self._file_mtime = None
+
+
+class ShardedPackageMap(PackageMap):
+  """The package map as a directory of per-package JSON files."""
+
+  def _lock_path(self) -> str:
+    return os.path.join(self.path, LOCK_FILE_NAME)
+
+  def _entry_path(self, key: str) -> str:
+    return os.path.join(self.path, key[:2], key + '.json')
+
+  def _stamp(self, key: str) -> Any:
+    try:
+      file_stat = os.stat(self._entry_path(key))
+    except FileNotFoundError:
+      return None
+    return [file_stat.st_mtime_ns, file_stat.st_size, file_stat.st_ino]
+
+  def _read(self, key: str):
+    try:
+      with open(self._entry_path(key)) as entry_file:
+        stored = json.loads(entry_file.read())
+    except FileNotFoundError:
+      return None
+    return stored['name'], stored['info']
+
+  def _list_keys(self) -> Iterator[str]:
+    if not os.path.isdir(self.path):
+      return
+    for shard in sorted(os.listdir(self.path)):
+      shard_dir = os.path.join(self.path, shard)
+      if shard.startswith('.') or not os.path.isdir(shard_dir):
+        continue
+      for file_name in sorted(os.listdir(shard_dir)):
+        if file_name.endswith('.json'):
+          yield file_name[:-len('.json')]
+
+  def _write(self, changes: Dict[str, Any]):
+    for key, entry in changes.items():
+      path = self._entry_path(key)
+      if entry is None:
+        with contextlib.suppress(FileNotFoundError):
+          os.remove(path)
+        continue
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+      _write_atomic(path, _dumps({'name': self._names[key], 'info': entry}))
+
+
+def is_sharded(path: str) -> bool:
+  """Whether path is (or, if missing, should become) a sharded map."""
+  if os.path.exists(path):
+    return os.path.isdir(path)
+  return not path.endswith('.json')
+
+
+def open_package_map(path: str) -> PackageMap:
+  if is_sharded(path):
+    return ShardedPackageMap(path)
+  return JsonPackageMap(path)
+
+
+def convert(src: str, dest: str) -> int:
+  """Copies every entry of the map at src into the map at dest."""
+  source = open_package_map(src)
+  if not is_sharded(dest):
+    source.export_json(dest)
+    return len(source)
+  target = open_package_map(dest)
+  for name in source:
+    target[name] = source[name]
+  return target.save()
+
+
+if __name__ == '__main__':
+  if len(sys.argv) != 4 or sys.argv[1] != 'convert':
+    print('Usage: %s convert SRC DEST' % sys.argv[0])
+    sys.exit(1)
+  print('Converted %d packages' % convert(sys.argv[2], sys.argv[3]))
@@ -0,0 +1,201 @@
+"""Runs items through a sequence of stages with bounded per-stage workers.
+
+Each item moves on to the next stage as soon as its current stage finishes, so
+slow network or subprocess work for one package never holds up the others.
+Output written through `log` and `run_command` is buffered per item and written
+as one block to the run's output when the item's stage completes, so
+concurrent stages don't interleave their lines. Every stage runs inside a tracing span labelled with
+its item, and `run_command` charges its subprocess time to the open span.
+"""
+
+import subprocess
+import sys
+import threading
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Hashable
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Sequence
+
+try:
+  from . import tracing
+except ImportError:
+  import tracing
+
+
+class Stage(NamedTuple):
+  name: str
+  func: Callable[[Any], Any]
+  jobs: int
+
+
+class Result(NamedTuple):
+  item: Any
+  value: Any
+  error: Optional[BaseException]
+  failed_stage: Optional[str]
+
+
+class SingleFlight(object):
+  """Shares one call of a function among concurrent callers of the same key.
+
+  While a call for a key is in flight, other callers with that key wait for
+  it and get its result (or exception) instead of repeating the work.
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._calls = {}  # type: Dict[Hashable, Future]
+
+  def do(self, key: Hashable, func: Callable[[], Any]) -> Any:
+    with self._lock:
+      future = self._calls.get(key)
+      leader = future is None
+      if leader:
+        future = self._calls[key] = Future()
+    if not leader:
+      return future.result()
+    try:
+      value = func()
+    except BaseException as e:
+      future.set_exception(e)
+      raise
+    else:
+      future.set_result(value)
+      return value
+    finally:
+      with self._lock:
+        del self._calls[key]
+
+
+_print_lock = threading.Lock()
+_context = threading.local()
+
+
+def log(message: str):
+  """Prints a message, buffering it if called from inside a pipeline stage."""
+  buffer = getattr(_context, 'buffer', None)
+  if buffer is None:
+    with _print_lock:
+      print(message)
+  else:
+    buffer.append(message)
+
+
+def run_command(cmd: List[str], check: bool = False, **kwargs):
+  """Like `subprocess.run`, but routes the command's output through `log`."""
+  kwargs.setdefault('stderr', subprocess.STDOUT)
+  result = tracing.run_subprocess(
+      cmd, stdout=subprocess.PIPE, universal_newlines=True, **kwargs)
+  for line in result.stdout.splitlines():
+    log(line)
+  if check and result.returncode != 0:
+    raise subprocess.CalledProcessError(result.returncode, cmd, result.stdout)
+  return result
+
+
+def _flush(label: str, buffer: List[str], output: Callable[[str], None]):
+  if not buffer:
+    return
+  with _print_lock:
+    for line in buffer:
+      output('[%s] %s' % (label, line))
+    sys.stdout.flush()
+
+
+def _run_stage(stage: Stage, label: str, value: Any,
+               output: Callable[[str], None]) -> Any:
+  _context.buffer = []
+  try:
+    with tracing.span(stage.name, package=label):
+      return stage.func(value)
+  finally:
+    buffer = _context.buffer
+    _context.buffer = None
+    _flush(label, buffer, output)
+
+
+def parse_jobs(spec: str, stage_names: Sequence[str],
+               defaults: Dict[str, int]) -> Dict[str, int]:
+  """Parses a `--jobs` value into per-stage worker counts.
+
+  The spec is either a single number applied to every stage (e.g. "8") or a
+  comma separated list of stage limits (e.g. "lookup=16,fetch=4").
+  """
+  jobs = dict(defaults)
+  if not spec:
+    return jobs
+  for part in spec.split(','):
+    part = part.strip()
+    if '=' in part:
+      name, count = part.split('=', 1)
+      if name not in stage_names:
+        raise ValueError('Unknown pipeline stage %s' % name)
+      jobs[name] = int(count)
+    else:
+      for name in stage_names:
+        jobs[name] = int(part)
+  for name, count in jobs.items():
+    if count < 1:
+      raise ValueError('Stage %s needs at least one job' % name)
+  return jobs
+
+
+def run(items: Sequence[Any], stages: Sequence[Stage],
+        label: Callable[[Any], str] = str,
+        output: Callable[[str], None] = print) -> List[Result]:
+  """Pushes every item through all stages and returns results in input order.
+
+  An item that raises in some stage is not passed on to later stages; its
+  Result records the exception and the stage that failed. Each item's
+  buffered output lines are passed to output.
+  """
+  results = [None] * len(items)
+  remaining = [len(items)]
+  lock = threading.Lock()
+  all_done = threading.Event()
+  executors = [
+      ThreadPoolExecutor(max_workers=stage.jobs,
+                         thread_name_prefix='pipsource-%s' % stage.name)
+      for stage in stages
+  ]
+
+  def finish(index, result):
+    results[index] = result
+    with lock:
+      remaining[0] -= 1
+      if remaining[0] == 0:
+        all_done.set()
+
+  def submit(index, stage_index, value):
+    if stage_index == len(stages):
+      finish(index, Result(items[index], value, None, None))
+      return
+    stage = stages[stage_index]
+    future = executors[stage_index].submit(
+        _run_stage, stage, label(items[index]), value, output)
+
+    def on_done(f):
+      error = f.exception()
+      if error is not None:
+        finish(index, Result(items[index], None, error, stage.name))
+      else:
+        submit(index, stage_index + 1, f.result())
+
+    future.add_done_callback(on_done)
+
+  try:
+    if not items:
+      return []
+    for index, item in enumerate(items):
+      submit(index, 0, item)
+    all_done.wait()
+  finally:
+    for executor in executors:
+      executor.shutdown(wait=True)
+  return results
@@ -0,0 +1,236 @@
+"""Reads installed packages and their dependency depths from `pipenv graph`.
+
+Two forms of the graph are accepted:
+
+- The text of `pipenv graph --reverse --bare`, where every package is listed
+  at the top level with the packages that require it nested under it. Shared
+  subtrees are repeated for every path to them, so on big projects the text
+  is large. It is read a line at a time and only the deepest indent seen per
+  package is kept.
+- The JSON of `pipenv graph --json` (each package once, with its direct
+  dependencies) or `--json-tree` (nested). Top-level items are decoded one at
+  a time and only the dependency edges are kept.
+
+Either way a package's depth is the length of its longest chain of
+dependencies, so a package comes after everything it depends on when sorted
+by depth. For the JSON forms the depths are computed in one pass over the
+edges, memoizing each package's depth.
+"""
+
+import itertools
+import json
+import logging
+import re
+import subprocess
+from typing import Dict
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import NamedTuple
+from typing import Set
+from typing import Tuple
+
+# "  - requests==2.23.0 [requires: certifi>=2017.4.17]"
+_LINE_RE = re.compile(
+    r'^(?P<indent>\s*)(?:-\s*)?(?P<name>[A-Za-z0-9][A-Za-z0-9._-]*)'
+    r'==(?P<version>[^\s\[\]]+)')
+
+_INDENT_WIDTH = 2
+
+_READ_SIZE = 64 * 1024
+
+GRAPH_COMMAND = ['pipenv', 'graph', '--json']
+
+TEXT_GRAPH_COMMAND = ['pipenv', 'graph', '--reverse', '--bare']
+
+
+class Node(NamedTuple):
+  version: str
+  # Longest chain of dependencies below the package.
+  depth: int
+
+
+def parse_text(lines: Iterable[str]) -> Dict[str, Node]:
+  """Parses `pipenv graph --reverse --bare` output, a line at a time.
+
+  Lines that aren't a `name==version` entry (e.g. warnings pipenv prints) are
+  logged and skipped.
+  """
+  nodes = {}  # type: Dict[str, Node]
+  for number, line in enumerate(lines, 1):
+    if not line.strip():
+      continue
+    match = _LINE_RE.match(line.expandtabs(_INDENT_WIDTH))
+    if not match:
+      logging.warning('Skipping unrecognized graph line %d: %s', number,
+                      line.rstrip())
+      continue
+    package = match.group('name')
+    depth = len(match.group('indent')) // _INDENT_WIDTH
+    node = nodes.get(package)
+    if node is None or depth > node.depth:
+      nodes[package] = Node(match.group('version'), depth)
+  return nodes
+
+
+def _json_items(chunks: Iterable[str]) -> Iterator[object]:
+  """Decodes the items of a JSON array as its text arrives in chunks."""
+  decoder = json.JSONDecoder()
+  buffer = ''
+  position = 0
+  started = False
+  # After a partial item fails to decode, wait until twice as much text is
+  # buffered before trying again, so a huge item is decoded in linear time.
+  retry_at = 0
+  # None marks the end of the text, when whatever is buffered is decoded.
+  for chunk in itertools.chain(chunks, [None]):
+    buffer = buffer[position:] + (chunk or '')
+    position = 0
+    if chunk is None:
+      retry_at = 0
+    while True:
+      while position < len(buffer) and buffer[position] in ' \t\r\n,':
+        position += 1
+      if position == len(buffer):
+        break
+      if not started:
+        if buffer[position] != '[':
+          raise ValueError('Expected a JSON array')
+        started = True
+        position += 1
+        continue
+      if buffer[position] == ']':
+        return
+      if len(buffer) - position < retry_at:
+        break
+      try:
+        item, end = decoder.raw_decode(buffer, position)
+      except ValueError:
+        # The item continues in the next chunk.
+        retry_at = 2 * (len(buffer) - position)
+        break
+      position = end
+      retry_at = 0
+      yield item
+  if not started or buffer[position:].strip():
+    raise ValueError('Truncated or malformed JSON graph')
+
+
+def _name_and_version(entry: Dict) -> Tuple[str, str]:
+  name = entry.get('package_name') or entry.get('key')
+  if not name:
+    raise ValueError('Graph entry without a package name: %r' % entry)
+  return name, entry.get('installed_version') or ''
+
+
+def _add_edges(item: Dict, versions: Dict[str, str],
+               edges: Dict[str, Set[str]]):
+  """Adds one item of the flat (`--json`) or nested (`--json-tree`) form."""
+  stack = [item]
+  while stack:
+    entry = stack.pop()
+    package_entry = entry.get('package', entry)
+    package, version = _name_and_version(package_entry)
+    versions.setdefault(package, version)
+    deps = edges.setdefault(package, set())
+    for dep_entry in entry.get('dependencies') or []:
+      dep, dep_version = _name_and_version(dep_entry)
+      versions.setdefault(dep, dep_version)
+      deps.add(dep)
+      # A subtree repeated in the nested form only needs walking once.
+      if dep_entry.get('dependencies') and dep not in edges:
+        stack.append(dep_entry)
+      else:
+        edges.setdefault(dep, set())
+
+
+def _depths(edges: Dict[str, Set[str]]) -> Dict[str, int]:
+  """Memoized longest dependency chain of each package; cycles are cut."""
+  depths = {}  # type: Dict[str, int]
+  visiting = set()  # type: Set[str]
+  for root in sorted(edges):
+    # Iterative depth-first search, as graphs can be deeper than the
+    # recursion limit.
+    stack = [(root, iter(sorted(edges.get(root, ()))))]
+    visiting.add(root)
+    while stack:
+      package, deps = stack[-1]
+      dep = next(deps, None)
+      if dep is None:
+        stack.pop()
+        visiting.discard(package)
+        depths[package] = max(
+            [depths[d] + 1 for d in edges.get(package, ())
+             if d in depths] or [0])
+      elif dep not in depths and dep not in visiting:
+        visiting.add(dep)
+        stack.append((dep, iter(sorted(edges.get(dep, ())))))
+  return depths
+
+
+def parse_json(chunks: Iterable[str]) -> Dict[str, Node]:
+  """Parses `pipenv graph --json` or `--json-tree` output."""
+  versions = {}  # type: Dict[str, str]
+  edges = {}  # type: Dict[str, Set[str]]
+  for item in _json_items(chunks):
+    if not isinstance(item, dict):
+      raise ValueError('Unexpected JSON graph item: %r' % (item,))
+    _add_edges(item, versions, edges)
+  return {package: Node(versions[package], depth)
+          for package, depth in _depths(edges).items()}
+
+
+def _chunks(stream) -> Iterator[str]:
+  while True:
+    chunk = stream.read(_READ_SIZE)
+    if not chunk:
+      return
+    yield chunk
+
+
+def _chain(first: str, chunks: Iterator[str]) -> Iterator[str]:
+  yield first
+  yield from chunks
+
+
+def _lines(first: str, stream) -> Iterator[str]:
+  rest = stream.readline()
+  if first or rest:
+    yield first + rest
+  yield from stream
+
+
+def parse(stream) -> Dict[str, Node]:
+  """Parses either form of the graph from a text stream."""
+  first = stream.read(1)
+  while first and first.isspace():
+    first = stream.read(1)
+  if first == '[':
+    return parse_json(_chain(first, _chunks(stream)))
+  return parse_text(_lines(first, stream))
+
+
+def _run(command: List[str], pipenv_dir: str) -> Dict[str, Node]:
+  process = subprocess.Popen(command, cwd=pipenv_dir, stdout=subprocess.PIPE,
+                             universal_newlines=True)
+  try:
+    nodes = parse(process.stdout)
+  finally:
+    process.stdout.close()
+    returncode = process.wait()
+  if returncode:
+    raise subprocess.CalledProcessError(returncode, command)
+  return nodes
+
+
+def read_pipenv_graph(pipenv_dir: str) -> Dict[str, Node]:
+  """Streams the project's graph out of pipenv.
+
+  Uses the compact JSON form, or the text form for pipenv versions that
+  can't print JSON.
+  """
+  try:
+    return _run(GRAPH_COMMAND, pipenv_dir)
+  except (subprocess.CalledProcessError, ValueError) as e:
+    logging.info('Falling back to the text graph: %s', e)
+    return _run(TEXT_GRAPH_COMMAND, pipenv_dir)
@@ -11,22 +11,114 @@ from typing import Dict
 from typing import List
 from typing import NamedTuple
 from typing import Optional
+from typing import Set
+from typing import Tuple
 import urllib.request
-import config
 
-import pypi_util
-import requirements
+try:
+  from . import archive
+  from . import config
+  from . import installer
+  from . import integrity
+  from . import mirror_cache
+  from . import pypi_util
+  from . import requirements
+  from . import resolver
+  from . import vendor_gc
+  from . import wheel_cache
+except ImportError:
+  import archive
+  import config
+  import installer
+  import integrity
+  import mirror_cache
+  import pypi_util
+  import requirements
+  import resolver
+  import vendor_gc
+  import wheel_cache
+
+_common_args = argparse.ArgumentParser(add_help=False)
+_common_args.add_argument('--config', type=str,
+                          default='~/.pipsource/config.json',
+                          help='The JSON config file with package source info')
+_common_args.add_argument('--vendor-path', type=str,
+                          default='~/.pipsource/vendor/',
+                          help='The folder for vendored package sources')
 
 parser = argparse.ArgumentParser(
     description='Vendor and install pip packages from source.')
-parser.add_argument('command', type=str,
-                    help="Command to run, either 'vendor' or 'install'")
-parser.add_argument('requirements_file', type=str,
-                    help='The requirements.txt like file to vendor/install')
-parser.add_argument('--config', type=str, default='~/.pipsource/config.json',
-                    help='The JSON config file with package source info')
-parser.add_argument('--vendor-path', type=str, default='~/.pipsource/vendor/',
-                    help='The folder for vendored package sources')
+_commands = parser.add_subparsers(dest='command', metavar='command')
+_commands.required = True
+for _command, _help in (('vendor', 'Vendor the sources of requirements'),
+                        ('install', 'Install vendored requirements')):
+  _command_parser = _commands.add_parser(
+      _command, parents=[_common_args], help=_help)
+  _command_parser.add_argument(
+      'requirements_file', type=str,
+      help='The requirements.txt like file to vendor/install')
+  if _command == 'install':
+    _command_parser.add_argument(
+        '--venv', type=str, default='.venv-vendored',
+        help='The venv to install into, created if it does not exist')
+    _command_parser.add_argument(
+        '--python', type=str, default='python',
+        help='The interpreter to create the venv with')
+    _command_parser.add_argument(
+        '--wheel-cache', type=str, default=wheel_cache.DEFAULT_CACHE_DIR,
+        help='Directory built wheels are cached in')
+    _command_parser.add_argument(
+        '--jobs', type=int, default=installer.DEFAULT_JOBS,
+        help='Packages of one dependency level to build at once')
+_gc_parser = _commands.add_parser(
+    'gc', parents=[_common_args],
+    help='Remove vendored packages that no root refers to')
+_gc_parser.add_argument(
+    'roots', type=str, nargs='+',
+    help='Install scripts, lockfiles (Pipfile.lock, requirements.txt) and '
+    'package maps whose packages are in use')
+_gc_parser.add_argument('--dry-run', action='store_true',
+                        help='Only report what would be removed')
+_gc_parser.add_argument('--free', type=str, default='',
+                        help='Only remove enough unused packages, oldest '
+                        'used first, to free this much, e.g. "5G"')
+_gc_parser.add_argument('--jobs', type=int,
+                        default=vendor_gc.DEFAULT_PURGE_JOBS,
+                        help='Concurrent workers for scanning and deleting')
+_gc_parser.add_argument('--foreground', action='store_true',
+                        help='Wait for deleted packages to be purged')
+_gc_parser.add_argument('--store', type=str, default='~/.pipsource/store',
+                        help='The content store vendored files link to, whose '
+                        'refs, trees and objects only removed packages use '
+                        'are removed too; empty to leave it alone')
+_pack_parser = _commands.add_parser(
+    'pack', parents=[_common_args],
+    help='Pack the vendored sources into one indexed archive')
+_pack_parser.add_argument('archive', type=str, help='The archive to write')
+_pack_parser.add_argument('packages', type=str, nargs='*',
+                          help='Packages to pack (default all)')
+_unpack_parser = _commands.add_parser(
+    'unpack', parents=[_common_args],
+    help='Restore vendored sources from a packed archive')
+_unpack_parser.add_argument('archive', type=str, help='The archive to read')
+_unpack_parser.add_argument(
+    'install_scripts', type=str, nargs='*',
+    help='Only restore the packages these install scripts install '
+    '(default all)')
+_verify_parser = _commands.add_parser(
+    'verify', parents=[_common_args],
+    help='Check vendored sources against their recorded file hashes')
+_verify_parser.add_argument('packages', type=str, nargs='*',
+                            help='Packages to check (default all)')
+_verify_parser.add_argument('--jobs', type=int, default=integrity.DEFAULT_JOBS,
+                            help='Processes to hash changed files with')
+_verify_parser.add_argument('--stat-cache', type=str,
+                            default=integrity.DEFAULT_STAT_CACHE_FILE,
+                            help='Cache of verified file hashes by stat, so '
+                            'unchanged files are not hashed again')
+_verify_parser.add_argument('--store', type=str, default='~/.pipsource/store',
+                            help='The content store to check each record '
+                            'against the ref of; empty to skip that check')
 
 logging.getLogger().setLevel(logging.INFO)
 
@@ -40,7 +132,8 @@ def _get_config(req: requirements.Requirement) -> config.Package:
       hg_path=None,
       vendored_version=req.version,
       install_requires=[],
-      version_commits=None)
+      version_commits=None,
+      version_tag_format=config.DEFAULT_VERSION_TAG_FORMAT)
 
 
 def _vendor_git_package(package, version, label, git_url):
@@ -84,27 +177,137 @@ def _vendor_git_package(package, version, label, git_url):
   # to check the revision it's at.
   subprocess.run(['mv', git_dir, git_moved_dir], stderr=subprocess.DEVNULL)
 
+def _dependency_graph(
+    reqs: List[requirements.Requirement],
+    configs: Dict[str, config.Package],
+    vendor_path: str) -> Dict[str, Set[str]]:
+  """Maps each requirement's package to the packages it depends on.
+
+  Dependencies come from the vendored sources under vendor_path when present
+  and from each package config's install_requires.
+  """
+  package_dirs = {
+      r.package: os.path.join(vendor_path, r.package) for r in reqs
+  }
+  extra_requires = {
+      name: package_config.install_requires
+      for name, package_config in configs.items()
+  }
+  return resolver.Resolver().graph(
+      [r.package for r in reqs], package_dirs, extra_requires=extra_requires)
+
+
+def _resolve_levels(
+    reqs: List[requirements.Requirement],
+    configs: Dict[str, config.Package],
+    vendor_path: str) -> List[List[Tuple[str, str]]]:
+  """Groups requirements into dependency levels for installing."""
+  versions = {r.package: r.version for r in reqs}
+  graph = _dependency_graph(reqs, configs, vendor_path)
+  return [[(p, versions[p]) for p in level]
+          for level in resolver.levels(graph)]
+
+
 def _run_vendor(
-    requirements: List[requirements.Requirement],
-    configs: Dict[str, config.Package]):
+    reqs: List[requirements.Requirement],
+    configs: Dict[str, config.Package],
+    vendor_path: str):
   logging.info('configs: %s', configs)
-  for r in requirements:
+  for r in reqs:
     if r.package not in configs:
-      config = _get_config(r)
-      print('got config:')
-      print(config)
-    print(r)
+      configs[r.package] = _get_config(r)
+      logging.info('got config: %s', configs[r.package])
+  for index, level in enumerate(_resolve_levels(reqs, configs, vendor_path)):
+    print('Level %d: %s' % (
+        index, ', '.join('%s==%s' % package for package in level)))
+
+
+def _run_install(
+    reqs: List[requirements.Requirement],
+    configs: Dict[str, config.Package],
+    vendor_path: str,
+    args):
+  venv_dir = os.path.abspath(os.path.expanduser(args.venv))
+  installer.ensure_venv(venv_dir, args.python)
+  package_installer = installer.Installer(
+      vendor_path, venv_dir, os.path.expanduser(args.wheel_cache), args.jobs)
+  outcomes = package_installer.install(
+      [(r.package, r.version) for r in reqs],
+      _dependency_graph(reqs, configs, vendor_path))
+  installer.print_summary(outcomes)
+  if any(o.status in ('failed', 'skipped') for o in outcomes):
+    sys.exit(1)
+
+
+def _run_gc(args):
+  free_bytes = None
+  if args.free:
+    try:
+      free_bytes = mirror_cache.parse_size(args.free)
+    except ValueError as e:
+      parser.error(str(e))
+  try:
+    vendor_gc.collect(
+        os.path.expanduser(args.vendor_path),
+        [os.path.expanduser(root) for root in args.roots],
+        dry_run=args.dry_run, free_bytes=free_bytes, jobs=args.jobs,
+        background=not args.foreground,
+        store_dir=os.path.expanduser(args.store) if args.store else None)
+  except ValueError as e:
+    parser.error(str(e))
+
+
+def _run_pack(args):
+  vendor_path = os.path.expanduser(args.vendor_path)
+  archive_path = os.path.expanduser(args.archive)
+  if args.command == 'pack':
+    count = archive.pack(vendor_path, archive_path, args.packages or None)
+    print('Packed %d packages into %s' % (count, archive_path))
+    return
+  if args.install_scripts:
+    unpacked = archive.unpack_for_scripts(
+        archive_path, vendor_path,
+        [os.path.expanduser(script) for script in args.install_scripts])
+  else:
+    unpacked = archive.unpack(archive_path, vendor_path)
+  print('Unpacked %d packages into %s' % (len(unpacked), vendor_path))
+
+
+def _run_verify(args):
+  drift = integrity.verify(
+      os.path.expanduser(args.vendor_path), args.packages or None,
+      os.path.expanduser(args.stat_cache), args.jobs,
+      store_dir=os.path.expanduser(args.store))
+  for item in drift:
+    print('%s: %s' % (os.path.join(item.package, item.path), item.problem))
+  if drift:
+    print('%d problems found' % len(drift))
+    sys.exit(1)
+  print('All vendored packages match their recorded hashes')
 
 
 def main():
   """Runs the pipsource command utility."""
   args = parser.parse_args()
 
-  reqs = requirements.parse(os.path.expanduser(args.requirements_file))
+  if args.command == 'gc':
+    _run_gc(args)
+    return
+  if args.command == 'verify':
+    _run_verify(args)
+    return
+  if args.command in ('pack', 'unpack'):
+    _run_pack(args)
+    return
+
+  reqs = [r for r in requirements.parse(
+      os.path.expanduser(args.requirements_file)) if requirements.applies(r)]
   configs = config.parse(os.path.expanduser(args.config))
 
   if args.command == 'vendor':
-    _run_vendor(reqs, configs)
+    _run_vendor(reqs, configs, os.path.expanduser(args.vendor_path))
+  elif args.command == 'install':
+    _run_install(reqs, configs, os.path.expanduser(args.vendor_path), args)
 
 if __name__ == "__main__":
   main()
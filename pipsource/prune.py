@@ -0,0 +1,286 @@
+"""Pruning of vendored source trees down to what building them needs.
+
+A freshly checked out package keeps the whole repo: tests, docs, benchmarks,
+CI configs and their fixtures, none of which `pip wheel` needs. Before a tree
+is imported into the content store, the paths matching the package's prune
+rules are removed from it, so they never reach the vendor dir.
+
+Rules are glob patterns matched against paths relative to the package dir.
+`*` and `?` don't match `/`, a `**/` matches any number of directories, and a
+pattern ending in `/` matches a directory and everything in it. The default
+excludes only remove top level test, doc, benchmark and example dirs, CI
+configs and bytecode. A default exclude is kept if setup.py, setup.cfg or
+pyproject.toml refers to a path in it. The package map can add rules:
+
+  "prune": {"exclude": ["data/fixtures/"], "include": ["tests/"]}
+
+Includes win over excludes, and `"prune": false` keeps the whole tree.
+
+The checkout's `.git` dir is kept out of the tree too, in a cache dir, from
+where it is moved back when the checkout needs updating.
+"""
+
+import hashlib
+import json
+import os
+import re
+import shutil
+from typing import Dict
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Pattern
+from typing import Sequence
+from typing import Tuple
+
+try:
+  from . import content_store
+except ImportError:
+  import content_store
+
+DEFAULT_EXCLUDES = (
+    # Tests, docs and other trees pip doesn't build from.
+    'tests/', 'test/', 'testing/', 'docs/', 'doc/', 'benchmarks/', 'bench/',
+    'examples/', 'example/',
+    # CI and developer tool configs.
+    '.github/', '.circleci/', '.azure-pipelines/', '.travis.yml',
+    'appveyor.yml', '.appveyor.yml', 'azure-pipelines.yml', '.gitlab-ci.yml',
+    '.cirrus.yml', '.pre-commit-config.yaml', 'tox.ini', 'noxfile.py',
+    # Bytecode left by tools run in the checkout.
+    '**/__pycache__/', '**/*.pyc',
+)
+
+DEFAULT_GIT_DIR_CACHE = os.path.expanduser('~/.pipsource/git-dirs')
+
+# Bumped when the same rules would prune differently, so that trees pruned
+# the old way are vendored again.
+_RULES_VERSION = 1
+
+_BUILD_FILES = ('setup.py', 'setup.cfg', 'pyproject.toml')
+
+_LEGACY_GIT_DIR_NAME = '.git-moved'
+
+
+class Rules(NamedTuple):
+  # Excludes on top of DEFAULT_EXCLUDES.
+  excludes: Tuple[str, ...]
+  includes: Tuple[str, ...]
+
+
+class PruneStats(NamedTuple):
+  files: int
+  bytes: int
+
+
+class _Glob(NamedTuple):
+  regex: Pattern
+  dir_only: bool
+  pattern: str
+
+
+def rules_for(package_info: Dict) -> Optional[Rules]:
+  """Returns the package map entry's prune rules, or None to not prune."""
+  config = package_info.get('prune', True)
+  if config is False:
+    return None
+  if config is True:
+    config = {}
+  if (not isinstance(config, dict) or set(config) - {'exclude', 'include'} or
+      not all(isinstance(config.get(key, []), list)
+              for key in ('exclude', 'include'))):
+    raise ValueError('"prune" must be false or an object with "exclude" '
+                     'and/or "include" lists')
+  rules = Rules(excludes=tuple(config.get('exclude', [])),
+                includes=tuple(config.get('include', [])))
+  for pattern in rules.excludes + rules.includes:
+    _compile(pattern)
+  return rules
+
+
+def label_with_rules(label: Sequence[str],
+                     rules: Optional[Rules]) -> List[str]:
+  """Returns the label trees are recorded under once pruned with rules.
+
+  The vendor manifest and content store compare labels, so changing the
+  rules vendors the package again.
+  """
+  if rules is None:
+    return list(label)
+  rules_json = json.dumps(
+      [_RULES_VERSION, DEFAULT_EXCLUDES, rules.excludes, rules.includes])
+  return list(label) + [
+      'prune:%s' % hashlib.sha1(rules_json.encode()).hexdigest()[:12]]
+
+
+def _compile(pattern: str) -> _Glob:
+  dir_only = pattern.endswith('/')
+  parts = pattern.strip('/').split('/')
+  if parts[-1] == '**':
+    parts.pop()
+    dir_only = True
+  if not parts or not all(parts):
+    raise ValueError('Invalid prune pattern %r' % pattern)
+  regex = ''
+  for part in parts:
+    if part == '**':
+      regex += '(?:[^/]+/)*'
+      continue
+    for char in part:
+      if char == '*':
+        regex += '[^/]*'
+      elif char == '?':
+        regex += '[^/]'
+      else:
+        regex += re.escape(char)
+    regex += '/'
+  return _Glob(re.compile(regex[:-1] + r'\Z'), dir_only, pattern)
+
+
+def _matches(globs: List[_Glob], rel_path: str, is_dir: bool) -> bool:
+  """Whether a glob matches the path or one of the dirs containing it."""
+  parts = rel_path.split('/')
+  for index in range(len(parts), 0, -1):
+    path = '/'.join(parts[:index])
+    path_is_dir = is_dir or index < len(parts)
+    for glob in globs:
+      if (path_is_dir or not glob.dir_only) and glob.regex.match(path):
+        return True
+  return False
+
+
+def _may_include_below(globs: List[_Glob], rel_dir: str) -> bool:
+  """Whether an include glob could match something inside rel_dir."""
+  for glob in globs:
+    prefix = glob.pattern.split('*', 1)[0].split('?', 1)[0]
+    if (glob.pattern.startswith('**') or rel_dir.startswith(prefix) or
+        prefix.startswith(rel_dir + '/')):
+      return True
+  return False
+
+
+def _referenced_by_build(package_dir: str) -> List[str]:
+  """Returns the top level names the build files refer to as paths.
+
+  Covers "name/..." path strings and os.path.join(..., "name", ...) calls.
+  """
+  text = ''
+  for name in _BUILD_FILES:
+    try:
+      with open(os.path.join(package_dir, name), errors='replace') as f:
+        text += f.read()
+    except OSError:
+      pass
+  names = set(re.findall(r'''(?<![\w./-])['"]?([\w.-]+)/''', text))
+  for args in re.findall(r'path\.join\(([^)]*)\)', text):
+    names.update(re.findall(r'''['"]([\w.-]+)['"]''', args))
+  return sorted(names)
+
+
+def _exclude_globs(package_dir: str, rules: Rules) -> List[_Glob]:
+  referenced = set(_referenced_by_build(package_dir))
+  defaults = [pattern for pattern in DEFAULT_EXCLUDES
+              if pattern.strip('/') not in referenced]
+  return [_compile(pattern) for pattern in defaults + list(rules.excludes)]
+
+
+def _remove(path: str) -> PruneStats:
+  if os.path.isdir(path) and not os.path.islink(path):
+    files = 0
+    size = 0
+    for root, _, names in os.walk(path):
+      for name in names:
+        files += 1
+        size += os.lstat(os.path.join(root, name)).st_size
+    shutil.rmtree(path)
+    return PruneStats(files, size)
+  size = os.lstat(path).st_size
+  os.remove(path)
+  return PruneStats(1, size)
+
+
+def prune(package_dir: str, rules: Rules,
+          skip: Sequence[str] = content_store.DEFAULT_EXCLUDES) -> PruneStats:
+  """Removes what rules exclude from package_dir; returns what was removed.
+
+  Top level dirs in skip (VCS metadata) are left alone.
+  """
+  excludes = _exclude_globs(package_dir, rules)
+  includes = [_compile(pattern) for pattern in rules.includes]
+  files = 0
+  size = 0
+  for root, dirs, names in os.walk(package_dir):
+    rel_root = os.path.relpath(root, package_dir)
+    rel_root = '' if rel_root == '.' else rel_root + '/'
+    if not rel_root:
+      dirs[:] = [d for d in dirs if d not in skip]
+    kept_dirs = []
+    for name in sorted(dirs):
+      rel_path = rel_root + name
+      path = os.path.join(root, name)
+      is_dir = not os.path.islink(path)
+      if (not _matches(excludes, rel_path, is_dir) or
+          _matches(includes, rel_path, is_dir)):
+        kept_dirs.append(name)
+      elif is_dir and _may_include_below(includes, rel_path):
+        # Prune what's inside it file by file.
+        kept_dirs.append(name)
+      else:
+        removed = _remove(path)
+        files += removed.files
+        size += removed.bytes
+    dirs[:] = kept_dirs
+    for name in names:
+      rel_path = rel_root + name
+      if (_matches(excludes, rel_path, False) and
+          not _matches(includes, rel_path, False)):
+        removed = _remove(os.path.join(root, name))
+        files += removed.files
+        size += removed.bytes
+  # Remove dirs emptied by pruning inside them.
+  for root, dirs, names in os.walk(package_dir, topdown=False):
+    rel_root = os.path.relpath(root, package_dir)
+    if (rel_root != '.' and not os.listdir(root) and
+        _matches(excludes, rel_root, True)):
+      os.rmdir(root)
+  return PruneStats(files, size)
+
+
+def git_dir_path(cache_dir: str, package_dir: str) -> str:
+  """Returns where the package dir's .git is kept while out of the tree."""
+  package_dir = os.path.abspath(package_dir)
+  digest = hashlib.sha1(package_dir.encode()).hexdigest()[:16]
+  return os.path.join(cache_dir,
+                      '%s-%s' % (os.path.basename(package_dir), digest))
+
+
+def stash_git_dir(package_dir: str, cache_dir: str):
+  """Moves the package dir's .git, if any, out of the tree into cache_dir."""
+  git_dir = os.path.join(package_dir, '.git')
+  if not os.path.isdir(git_dir):
+    return
+  cached = git_dir_path(cache_dir, package_dir)
+  os.makedirs(cache_dir, exist_ok=True)
+  shutil.rmtree(cached, ignore_errors=True)
+  shutil.move(git_dir, cached)
+
+
+def restore_git_dir(package_dir: str, cache_dir: str) -> bool:
+  """Moves the stashed .git back into the package dir.
+
+  A .git-moved dir left in the tree by older versions is used instead if
+  there is one. Returns whether the package dir now has a .git.
+  """
+  git_dir = os.path.join(package_dir, '.git')
+  legacy_dir = os.path.join(package_dir, _LEGACY_GIT_DIR_NAME)
+  cached = git_dir_path(cache_dir, package_dir)
+  if os.path.isdir(legacy_dir) and not os.path.exists(git_dir):
+    os.rename(legacy_dir, git_dir)
+    shutil.rmtree(cached, ignore_errors=True)
+  elif os.path.isdir(cached) and not os.path.exists(git_dir):
+    shutil.move(cached, git_dir)
+  return os.path.isdir(git_dir)
+
+
+def discard_git_dir(package_dir: str, cache_dir: str):
+  """Forgets the stashed .git, e.g. when the tree is replaced without git."""
+  shutil.rmtree(git_dir_path(cache_dir, package_dir), ignore_errors=True)
@@ -1,23 +1,215 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+from typing import Dict
+from typing import Iterable
 from typing import Optional
+import hashlib
+import http.client
 import json
+import os
 import re
+import threading
+import time
 import urllib
+import urllib.error
+import urllib.request
+import urllib.response
 
+try:
+  from . import tracing
+except ImportError:
+  import tracing
 
-def get_git_url(package: str) -> Optional[str]:
-  """Retrieves GitHub page if specified for given PyPi package via PyPi API."""
-  # TODO: make sure this verifies HTTPS certs
-  data = urllib.request.urlopen(
-      'https://pypi.python.org/pypi/%s/json' % package).read()
-  data_parsed = json.loads(data)
-  info = data_parsed['info']
-  home_page = info.get('home_page')
+DEFAULT_INDEX_URL = 'https://pypi.org/pypi'
+
+DEFAULT_CACHE_DIR = os.path.expanduser('~/.pipsource/pypi')
+
+DEFAULT_TTL_SECONDS = 24 * 60 * 60
+
+DEFAULT_MAX_WORKERS = 8
+
+
+class _KeepAliveMixin(object):
+  """Reuses one HTTP connection per host and thread instead of one per call."""
+
+  def _keep_alive_open(self, connection_class, req):
+    connections = self._local.__dict__.setdefault('connections', {})
+    host = req.host
+    for attempt in range(2):
+      conn = connections.get(host)
+      if conn is None:
+        conn = connection_class(host, timeout=req.timeout)
+        connections[host] = conn
+      headers = dict(req.header_items())
+      headers['Connection'] = 'keep-alive'
+      try:
+        conn.request(req.get_method(), req.selector, req.data, headers)
+        resp = conn.getresponse()
+      except (http.client.HTTPException, OSError):
+        # The server may have closed an idle connection; retry once on a new
+        # one before giving up.
+        conn.close()
+        del connections[host]
+        if attempt:
+          raise
+        continue
+      # Read the body now so the connection is free for the next request.
+      body = resp.read()
+      addinfo = urllib.response.addinfourl(
+          _BytesReader(body), resp.msg, req.get_full_url(), resp.status)
+      addinfo.msg = resp.reason
+      return addinfo
+
+
+class _BytesReader(object):
+
+  def __init__(self, data: bytes):
+    self._data = data
+
+  def read(self, *args):
+    data, self._data = self._data, b''
+    return data
+
+  def close(self):
+    pass
+
+
+class KeepAliveHTTPHandler(_KeepAliveMixin, urllib.request.HTTPHandler):
+
+  def __init__(self):
+    super().__init__()
+    self._local = threading.local()
+
+  def http_open(self, req):
+    return self._keep_alive_open(http.client.HTTPConnection, req)
+
+
+class KeepAliveHTTPSHandler(_KeepAliveMixin, urllib.request.HTTPSHandler):
+
+  def __init__(self):
+    super().__init__()
+    self._local = threading.local()
+
+  def https_open(self, req):
+    return self._keep_alive_open(http.client.HTTPSConnection, req)
+
+
+def git_url_from_info(info: Dict[str, Any]) -> Optional[str]:
+  """Finds a GitHub URL in the "info" section of PyPI package metadata."""
+  home_page = info.get('home_page') or ''
   if home_page.startswith('http://github.com'):
     home_page = home_page.replace('http://github.com', 'https://github.com')
   if re.match('^https://github.com/', home_page):
     return home_page
-  description = info.get('description')
-  match = re.search('github.com\/[^\/]+/[a-zA-Z-_]+', description)
+  description = info.get('description') or ''
+  match = re.search(r'github.com\/[^\/]+/[a-zA-Z-_]+', description)
   if match:
     return 'https://%s' % match.group(0)
   return None
+
+
+class PypiClient(object):
+  """Fetches PyPI JSON metadata through an on-disk cache.
+
+  Cached entries younger than ttl are used without any request. Older entries
+  are revalidated with If-None-Match, so unchanged metadata costs only a 304.
+  Requests go through `opener`, which by default keeps connections alive.
+  """
+
+  def __init__(self,
+               index_url: str = DEFAULT_INDEX_URL,
+               cache_dir: Optional[str] = DEFAULT_CACHE_DIR,
+               ttl: float = DEFAULT_TTL_SECONDS,
+               max_workers: int = DEFAULT_MAX_WORKERS,
+               opener: Optional[urllib.request.OpenerDirector] = None):
+    self.index_url = index_url.rstrip('/')
+    self.cache_dir = cache_dir
+    self.ttl = ttl
+    self.max_workers = max_workers
+    self.opener = opener or urllib.request.build_opener(
+        KeepAliveHTTPHandler, KeepAliveHTTPSHandler)
+    # Entries read or written by this client, so a long-running process
+    # doesn't re-read the disk cache.
+    self._memory_cache = {}  # type: Dict[str, Dict[str, Any]]
+
+  def _cache_path(self, package: str) -> str:
+    name = hashlib.sha1(package.lower().encode()).hexdigest()
+    return os.path.join(self.cache_dir, '%s.json' % name)
+
+  def _read_cache(self, package: str) -> Optional[Dict[str, Any]]:
+    entry = self._memory_cache.get(package.lower())
+    if entry is not None or not self.cache_dir:
+      return entry
+    try:
+      with open(self._cache_path(package)) as cache_file:
+        entry = json.loads(cache_file.read())
+    except (OSError, ValueError):
+      return None
+    self._memory_cache[package.lower()] = entry
+    return entry
+
+  def _write_cache(self, package: str, entry: Dict[str, Any]):
+    self._memory_cache[package.lower()] = entry
+    if not self.cache_dir:
+      return
+    os.makedirs(self.cache_dir, exist_ok=True)
+    path = self._cache_path(package)
+    tmp_path = '%s.tmp.%d.%d' % (path, os.getpid(), threading.get_ident())
+    with open(tmp_path, 'w') as cache_file:
+      json.dump(entry, cache_file)
+    os.replace(tmp_path, path)
+
+  def get_metadata(self, package: str) -> Dict[str, Any]:
+    """Returns the parsed PyPI JSON document for package."""
+    cached = self._read_cache(package)
+    if cached and time.time() - cached['fetched'] < self.ttl:
+      return cached['data']
+
+    req = urllib.request.Request('%s/%s/json' % (self.index_url, package))
+    if cached and cached.get('etag'):
+      req.add_header('If-None-Match', cached['etag'])
+    with tracing.span('pypi-request'):
+      try:
+        resp = self.opener.open(req)
+      except urllib.error.HTTPError as e:
+        if e.code != 304 or not cached:
+          raise
+        cached['fetched'] = time.time()
+        self._write_cache(package, cached)
+        return cached['data']
+      data = json.loads(resp.read())
+    self._write_cache(package, {
+        'fetched': time.time(),
+        'etag': resp.headers.get('ETag') if resp.headers else None,
+        'data': data,
+    })
+    return data
+
+  def get_git_url(self, package: str) -> Optional[str]:
+    return git_url_from_info(self.get_metadata(package)['info'])
+
+  def get_git_urls(self, packages: Iterable[str]) -> Dict[str, Optional[str]]:
+    """Looks up git URLs for many packages at once, max_workers at a time."""
+    packages = list(packages)
+    with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+      urls = executor.map(self.get_git_url, packages)
+      return dict(zip(packages, urls))
+
+
+_default_client = None
+_default_client_lock = threading.Lock()
+
+
+def default_client() -> PypiClient:
+  """Returns a process-wide client so connections and cache are shared."""
+  global _default_client
+  with _default_client_lock:
+    if _default_client is None:
+      _default_client = PypiClient()
+    return _default_client
+
+
+def get_git_url(package: str,
+                client: Optional[PypiClient] = None) -> Optional[str]:
+  """Retrieves GitHub page if specified for given PyPi package via PyPi API."""
+  return (client or default_client()).get_git_url(package)
@@ -0,0 +1,199 @@
+"""Cached listings of a source repo's tags, used to work out version labels.
+
+A git repo's tags and default branch HEAD come from a single
+`git ls-remote`; hg tags are read from the local mirror. Listings are cached
+on disk for a while, so resolving the labels of many versions of many
+packages costs at most one round trip per repo. `find_tag_format` then picks
+the tag naming scheme a project uses for its releases, e.g. "v%s" or
+"package-%s".
+"""
+
+import json
+import os
+import re
+import subprocess
+import threading
+import time
+from typing import Collection
+from typing import Dict
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Set
+
+try:
+  from . import resolver
+  from . import tracing
+except ImportError:
+  import resolver
+  import tracing
+
+DEFAULT_TTL = 60 * 60
+
+# Tag formats tried in order; {name} stands for spellings of the package name.
+TAG_FORMATS = ('%s', 'v%s', '{name}-%s', '{name}_%s', '{name}-v%s',
+               'release-%s', 'version-%s', 'v.%s', 'rel-%s', 'r%s')
+
+_PEELED_SUFFIX = '^{}'
+
+
+class Refs(NamedTuple):
+  # Commit of the default branch, if known.
+  head: Optional[str]
+  # Tag name -> commit (annotated tags are peeled).
+  tags: Dict[str, str]
+
+
+def parse_ls_remote(output: str) -> Refs:
+  head = None
+  tags = {}
+  peeled = {}
+  for line in output.splitlines():
+    parts = line.split('\t')
+    if len(parts) != 2:
+      continue
+    sha, ref = parts
+    if ref == 'HEAD':
+      head = sha
+    elif ref.startswith('refs/tags/'):
+      name = ref[len('refs/tags/'):]
+      if name.endswith(_PEELED_SUFFIX):
+        peeled[name[:-len(_PEELED_SUFFIX)]] = sha
+      else:
+        tags[name] = sha
+  tags.update(peeled)
+  return Refs(head, tags)
+
+
+def _name_spellings(package: str) -> List[str]:
+  canonical = resolver.canonical_name(package)
+  spellings = []
+  for name in (package, package.lower(), canonical,
+               canonical.replace('-', '_')):
+    if name not in spellings:
+      spellings.append(name)
+  return spellings
+
+
+def find_tag_format(package: str, version: str,
+                    tags: Collection[str]) -> Optional[str]:
+  """Returns the format whose tag for version exists, e.g. "v%s".
+
+  Known formats are tried first. Failing those, any tag that ends with the
+  version after a prefix without digits (e.g. "stable/1.0") is accepted.
+  """
+  for tag_format in TAG_FORMATS:
+    names = _name_spellings(package) if '{name}' in tag_format else ['']
+    for name in names:
+      candidate = tag_format.replace('{name}', name)
+      if candidate % version in tags:
+        return candidate
+  prefixes = sorted(
+      tag[:-len(version)] for tag in tags
+      if tag.endswith(version) and '%' not in tag and
+      not re.search(r'\d', tag[:-len(version)]))
+  if prefixes:
+    return prefixes[0] + '%s'
+  return None
+
+
+class RemoteRefs(object):
+  """Tag listings per repo URL, cached on disk for ttl seconds."""
+
+  def __init__(self, cache_path: Optional[str] = None,
+               ttl: int = DEFAULT_TTL):
+    self.cache_path = cache_path
+    self.ttl = ttl
+    self._lock = threading.Lock()
+    self._cache = self._load()
+    self._dirty = False
+    # URLs listed by this instance, which a refresh doesn't list again.
+    self._listed = set()  # type: Set[str]
+
+  def _load(self) -> Dict[str, Dict]:
+    if not self.cache_path or not os.path.isfile(self.cache_path):
+      return {}
+    try:
+      with open(self.cache_path) as cache_file:
+        return json.loads(cache_file.read())
+    except ValueError:
+      return {}
+
+  def _cached(self, url: str, refresh: bool) -> Optional[Refs]:
+    with self._lock:
+      entry = self._cache.get(url)
+      if entry is None:
+        return None
+      if url in self._listed or (
+          not refresh and time.time() - entry['fetched'] < self.ttl):
+        return Refs(entry['head'], entry['tags'])
+    return None
+
+  def _store(self, url: str, refs: Refs) -> Refs:
+    with self._lock:
+      self._cache[url] = {
+          'fetched': time.time(),
+          'head': refs.head,
+          'tags': refs.tags,
+      }
+      self._listed.add(url)
+      self._dirty = True
+    return refs
+
+  def git_refs(self, url: str, refresh: bool = False) -> Refs:
+    """Returns url's tags and HEAD, listing the remote if not cached.
+
+    With refresh, a cached listing is only reused if it was made by this
+    instance, e.g. to pick up a release tagged since the cache was filled.
+    """
+    refs = self._cached(url, refresh)
+    if refs is not None:
+      return refs
+    with tracing.span('ls-remote'):
+      output = tracing.check_output(
+          ['git', 'ls-remote', '--quiet', url, 'HEAD', 'refs/tags/*'])
+    return self._store(url, parse_ls_remote(output.decode()))
+
+  def hg_refs(self, url: str, mirror_dir: str,
+              refresh: bool = False) -> Refs:
+    """Returns url's tags, read from an up to date hg mirror of it."""
+    refs = self._cached(url, refresh)
+    if refs is not None:
+      return refs
+    output = tracing.check_output(
+        ['hg', 'tags', '--template', '{tag}\\t{node}\\n'], cwd=mirror_dir)
+    tags = {}
+    for line in output.decode().splitlines():
+      tag, _, node = line.partition('\t')
+      if node and tag != 'tip':
+        tags[tag] = node
+    return self._store(url, Refs(None, tags))
+
+  def save(self):
+    with self._lock:
+      if not self.cache_path or not self._dirty:
+        return
+      os.makedirs(os.path.dirname(os.path.abspath(self.cache_path)),
+                  exist_ok=True)
+      tmp_path = '%s.tmp.%d' % (self.cache_path, os.getpid())
+      with open(tmp_path, 'w') as cache_file:
+        json.dump(self._cache, cache_file, sort_keys=True, indent=2)
+      os.replace(tmp_path, self.cache_path)
+      self._dirty = False
+
+
+def export_commit(mirror_dir: str, commit: str, dest: str,
+                  subdir: Optional[str] = None):
+  """Writes the tree of commit in a git mirror to the dest directory.
+
+  With subdir, only that dir of the tree is written, as dest's contents.
+  """
+  os.makedirs(dest, exist_ok=True)
+  tree = '%s:%s' % (commit, subdir) if subdir else commit
+  archive = subprocess.Popen(['git', 'archive', tree], cwd=mirror_dir,
+                             stdout=subprocess.PIPE)
+  tracing.run_subprocess(['tar', '-x', '-C', dest], stdin=archive.stdout,
+                         check=True)
+  archive.stdout.close()
+  if archive.wait() != 0:
+    raise subprocess.CalledProcessError(archive.returncode, ['git', 'archive'])
@@ -1,24 +1,225 @@
+"""Parses pinned requirements from requirements.txt style files.
+
+Besides the legacy `name=version` lines this reads what `pip-compile
+--generate-hashes` writes: `name==version` pins with extras and environment
+markers, `--hash` options on backslash continued lines, comments, and
+`-r`/`-c` includes of other requirement and constraint files. Files are
+streamed line by line, and parsed results are memoized by the path and mtime
+of every file involved.
+"""
+
 import logging
+import os
+import re
+import sys
+import threading
 
+from typing import Dict
+from typing import Iterator
 from typing import NamedTuple
 from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
+
+try:
+  from . import resolver
+except ImportError:
+  import resolver
 
 class Requirement(NamedTuple):
     package: str
     version: str
+    # Environment marker, e.g. 'python_version < "3.8"'.
+    marker: Optional[str] = None
+    # Allowed artifact hashes, e.g. ('sha256:...',).
+    hashes: Tuple[str, ...] = ()
+
+_PIN_RE = re.compile(
+    r'^(?P<name>[A-Za-z0-9][A-Za-z0-9._-]*)\s*(?:\[[^\]]*\])?\s*'
+    r'(?:(?P<op>===|==|=)\s*(?P<version>[^\s;,]+))?\s*'
+    r'(?:;\s*(?P<marker>.*?))?\s*$')
+
+_COMMENT_RE = re.compile(r'(^|\s+)#.*$')
+
+_INCLUDE_OPTIONS = {
+    '-r': 'requirement', '--requirement': 'requirement',
+    '-c': 'constraint', '--constraint': 'constraint',
+}
+
+# Global options that don't affect which packages are pinned.
+_IGNORED_OPTIONS = ('-i', '--index-url', '--extra-index-url', '--no-index',
+                    '-f', '--find-links', '--trusted-host', '--pre',
+                    '--prefer-binary', '--require-hashes', '--only-binary',
+                    '--no-binary', '--use-feature')
+
+_cache_lock = threading.Lock()
+# Path -> ((path, mtime) of every file read, parsed requirements).
+_cache = {}  # type: Dict[str, Tuple[List[Tuple[str, int]], List[Requirement]]]
+
+
+def _logical_lines(path: str) -> Iterator[Tuple[int, str]]:
+  """Yields (line number, line) with comments removed and continuations
+  joined."""
+  with open(path) as f:
+    pending = ''
+    start = 0
+    for number, line in enumerate(f, 1):
+      line = line.rstrip('\n')
+      if not pending:
+        start = number
+      if line.endswith('\\'):
+        pending += line[:-1] + ' '
+        continue
+      line = _COMMENT_RE.sub('', pending + line).strip()
+      pending = ''
+      if line:
+        yield start, line
+    if pending.strip():
+      yield start, _COMMENT_RE.sub('', pending).strip()
+
+
+def _option_value(tokens: List[str], index: int) -> Tuple[str, str, int]:
+  """Splits "--opt=value" or "--opt value" at index; returns the next index."""
+  token = tokens[index]
+  if token.startswith('--') and '=' in token:
+    name, value = token.split('=', 1)
+    return name, value, index + 1
+  if not token.startswith('--') and len(token) > 2:
+    return token[:2], token[2:], index + 1
+  if index + 1 >= len(tokens):
+    raise ValueError('Missing value for %s' % token)
+  return token, tokens[index + 1], index + 2
 
-def parse(requirements_file: str) -> List[Requirement]:
-  """Parses out the requirements from a requirements.txt formatted file."""
-  with open(requirements_file) as f:
-     requirements_lines = f.readlines()
 
+def _parse_line(line: str) -> Optional[Requirement]:
+  """Returns the line's requirement (version may be '') or None."""
+  tokens = line.split()
+  # As with pip, the requirement ends at the first option.
+  split = next((i for i, t in enumerate(tokens) if t.startswith('-')),
+               len(tokens))
+  spec = ' '.join(tokens[:split])
+  hashes = []
+  index = split
+  while index < len(tokens):
+    name, value, index = _option_value(tokens, index)
+    if name == '--hash':
+      hashes.append(value)
+    else:
+      raise ValueError('Unsupported option %s' % name)
+  if ' @ ' in spec or '://' in spec:
+    logging.warning('Skipping URL requirement: %s', spec)
+    return None
+  match = _PIN_RE.match(spec)
+  if not match:
+    raise ValueError('Malformed requirement: %s' % spec)
+  if match.group('op') not in (None, '==', '===', '='):
+    raise ValueError('Requirement is not pinned: %s' % spec)
+  return Requirement(
+      package=match.group('name'),
+      version=match.group('version') or '',
+      marker=match.group('marker') or None,
+      hashes=tuple(hashes))
+
+
+def _parse_file(path: str, constraint: bool, files: List[Tuple[str, int]],
+                seen: Set[str]) -> Iterator[Tuple[Requirement, bool]]:
+  """Yields (requirement, is_constraint) for path and what it includes."""
+  path = os.path.abspath(path)
+  if path in seen:
+    return
+  seen.add(path)
+  files.append((path, os.stat(path).st_mtime_ns))
+  base_dir = os.path.dirname(path)
+  for number, line in _logical_lines(path):
+    try:
+      if line.startswith('-'):
+        tokens = line.split()
+        option = tokens[0].split('=', 1)[0]
+        if option in _INCLUDE_OPTIONS or tokens[0][:2] in ('-r', '-c'):
+          name, value, _ = _option_value(tokens, 0)
+          include = os.path.join(base_dir, os.path.expanduser(value))
+          yield from _parse_file(
+              include, constraint or _INCLUDE_OPTIONS[name] == 'constraint',
+              files, seen)
+        elif option in ('-e', '--editable'):
+          logging.warning('Skipping editable requirement: %s', line)
+        elif option not in _IGNORED_OPTIONS:
+          raise ValueError('Unsupported option %s' % option)
+        continue
+      requirement = _parse_line(line)
+    except ValueError as e:
+      raise ValueError('%s:%d: %s' % (path, number, e))
+    if requirement is not None:
+      yield requirement, constraint
+
+
+def _parse_uncached(requirements_file: str
+                   ) -> Tuple[List[Tuple[str, int]], List[Requirement]]:
+  files = []  # type: List[Tuple[str, int]]
   requirements = []
-  for line in requirements_lines:
-    if line.startswith('#') or len(line.strip()) == 0:
+  by_name = {}  # type: Dict[Tuple[str, Optional[str]], int]
+  constraints = {}  # type: Dict[Tuple[str, Optional[str]], Requirement]
+  for requirement, is_constraint in _parse_file(
+      requirements_file, False, files, set()):
+    key = (resolver.canonical_name(requirement.package), requirement.marker)
+    if is_constraint:
+      constraints.setdefault(key, requirement)
       continue
-    parts = line.split('=')
-    if len(parts) != 2:
-      logging.critical('Malformed requirements line: %s', line)
-      sys.exit(1)
-    requirements.append(Requirement(package=parts[0], version=parts[1].strip()))
-  return requirements
+    if key in by_name:
+      existing = requirements[by_name[key]]
+      if existing.version != requirement.version:
+        raise ValueError('Conflicting pins for %s: %s and %s' % (
+            requirement.package, existing.version, requirement.version))
+      continue
+    by_name[key] = len(requirements)
+    requirements.append(requirement)
+
+  for index, requirement in enumerate(requirements):
+    key = (resolver.canonical_name(requirement.package), requirement.marker)
+    constraint = constraints.get(key)
+    if not requirement.version and constraint:
+      requirement = requirement._replace(
+          version=constraint.version,
+          hashes=requirement.hashes or constraint.hashes)
+      requirements[index] = requirement
+    if not requirement.version:
+      raise ValueError('Requirement is not pinned: %s' % requirement.package)
+  return files, requirements
+
+
+def load(requirements_file: str) -> List[Requirement]:
+  """Parses requirements_file, raising ValueError if it is malformed."""
+  path = os.path.abspath(requirements_file)
+  with _cache_lock:
+    cached = _cache.get(path)
+  if cached is not None:
+    files, requirements = cached
+    try:
+      if all(os.stat(f).st_mtime_ns == mtime for f, mtime in files):
+        return list(requirements)
+    except FileNotFoundError:
+      pass
+  files, requirements = _parse_uncached(path)
+  with _cache_lock:
+    _cache[path] = (files, requirements)
+  return list(requirements)
+
+
+def applies(requirement: Requirement,
+            environment: Optional[Dict[str, str]] = None) -> bool:
+  """Whether the requirement's environment marker (if any) holds."""
+  if not requirement.marker:
+    return True
+  return resolver.requirement_name(
+      '%s; %s' % (requirement.package, requirement.marker),
+      environment) is not None
+
+
+def parse(requirements_file: str) -> List[Requirement]:
+  """Parses out the requirements from a requirements.txt formatted file."""
+  try:
+    return load(requirements_file)
+  except ValueError as e:
+    logging.critical('Malformed requirements file: %s', e)
+    sys.exit(1)
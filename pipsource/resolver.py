@@ -0,0 +1,398 @@
+"""Builds the dependency graph of vendored packages without pipenv.
+
+Dependencies are read statically from each vendored source tree's
+`install_requires` (setup.py, setup.cfg or pyproject.toml), plus any
+`install_requires` listed for the package in the package map. The graph only
+keeps edges between pinned packages and is returned as a topological order
+grouped into levels: every package's dependencies are in earlier levels, so
+the packages within one level can be installed in parallel.
+"""
+
+import configparser
+import json
+import logging
+import os
+import platform
+import re
+import sys
+import threading
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Mapping
+from typing import Optional
+from typing import Sequence
+from typing import Set
+from typing import Tuple
+
+try:
+  from . import version_probe
+except ImportError:
+  import version_probe
+
+try:
+  from packaging.markers import InvalidMarker
+  from packaging.markers import Marker
+  from packaging.markers import UndefinedComparison
+  from packaging.markers import UndefinedEnvironmentName
+except ImportError:
+  Marker = None
+
+_NAME_RE = re.compile(r'^\s*([A-Za-z0-9][A-Za-z0-9._-]*)')
+
+_MARKER_TOKEN_RE = re.compile(
+    r'\s*(\(|\)|===|==|!=|<=|>=|~=|<|>|not\s+in\b|in\b|and\b|or\b|'
+    r"'[^']*'|\"[^\"]*\"|[A-Za-z_][A-Za-z0-9_.]*)")
+
+# Marker variables compared as versions rather than as strings.
+_VERSION_VARIABLES = ('python_version', 'python_full_version',
+                      'implementation_version')
+
+
+def canonical_name(name: str) -> str:
+  """Normalizes a package name the way PyPI does (PEP 503)."""
+  return re.sub(r'[-_.]+', '-', name).lower()
+
+
+def _current_environment() -> Dict[str, str]:
+  """Returns the PEP 508 marker environment of this interpreter."""
+  return {
+      'implementation_name': sys.implementation.name,
+      'implementation_version': platform.python_version(),
+      'os_name': os.name,
+      'platform_machine': platform.machine(),
+      'platform_release': platform.release(),
+      'platform_system': platform.system(),
+      'platform_version': platform.version(),
+      'python_full_version': platform.python_version(),
+      'platform_python_implementation': platform.python_implementation(),
+      'python_version': '.'.join(platform.python_version_tuple()[:2]),
+      'sys_platform': sys.platform,
+  }
+
+
+def _version_tuple(version: str) -> Optional[Tuple[int, ...]]:
+  match = re.match(r'^\s*(\d+(?:\.\d+)*)', version)
+  if not match:
+    return None
+  return tuple(int(part) for part in match.group(1).split('.'))
+
+
+def _compare(op: str, left: str, right: str, as_versions: bool) -> bool:
+  """Compares marker values; raises ValueError for unsupported ones."""
+  if op in ('in', 'not in'):
+    return (left in right) == (op == 'in')
+  if op == '===':
+    return left == right
+  if as_versions:
+    if op in ('==', '!=') and right.endswith('.*'):
+      prefix = _version_tuple(right[:-2])
+      found = _version_tuple(left)
+      if prefix is None or found is None:
+        raise ValueError(right)
+      return (found[:len(prefix)] == prefix) == (op == '==')
+    found, wanted = _version_tuple(left), _version_tuple(right)
+    if found is None or wanted is None:
+      raise ValueError(right)
+    if op == '~=':
+      return found >= wanted and found[:len(wanted) - 1] == wanted[:-1]
+    width = max(len(found), len(wanted))
+    found += (0,) * (width - len(found))
+    wanted += (0,) * (width - len(wanted))
+    left, right = found, wanted
+  elif op not in ('==', '!='):
+    raise ValueError(op)
+  return {'==': left == right, '!=': left != right, '<': left < right,
+          '<=': left <= right, '>': left > right, '>=': left >= right,
+          '~=': left == right}[op]
+
+
+def _evaluate_marker(marker: str, environment: Dict[str, str]) -> bool:
+  """Evaluates a PEP 508 marker without `packaging`.
+
+  Handles comparisons of the standard variables, joined with and, or and
+  parentheses. Raises ValueError for anything else.
+  """
+  tokens = []
+  position = 0
+  marker = marker.strip()
+  while position < len(marker):
+    match = _MARKER_TOKEN_RE.match(marker, position)
+    if not match:
+      raise ValueError(marker)
+    tokens.append(re.sub(r'\s+', ' ', match.group(1)))
+    position = match.end()
+
+  def take():
+    if not tokens:
+      raise ValueError(marker)
+    return tokens.pop(0)
+
+  def value():
+    token = take()
+    if token[0] in '\'"':
+      return token[1:-1], False
+    if token not in environment:
+      raise ValueError(token)
+    return environment[token], token in _VERSION_VARIABLES
+
+  def atom():
+    if tokens and tokens[0] == '(':
+      take()
+      result = expression()
+      if take() != ')':
+        raise ValueError(marker)
+      return result
+    left, left_version = value()
+    op = take()
+    right, right_version = value()
+    return _compare(op, left, right, left_version or right_version)
+
+  def conjunction():
+    result = atom()
+    while tokens and tokens[0] == 'and':
+      take()
+      result = atom() and result
+    return result
+
+  def expression():
+    result = conjunction()
+    while tokens and tokens[0] == 'or':
+      take()
+      result = conjunction() or result
+    return result
+
+  result = expression()
+  if tokens:
+    raise ValueError(marker)
+  return result
+
+
+def marker_applies(marker: str,
+                   environment: Optional[Dict[str, str]] = None) -> bool:
+  """Whether an environment marker holds in environment (default this one).
+
+  Uses the optional `packaging` library when it is available, and otherwise
+  a built-in evaluator for the common markers. A marker neither can evaluate
+  is logged and treated as holding.
+  """
+  if Marker is not None:
+    try:
+      return Marker(marker).evaluate(environment)
+    except (InvalidMarker, UndefinedComparison, UndefinedEnvironmentName):
+      pass
+  else:
+    full_environment = _current_environment()
+    full_environment.update(environment or {})
+    try:
+      return _evaluate_marker(marker, full_environment)
+    except ValueError:
+      pass
+  logging.warning('Ignoring environment marker %r, which could not be '
+                  'evaluated', marker)
+  return True
+
+
+def requirement_name(requirement: str,
+                     environment: Optional[Dict[str, str]] = None
+                    ) -> Optional[str]:
+  """Returns the canonical name a requirement string refers to.
+
+  Returns None for blank or unparseable lines and for requirements whose
+  environment marker doesn't apply.
+  """
+  requirement = requirement.split('#', 1)[0].strip()
+  match = _NAME_RE.match(requirement)
+  if not match:
+    return None
+  if ';' in requirement and not marker_applies(
+      requirement.split(';', 1)[1].strip(), environment):
+    return None
+  return canonical_name(match.group(1))
+
+
+def _requires_from_pyproject(package_dir: str) -> Optional[List[str]]:
+  path = os.path.join(package_dir, 'pyproject.toml')
+  if version_probe.tomllib is None or not os.path.isfile(path):
+    return None
+  with open(path, 'rb') as f:
+    try:
+      pyproject = version_probe.tomllib.load(f)
+    except version_probe.tomllib.TOMLDecodeError:
+      return None
+  dependencies = pyproject.get('project', {}).get('dependencies')
+  return list(dependencies) if isinstance(dependencies, list) else None
+
+
+def _requires_from_setup_cfg(package_dir: str) -> Optional[List[str]]:
+  path = os.path.join(package_dir, 'setup.cfg')
+  if not os.path.isfile(path):
+    return None
+  parser = configparser.ConfigParser(interpolation=None)
+  try:
+    parser.read(path)
+  except configparser.Error:
+    return None
+  if not parser.has_option('options', 'install_requires'):
+    return None
+  value = parser.get('options', 'install_requires')
+  return [line for line in value.split('\n') if line.strip()]
+
+
+def _requires_from_setup_py(package_dir: str) -> Optional[List[str]]:
+  keywords = version_probe.setup_py_keywords(package_dir)
+  if not keywords:
+    return None
+  requires = keywords.get('install_requires')
+  if isinstance(requires, str):
+    return requires.split('\n')
+  if isinstance(requires, (list, tuple)):
+    return [r for r in requires if isinstance(r, str)]
+  return None
+
+
+def read_install_requires(package_dir: str) -> List[str]:
+  """Statically reads the requirement strings a source tree declares."""
+  for reader in (_requires_from_pyproject, _requires_from_setup_cfg,
+                 _requires_from_setup_py):
+    requires = reader(package_dir)
+    if requires is not None:
+      return requires
+  return []
+
+
+def levels(graph: Mapping[str, Iterable[str]]) -> List[List[str]]:
+  """Groups a package -> dependencies graph into topological levels.
+
+  Level 0 holds packages without dependencies; each later level holds the
+  packages whose dependencies are all in earlier levels. Packages in a
+  dependency cycle are put together in one final level.
+  """
+  remaining = {p: set(d for d in deps if d in graph and d != p)
+               for p, deps in graph.items()}
+  result = []
+  placed = set()  # type: Set[str]
+  while remaining:
+    level = sorted(p for p, deps in remaining.items() if deps <= placed)
+    if not level:
+      cycle = sorted(remaining)
+      logging.warning('Dependency cycle between %s', ', '.join(cycle))
+      level = cycle
+    result.append(level)
+    placed.update(level)
+    for package in level:
+      del remaining[package]
+  return result
+
+
+class Resolver(object):
+  """Reads dependency metadata, caching it on disk by source tree or commit."""
+
+  def __init__(self, cache_path: Optional[str] = None,
+               environment: Optional[Dict[str, str]] = None):
+    self.cache_path = cache_path
+    self.environment = environment
+    self._lock = threading.Lock()
+    self._cache = self._load()
+    self._dirty = False
+
+  def _load(self) -> Dict[str, List[str]]:
+    if not self.cache_path or not os.path.isfile(self.cache_path):
+      return {}
+    try:
+      with open(self.cache_path) as cache_file:
+        return json.loads(cache_file.read())
+    except ValueError:
+      return {}
+
+  def install_requires(self, package_dir: str,
+                       cache_key: Optional[str] = None) -> List[str]:
+    """Returns package_dir's requirement strings, cached under cache_key."""
+    if cache_key:
+      with self._lock:
+        if cache_key in self._cache:
+          return self._cache[cache_key]
+    requires = read_install_requires(package_dir)
+    if cache_key:
+      with self._lock:
+        self._cache[cache_key] = requires
+        self._dirty = True
+    return requires
+
+  def graph(self, packages: Sequence[str],
+            package_dirs: Mapping[str, str],
+            cache_keys: Optional[Mapping[str, str]] = None,
+            extra_requires: Optional[Mapping[str, Iterable[str]]] = None,
+            environment: Optional[Dict[str, str]] = None
+           ) -> Dict[str, Set[str]]:
+    """Returns package -> dependencies for packages, limited to packages.
+
+    The result is keyed by the names as given, while requirements are
+    matched on their canonical names. Markers are evaluated in environment,
+    if given, instead of the resolver's, e.g. for another interpreter.
+    """
+    environment = environment or self.environment
+    by_canonical = {canonical_name(p): p for p in packages}
+    cache_keys = cache_keys or {}
+    extra_requires = extra_requires or {}
+    graph = {}
+    for package in packages:
+      requires = list(extra_requires.get(package, []))
+      package_dir = package_dirs.get(package)
+      if package_dir and os.path.isdir(package_dir):
+        requires += self.install_requires(package_dir,
+                                          cache_keys.get(package))
+      deps = set()
+      for requirement in requires:
+        name = requirement_name(requirement, environment)
+        if name in by_canonical:
+          deps.add(by_canonical[name])
+      graph[package] = deps
+    return graph
+
+  def resolve(self, packages_and_versions: Sequence[Tuple[str, str]],
+              package_dirs: Mapping[str, str],
+              cache_keys: Optional[Mapping[str, str]] = None,
+              extra_requires: Optional[Mapping[str, Iterable[str]]] = None,
+              environment: Optional[Dict[str, str]] = None
+             ) -> List[List[Tuple[str, str]]]:
+    """Returns the (package, version) pairs grouped into install levels."""
+    versions = dict(packages_and_versions)
+    graph = self.graph(list(versions), package_dirs, cache_keys,
+                       extra_requires, environment)
+    return [[(p, versions[p]) for p in level] for level in levels(graph)]
+
+  def save(self):
+    with self._lock:
+      if not self.cache_path or not self._dirty:
+        return
+      os.makedirs(os.path.dirname(os.path.abspath(self.cache_path)),
+                  exist_ok=True)
+      tmp_path = '%s.tmp.%d' % (self.cache_path, os.getpid())
+      with open(tmp_path, 'w') as cache_file:
+        json.dump(self._cache, cache_file, sort_keys=True, indent=2)
+      os.replace(tmp_path, self.cache_path)
+      self._dirty = False
+
+
+def read_pipfile_lock(path: str,
+                      environment: Optional[Dict[str, str]] = None
+                     ) -> List[Tuple[str, str]]:
+  """Returns the pinned (package, version) pairs of a Pipfile.lock.
+
+  Packages whose markers don't hold in environment are left out.
+  """
+  with open(path) as lock_file:
+    lock = json.loads(lock_file.read())
+  pins = []
+  for package, info in sorted(lock.get('default', {}).items()):
+    markers = info.get('markers')
+    if markers and requirement_name(
+        '%s; %s' % (package, markers), environment) is None:
+      continue
+    version = info.get('version', '')
+    if not version.startswith('=='):
+      logging.warning('Skipping %s: not pinned to an exact version', package)
+      continue
+    pins.append((package, version[2:]))
+  return pins
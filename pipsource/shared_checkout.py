@@ -0,0 +1,194 @@
+"""Sparse checkouts shared by the packages vendored from one git repo.
+
+Some repos publish several packages, each from its own subdirectory, e.g.
+
+  "foo-client": {"git": "https://example.com/foo", "subdir": "client"}
+
+Rather than cloning the repo once per package, each commit of such a repo is
+fetched once, from the mirror, into a checkout in the cache dir keyed by URL
+and commit. The checkout is sparse: only the subdirectories of the packages
+vendored from it are in its working tree, and a package's subdirectory is
+added to it the first time that package needs it. Checkouts are locked with a
+lock file while they are used, so sibling packages vendored in parallel, or by
+other processes, share the one fetch.
+
+Like the mirror cache, the checkouts have a total size cap: an index records
+when each was last used and its size, and the least recently used ones that
+aren't locked are removed once the cap is exceeded.
+"""
+
+import contextlib
+import hashlib
+import json
+import os
+import posixpath
+import shutil
+import time
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Optional
+
+try:
+  from . import locking
+  from . import mirror_cache
+  from . import tracing
+except ImportError:
+  import locking
+  import mirror_cache
+  import tracing
+
+DEFAULT_CACHE_DIR = os.path.expanduser('~/.pipsource/checkouts')
+
+DEFAULT_MAX_BYTES = 5 * 1024 ** 3
+
+INDEX_FILE_NAME = 'index.json'
+
+
+def normalize_subdir(subdir: str) -> str:
+  """Returns subdir as a clean relative path; raises ValueError if it isn't."""
+  if not isinstance(subdir, str):
+    raise ValueError('"subdir" must be a string')
+  normalized = posixpath.normpath(subdir.strip('/'))
+  if (not subdir or subdir.startswith('/') or normalized == '.' or
+      normalized.split('/')[0] == '..' or '.git' in normalized.split('/')):
+    raise ValueError('Invalid subdir %r' % subdir)
+  return normalized
+
+
+def subdir_for(package_info) -> Optional[str]:
+  """Returns the package map entry's repo subdirectory, if it has one."""
+  subdir = package_info.get('subdir')
+  if subdir is None:
+    return None
+  return normalize_subdir(subdir)
+
+
+def checkout_path(cache_dir: str, url: str, commit: str) -> str:
+  """Returns where the checkout of url at commit is kept."""
+  name = posixpath.basename(url.rstrip('/'))
+  if name.endswith('.git'):
+    name = name[:-len('.git')]
+  digest = hashlib.sha1(url.encode()).hexdigest()[:16]
+  return os.path.join(cache_dir, '%s-%s-%s' % (name, digest, commit))
+
+
+def _git(args: List[str], cwd: str):
+  tracing.run_subprocess(['git'] + args, cwd=cwd, check=True)
+
+
+def _sparse_file(path: str) -> str:
+  return os.path.join(path, '.git', 'info', 'sparse-checkout')
+
+
+def sparse_dirs(path: str) -> List[str]:
+  """Returns the subdirectories in the checkout's working tree."""
+  try:
+    with open(_sparse_file(path)) as f:
+      return [line.strip().strip('/') for line in f if line.strip()]
+  except FileNotFoundError:
+    return []
+
+
+def _add_sparse_dir(path: str, subdir: str):
+  # Patterns anchored at the root, so "client" doesn't also match
+  # "server/client". These work with any git that has sparse checkouts, not
+  # just those with `git sparse-checkout`.
+  with open(_sparse_file(path), 'a') as f:
+    f.write('/%s/\n' % subdir)
+
+
+def _create(path: str, commit: str, subdir: str, mirror_dir: str):
+  tmp_path = '%s.tmp.%d' % (path, os.getpid())
+  shutil.rmtree(tmp_path, ignore_errors=True)
+  _git(['init', '--quiet', tmp_path], os.path.dirname(path))
+  _git(['config', 'core.sparseCheckout', 'true'], tmp_path)
+  os.makedirs(os.path.dirname(_sparse_file(tmp_path)), exist_ok=True)
+  _add_sparse_dir(tmp_path, subdir)
+  with tracing.span('clone'):
+    _git(['fetch', '--quiet', '--depth', '1', mirror_dir, commit], tmp_path)
+  with tracing.span('checkout'):
+    _git(['checkout', '--quiet', 'FETCH_HEAD'], tmp_path)
+  os.rename(tmp_path, path)
+
+
+@contextlib.contextmanager
+def ensure(cache_dir: str, url: str, commit: str, subdir: str,
+           mirror_dir: str) -> Iterator[str]:
+  """Yields the dir of subdir in the shared checkout of url at commit.
+
+  commit must be a full hash present in mirror_dir, a mirror of url. The
+  checkout is created, or subdir added to it, if needed, and is locked
+  against changes and eviction until the context exits, so copy from it
+  inside the `with` block. Raises ValueError if the commit has no such
+  subdirectory.
+  """
+  path = checkout_path(cache_dir, url, commit)
+  os.makedirs(cache_dir, exist_ok=True)
+  with locking.file_lock(path + '.lock'):
+    if not os.path.isdir(path):
+      _create(path, commit, subdir, mirror_dir)
+    elif subdir not in sparse_dirs(path):
+      _add_sparse_dir(path, subdir)
+      with tracing.span('checkout'):
+        _git(['read-tree', '-mu', 'HEAD'], path)
+    _touch(cache_dir, path)
+    source_dir = os.path.join(path, subdir)
+    if not os.path.isdir(source_dir):
+      raise ValueError('%s has no dir %s at commit %s' % (url, subdir, commit))
+    yield source_dir
+
+
+def _index_path(cache_dir: str) -> str:
+  return os.path.join(cache_dir, INDEX_FILE_NAME)
+
+
+def _load_index(cache_dir: str) -> Dict[str, Dict]:
+  try:
+    with open(_index_path(cache_dir)) as index_file:
+      return json.loads(index_file.read())
+  except FileNotFoundError:
+    return {}
+
+
+def _save_index(cache_dir: str, index: Dict[str, Dict]):
+  tmp_path = _index_path(cache_dir) + '.tmp.%d' % os.getpid()
+  with open(tmp_path, 'w') as index_file:
+    json.dump(index, index_file, sort_keys=True, indent=2)
+  os.replace(tmp_path, _index_path(cache_dir))
+
+
+def _touch(cache_dir: str, path: str):
+  size = mirror_cache.dir_size(path)
+  with locking.file_lock(_index_path(cache_dir) + '.lock'):
+    index = _load_index(cache_dir)
+    index[os.path.basename(path)] = {'last_used': time.time(), 'bytes': size}
+    _save_index(cache_dir, index)
+
+
+def total_bytes(cache_dir: str) -> int:
+  with locking.file_lock(_index_path(cache_dir) + '.lock'):
+    return sum(entry['bytes'] for entry in _load_index(cache_dir).values())
+
+
+def evict(cache_dir: str, max_bytes: int = DEFAULT_MAX_BYTES):
+  """Removes least recently used checkouts until they fit in max_bytes.
+
+  Checkouts that are currently locked, by this or another process, are
+  skipped.
+  """
+  with locking.file_lock(_index_path(cache_dir) + '.lock'):
+    index = _load_index(cache_dir)
+    entries = sorted(index.items(), key=lambda e: e[1]['last_used'])
+    total = sum(entry['bytes'] for _, entry in entries)
+    for name, entry in entries:
+      if total <= max_bytes:
+        break
+      path = os.path.join(cache_dir, name)
+      with locking.file_lock(path + '.lock', blocking=False) as locked:
+        if not locked:
+          continue
+        shutil.rmtree(path, ignore_errors=True)
+        del index[name]
+        total -= entry['bytes']
+    _save_index(cache_dir, index)
@@ -0,0 +1,176 @@
+"""Span-based timing of vendor runs.
+
+Code wraps interesting work in `span(name)`; spans nest per thread and inherit
+the package of the span they are opened in, so a pipeline stage span labelled
+with a package attributes everything under it to that package. Subprocesses
+started through `run_subprocess` add their wall time to the innermost open
+span. At the end of a run `summary_lines` reports the slowest packages and
+phases, and `write_chrome_trace` exports every span in the Chrome trace event
+format (loadable in chrome://tracing or Perfetto).
+"""
+
+import contextlib
+import json
+import os
+import subprocess
+import threading
+import time
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+
+
+class Span(NamedTuple):
+  name: str
+  package: Optional[str]
+  # Seconds since the tracer started.
+  start: float
+  duration: float
+  thread: int
+  # Wall time spent waiting on subprocesses directly inside this span.
+  subprocess_seconds: float
+  depth: int
+
+
+class _OpenSpan(object):
+
+  def __init__(self, name, package, start, depth):
+    self.name = name
+    self.package = package
+    self.start = start
+    self.depth = depth
+    self.subprocess_seconds = 0.0
+
+
+class Tracer(object):
+  """Collects the spans of one run from any number of threads."""
+
+  def __init__(self):
+    self.origin = time.monotonic()
+    self._lock = threading.Lock()
+    self._spans = []  # type: List[Span]
+    self._context = threading.local()
+
+  def _stack(self) -> List[_OpenSpan]:
+    stack = getattr(self._context, 'stack', None)
+    if stack is None:
+      stack = self._context.stack = []
+    return stack
+
+  @contextlib.contextmanager
+  def span(self, name: str, package: Optional[str] = None) -> Iterator[None]:
+    stack = self._stack()
+    if package is None and stack:
+      package = stack[-1].package
+    open_span = _OpenSpan(name, package, time.monotonic(), len(stack))
+    stack.append(open_span)
+    try:
+      yield
+    finally:
+      stack.pop()
+      end = time.monotonic()
+      with self._lock:
+        self._spans.append(Span(
+            name=name, package=package,
+            start=open_span.start - self.origin,
+            duration=end - open_span.start,
+            thread=threading.get_ident(),
+            subprocess_seconds=open_span.subprocess_seconds,
+            depth=open_span.depth))
+
+  def add_subprocess_time(self, seconds: float):
+    stack = self._stack()
+    if stack:
+      stack[-1].subprocess_seconds += seconds
+
+  def spans(self) -> List[Span]:
+    with self._lock:
+      return list(self._spans)
+
+  def summary_lines(self, limit: int = 5) -> List[str]:
+    """Returns a report of the slowest top level packages and phases."""
+    spans = self.spans()
+    if not spans:
+      return []
+    package_seconds = {}  # type: Dict[str, float]
+    phase_seconds = {}  # type: Dict[str, List[float]]
+    for span in spans:
+      # Only count a package's outermost spans so nested time isn't counted
+      # twice; pipeline stages of one package never overlap.
+      if span.package and span.depth == 0:
+        package_seconds[span.package] = (
+            package_seconds.get(span.package, 0.0) + span.duration)
+      totals = phase_seconds.setdefault(span.name, [0.0, 0.0, 0])
+      totals[0] += span.duration
+      totals[1] += span.subprocess_seconds
+      totals[2] += 1
+    lines = []
+    if package_seconds:
+      lines.append('Slowest packages:')
+      for package, seconds in sorted(
+          package_seconds.items(), key=lambda p: -p[1])[:limit]:
+        lines.append('  %8.2fs  %s' % (seconds, package))
+    lines.append('Slowest phases (total, subprocess, count):')
+    for name, (seconds, subprocess_seconds, count) in sorted(
+        phase_seconds.items(), key=lambda p: -p[1][0])[:limit * 2]:
+      lines.append('  %8.2fs  %8.2fs  %5d  %s' %
+                   (seconds, subprocess_seconds, count, name))
+    return lines
+
+  def write_chrome_trace(self, path: str):
+    events = []
+    for span in self.spans():
+      args = {'subprocess_seconds': round(span.subprocess_seconds, 6)}
+      if span.package:
+        args['package'] = span.package
+      events.append({
+          'name': span.name,
+          'cat': span.package or 'run',
+          'ph': 'X',
+          'ts': int(span.start * 1e6),
+          'dur': int(span.duration * 1e6),
+          'pid': os.getpid(),
+          'tid': span.thread,
+          'args': args,
+      })
+    events.sort(key=lambda e: e['ts'])
+    tmp_path = '%s.tmp.%d' % (path, os.getpid())
+    with open(tmp_path, 'w') as trace_file:
+      json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, trace_file)
+    os.replace(tmp_path, path)
+
+
+_tracer = Tracer()
+
+
+def tracer() -> Tracer:
+  return _tracer
+
+
+def reset() -> Tracer:
+  """Starts a fresh tracer, e.g. at the start of a run."""
+  global _tracer
+  _tracer = Tracer()
+  return _tracer
+
+
+def span(name: str, package: Optional[str] = None):
+  """Times the enclosed block as a span of the current run."""
+  return _tracer.span(name, package)
+
+
+def run_subprocess(cmd: List[str], **kwargs) -> subprocess.CompletedProcess:
+  """Like `subprocess.run`, adding its wall time to the current span."""
+  start = time.monotonic()
+  try:
+    return subprocess.run(cmd, **kwargs)
+  finally:
+    _tracer.add_subprocess_time(time.monotonic() - start)
+
+
+def check_output(cmd: List[str], **kwargs) -> bytes:
+  """Like `subprocess.check_output`, adding its wall time to the span."""
+  kwargs.setdefault('stdout', subprocess.PIPE)
+  return run_subprocess(cmd, check=True, **kwargs).stdout
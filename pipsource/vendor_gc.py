@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+"""Garbage collection of vendored package directories.
+
+A vendored package is live if any root refers to it. Roots are install
+scripts, lockfiles (Pipfile.lock or requirements.txt) and package maps. The
+vendor manifest is not a root: it lists every vendored package, so nothing
+would ever be garbage. Every other directory in the vendor dir is garbage. Each
+candidate directory is walked once to find both its size and when it was last
+used, so a dry run costs the same as a real collection.
+
+Vendored files are links to content store objects, so deleting a package dir
+alone frees little. Given the store, collection also deletes the refs of the
+removed packages and then sweeps the trees and objects nothing uses any more.
+A candidate's reclaimable bytes include the objects that only its trees use,
+and its last use is when a vendor run last used its refs.
+
+Deleting is done by renaming directories into a trash dir inside the vendor
+dir, which is instant and atomic, and then removing the trash in parallel,
+normally in a detached background process.
+"""
+
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Set
+
+try:
+  from . import content_store
+  from . import integrity
+  from . import manifest
+  from . import mirror_cache
+  from . import package_map_store
+  from . import requirements
+  from . import resolver
+except ImportError:
+  import content_store
+  import integrity
+  import manifest
+  import mirror_cache
+  import package_map_store
+  import requirements
+  import resolver
+
+TRASH_DIR_NAME = '.pipsource-trash'
+
+DEFAULT_PURGE_JOBS = 8
+
+_INSTALL_LINE_RE = re.compile(r'pip_(?:install|wheel)_vendored ([^ ]+) ')
+
+
+class Candidate(NamedTuple):
+  package: str
+  path: str
+  # Apparent size of every file in the package dir.
+  bytes: int
+  # Bytes freed by deleting just it: its files that aren't linked from
+  # elsewhere, plus the store objects no other tree uses.
+  reclaimable_bytes: int
+  # When its refs were last used, or else the newest dir mtime in the tree.
+  last_used: float
+  # Bytes of files in the dir that aren't linked from elsewhere.
+  own_bytes: int = 0
+  # Store objects that only the trees of candidates use, and their sizes.
+  # Ones other candidates use too are freed only along with those.
+  objects: Dict[str, int] = {}
+
+
+def roots_from_install_script(path: str) -> Set[str]:
+  roots = set()
+  with open(path) as script_file:
+    for line in script_file:
+      match = _INSTALL_LINE_RE.match(line)
+      if match:
+        roots.add(match.group(1))
+  return roots
+
+
+def _roots_from_json(path: str) -> Set[str]:
+  if os.path.basename(path) == manifest.MANIFEST_FILE_NAME:
+    raise ValueError('%s lists every vendored package, so it can\'t be a gc '
+                     'root' % path)
+  with open(path) as json_file:
+    data = json.loads(json_file.read())
+  if not isinstance(data, dict):
+    return set()
+  if 'default' in data and '_meta' in data:
+    # Pipfile.lock
+    return set(data['default'])
+  if isinstance(data.get('packages'), dict):
+    # pipsource config file.
+    return set(data['packages'])
+  # Package map: package name -> source info.
+  return set(data)
+
+
+def roots_from_file(path: str) -> Set[str]:
+  """Returns the package names a root file refers to.
+
+  Raises ValueError for the vendor manifest.
+  """
+  if os.path.isdir(path):
+    return set(package_map_store.ShardedPackageMap(path))
+  if path.endswith('.json') or os.path.basename(path) == 'Pipfile.lock':
+    return _roots_from_json(path)
+  if path.endswith('.txt'):
+    return set(r.package for r in requirements.parse(path))
+  return roots_from_install_script(path)
+
+
+def collect_roots(paths: Iterable[str]) -> Set[str]:
+  """Returns the canonical names of all packages referred to by paths."""
+  roots = set()
+  for path in paths:
+    roots.update(resolver.canonical_name(p) for p in roots_from_file(path))
+  return roots
+
+
+def _scan(package: str, path: str) -> Candidate:
+  total = 0
+  reclaimable = 0
+  last_used = 0.0
+  stack = [path]
+  while stack:
+    current = stack.pop()
+    try:
+      entries = os.scandir(current)
+    except OSError:
+      continue
+    with entries:
+      for entry in entries:
+        try:
+          entry_stat = entry.stat(follow_symlinks=False)
+        except OSError:
+          continue
+        if entry.is_dir(follow_symlinks=False):
+          # Dirs are the package's own, unlike files shared with the store,
+          # and are written when the tree is checked out or relinked.
+          last_used = max(last_used, entry_stat.st_mtime)
+          stack.append(entry.path)
+          continue
+        total += entry_stat.st_size
+        if entry_stat.st_nlink <= 1:
+          reclaimable += entry_stat.st_size
+  if not last_used:
+    last_used = os.lstat(path).st_mtime
+  return Candidate(package, path, total, reclaimable, last_used,
+                   own_bytes=reclaimable)
+
+
+def _refs_by_package(
+    store: content_store.ContentStore
+) -> Dict[str, List[content_store.StoredRef]]:
+  refs = {}  # type: Dict[str, List[content_store.StoredRef]]
+  for ref in store.list_refs():
+    refs.setdefault(resolver.canonical_name(ref.package), []).append(ref)
+  return refs
+
+
+def _add_store_usage(candidates: List[Candidate], roots: Set[str],
+                     store: content_store.ContentStore) -> List[Candidate]:
+  """Adds the store objects each candidate's trees alone use."""
+  refs = _refs_by_package(store)
+  checkouts = store.checkouts()
+  candidate_paths = set(os.path.abspath(c.path) for c in candidates)
+  live_trees = set(ref.tree for package, package_refs in refs.items()
+                   if package in roots for ref in package_refs)
+  live_trees.update(tree for dest, tree in checkouts.items()
+                    if dest not in candidate_paths and os.path.isdir(dest))
+  live_objects = set()
+  for tree in live_trees:
+    live_objects.update(store.tree_objects(tree))
+
+  with_objects = []
+  users = {}  # type: Dict[str, int]
+  for candidate in candidates:
+    package_refs = refs.get(resolver.canonical_name(candidate.package), [])
+    trees = set(ref.tree for ref in package_refs)
+    checkout = checkouts.get(os.path.abspath(candidate.path))
+    if checkout:
+      trees.add(checkout)
+    objects = {}
+    for tree in trees - live_trees:
+      objects.update(store.tree_objects(tree))
+    objects = {path: size for path, size in objects.items()
+               if path not in live_objects}
+    for path in objects:
+      users[path] = users.get(path, 0) + 1
+    last_used = max([ref.used_at for ref in package_refs] or
+                    [candidate.last_used])
+    with_objects.append(candidate._replace(objects=objects,
+                                           last_used=last_used))
+  return [
+      c._replace(reclaimable_bytes=c.own_bytes + sum(
+          size for path, size in c.objects.items() if users[path] == 1))
+      for c in with_objects
+  ]
+
+
+def find_garbage(vendor_dir: str, roots: Set[str],
+                 jobs: int = DEFAULT_PURGE_JOBS,
+                 store: Optional[content_store.ContentStore] = None
+                 ) -> List[Candidate]:
+  """Returns the unreachable package dirs in vendor_dir, oldest used first.
+
+  roots holds canonical package names. Entries starting with a dot, such as
+  the manifest and the trash dir, are never collected. With the content
+  store the vendored files link to, the store objects deleting candidates
+  frees count too.
+  """
+  unreachable = [
+      name for name in sorted(os.listdir(vendor_dir))
+      if not name.startswith('.') and
+      resolver.canonical_name(name) not in roots
+  ]
+  with ThreadPoolExecutor(max_workers=jobs) as executor:
+    candidates = list(executor.map(
+        lambda name: _scan(name, os.path.join(vendor_dir, name)),
+        unreachable))
+  if store is not None:
+    candidates = _add_store_usage(candidates, roots, store)
+  return sorted(candidates, key=lambda c: (c.last_used, c.package))
+
+
+def freed_bytes(selected: List[Candidate],
+                candidates: List[Candidate]) -> int:
+  """Returns the bytes deleting the selected candidates frees."""
+  selected_paths = set(c.path for c in selected)
+  unselected_objects = set()
+  for candidate in candidates:
+    if candidate.path not in selected_paths:
+      unselected_objects.update(candidate.objects)
+  objects = {}  # type: Dict[str, int]
+  for candidate in selected:
+    objects.update(candidate.objects)
+  return sum(c.own_bytes for c in selected) + sum(
+      size for path, size in objects.items()
+      if path not in unselected_objects)
+
+
+def select(candidates: List[Candidate],
+           free_bytes: Optional[int] = None) -> List[Candidate]:
+  """Picks the candidates to delete, oldest used first.
+
+  Without free_bytes everything is selected; otherwise just enough to free
+  that many bytes (or everything, if the garbage doesn't add up to it).
+  """
+  if free_bytes is None:
+    return list(candidates)
+  users = {}  # type: Dict[str, int]
+  for candidate in candidates:
+    for path in candidate.objects:
+      users[path] = users.get(path, 0) + 1
+  selected = []
+  freed = 0
+  for candidate in candidates:
+    if freed >= free_bytes:
+      break
+    selected.append(candidate)
+    freed += candidate.own_bytes
+    for path, size in candidate.objects.items():
+      users[path] -= 1
+      if not users[path]:
+        freed += size
+  return selected
+
+
+def dead_refs(store: content_store.ContentStore, vendor_dir: str,
+              roots: Set[str],
+              removed: Iterable[Candidate] = ()
+              ) -> List[content_store.StoredRef]:
+  """Returns the store refs no longer needed once removed is deleted.
+
+  Refs of root packages and of packages still vendored in vendor_dir are
+  kept, as are refs whose tree is checked out elsewhere, e.g. in another
+  vendor dir sharing the store.
+  """
+  removed_paths = set(os.path.abspath(c.path) for c in removed)
+  vendored = set(
+      resolver.canonical_name(name) for name in os.listdir(vendor_dir)
+      if not name.startswith('.') and
+      os.path.abspath(os.path.join(vendor_dir, name)) not in removed_paths)
+  checked_out = set(
+      tree for dest, tree in store.checkouts().items()
+      if dest not in removed_paths and os.path.isdir(dest))
+  return [
+      ref for ref in store.list_refs()
+      if resolver.canonical_name(ref.package) not in roots | vendored and
+      ref.tree not in checked_out
+  ]
+
+
+def move_to_trash(vendor_dir: str, candidates: List[Candidate]) -> str:
+  """Renames the candidates into the trash dir and returns its path."""
+  trash_dir = os.path.join(vendor_dir, TRASH_DIR_NAME)
+  os.makedirs(trash_dir, exist_ok=True)
+  stamp = '%d.%d' % (time.time(), os.getpid())
+  for candidate in candidates:
+    os.rename(candidate.path,
+              os.path.join(trash_dir, '%s.%s' % (candidate.package, stamp)))
+  manifest_path = os.path.join(vendor_dir, manifest.MANIFEST_FILE_NAME)
+  if candidates and os.path.isfile(manifest_path):
+    vendor_manifest = manifest.Manifest(manifest_path)
+    for candidate in candidates:
+      vendor_manifest.remove(candidate.package)
+    vendor_manifest.save()
+  record_path = os.path.join(vendor_dir, integrity.RECORD_FILE_NAME)
+  if candidates and os.path.isfile(record_path):
+    record = integrity.IntegrityRecord(record_path)
+    for candidate in candidates:
+      record.remove(candidate.package)
+    record.save()
+  return trash_dir
+
+
+def purge(trash_dir: str, jobs: int = DEFAULT_PURGE_JOBS):
+  """Deletes everything in the trash dir, several trees at a time."""
+  if not os.path.isdir(trash_dir):
+    return
+  paths = [os.path.join(trash_dir, name) for name in os.listdir(trash_dir)]
+
+  def remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+      shutil.rmtree(path, ignore_errors=True)
+    else:
+      os.remove(path)
+
+  with ThreadPoolExecutor(max_workers=jobs) as executor:
+    list(executor.map(remove, paths))
+
+
+def purge_in_background(trash_dir: str, jobs: int = DEFAULT_PURGE_JOBS):
+  """Starts a detached process that purges the trash dir."""
+  subprocess.Popen(
+      [sys.executable, os.path.abspath(__file__), trash_dir, str(jobs)],
+      stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+      stderr=subprocess.DEVNULL, start_new_session=True)
+
+
+def collect(vendor_dir: str, root_paths: Iterable[str], dry_run: bool = False,
+            free_bytes: Optional[int] = None, jobs: int = DEFAULT_PURGE_JOBS,
+            background: bool = True,
+            store_dir: Optional[str] = None) -> List[Candidate]:
+  """Removes (or with dry_run, reports) unreachable package dirs.
+
+  With store_dir, the content store's refs, trees and objects that only the
+  removed packages used are deleted too. Returns the candidates that were
+  (or would be) removed.
+  """
+  roots = collect_roots(root_paths)
+  store = None
+  if store_dir and os.path.isdir(store_dir):
+    store = content_store.ContentStore(store_dir)
+  candidates = find_garbage(vendor_dir, roots, jobs, store)
+  selected = select(candidates, free_bytes)
+  for candidate in selected:
+    print('%s %s (%s reclaimable)' % (
+        'Would remove' if dry_run else 'Removing', candidate.path,
+        mirror_cache.format_size(candidate.reclaimable_bytes)))
+  freed = freed_bytes(selected, candidates)
+  print('%d of %d unused packages, %s reclaimable of %s' % (
+      len(selected), len(candidates), mirror_cache.format_size(freed),
+      mirror_cache.format_size(sum(c.bytes for c in selected))))
+  if free_bytes is not None and freed < free_bytes:
+    print('Not enough unused packages to free %s' %
+          mirror_cache.format_size(free_bytes))
+  refs = dead_refs(store, vendor_dir, roots, selected) if store else []
+  if dry_run:
+    if refs:
+      print('Would remove %d store refs' % len(refs))
+    return selected
+  trash_dir = move_to_trash(vendor_dir, selected)
+  if store is not None:
+    for ref in refs:
+      store.remove_ref(ref.package, ref.version)
+    stats = store.sweep()
+    print('Removed %d refs, %d trees and %d objects (%s) from the store' % (
+        len(refs), stats.trees, stats.objects,
+        mirror_cache.format_size(stats.bytes)))
+  if background:
+    purge_in_background(trash_dir, jobs)
+  else:
+    purge(trash_dir, jobs)
+  return selected
+
+
+if __name__ == '__main__':
+  # Background purge: vendor_gc.py TRASH_DIR [JOBS]
+  purge(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else
+        DEFAULT_PURGE_JOBS)
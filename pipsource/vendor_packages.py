@@ -3,20 +3,57 @@
 
 # TODO: better heuristics
 # Common issues I had importing packages were:
-# - version tags are often either "v%s" or "package-%s" formatted, and those
-#   could be auto-detected.
-# - some packages don't use tags at all. We should check if the HEAD of the
-#   master branch happens to be the version we are looking for, if so,
-#   add a commit for that to the version commit map
 # - would be nice to be able to auto-detect bitbucket hg repos.
 
+import argparse
 import json
 import os
 import re
+import shutil
 import stat
 import subprocess
 import sys
-from urllib import request
+import tempfile
+import threading
+
+try:
+  from . import content_store
+  from . import daemon
+  from . import integrity
+  from . import manifest
+  from . import mirror_cache
+  from . import package_map_store
+  from . import pipeline
+  from . import pipenv_graph
+  from . import prune
+  from . import pypi_util
+  from . import remote_refs
+  from . import requirements
+  from . import resolver
+  from . import shared_checkout
+  from . import tracing
+  from . import venv_snapshot
+  from . import version_probe
+  from . import wheel_cache
+except ImportError:
+  import content_store
+  import daemon
+  import integrity
+  import manifest
+  import mirror_cache
+  import package_map_store
+  import pipeline
+  import pipenv_graph
+  import prune
+  import pypi_util
+  import remote_refs
+  import requirements
+  import resolver
+  import shared_checkout
+  import tracing
+  import venv_snapshot
+  import version_probe
+  import wheel_cache
 
 PACKAGE_MAP_FILE = (
     os.path.expanduser('~/ndotfiles/install/third_party/pip/package_map.json'))
@@ -25,134 +62,404 @@ PIP_VENDOR_DIR = os.path.expanduser('~/ndotfiles/third_party/pip/')
 
 INSTALL_SCRIPT_NAME = 'install_venv_vendored.sh'
 
+VENV_NAME = '.venv-vendored'
+
+MIRROR_CACHE_DIR = os.path.expanduser('~/.pipsource/mirrors')
+
+MIRROR_CACHE_MAX_BYTES = mirror_cache.DEFAULT_MAX_BYTES
+
+CONTENT_STORE_DIR = os.path.expanduser('~/.pipsource/store')
+
+CONTENT_STORE_LINK_MODE = 'hardlink'
+
+VERSION_CACHE_FILE = os.path.expanduser('~/.pipsource/versions.json')
+
+WHEEL_CACHE_DIR = wheel_cache.DEFAULT_CACHE_DIR
+
+GIT_DIR_CACHE_DIR = prune.DEFAULT_GIT_DIR_CACHE
+
+# Sparse checkouts of repos that packages are vendored from subdirs of.
+SHARED_CHECKOUT_DIR = shared_checkout.DEFAULT_CACHE_DIR
+
+SHARED_CHECKOUT_MAX_BYTES = shared_checkout.DEFAULT_MAX_BYTES
+
+# Where install scripts keep venv snapshots; empty to not use snapshots.
+VENV_SNAPSHOT_DIR = venv_snapshot.DEFAULT_SNAPSHOT_DIR
+
+DEPENDENCY_CACHE_FILE = os.path.expanduser('~/.pipsource/dependencies.json')
+
+REMOTE_REFS_CACHE_FILE = os.path.expanduser('~/.pipsource/remote_refs.json')
+
+# Chrome trace output file for the run, if any.
+TRACE_FILE = ''
+
+DAEMON_SOCKET = daemon.DEFAULT_SOCKET_PATH
+
+PIPELINE_STAGES = ('lookup', 'fetch', 'probe')
+
+DEFAULT_JOBS = {'lookup': 8, 'fetch': 4, 'probe': os.cpu_count() or 1}
+
+_package_map_lock = threading.Lock()
+
+_mirror_cache = None
+
+_pypi_client = None
+
+_content_store = None
+
+_manifest = None
+
+_version_probe = None
+
+_resolver = None
+
+_remote_refs = None
+
+_package_map = None
+
+_integrity_record = None
+
+# Shares work between runs served concurrently by the daemon.
+_lookup_flights = pipeline.SingleFlight()
+_fetch_flights = pipeline.SingleFlight()
+_probe_flights = pipeline.SingleFlight()
+
+# Package -> lock serializing changes to that package's vendor dir.
+_package_dir_locks = {}
+
+# Vendor requests the daemon is serving.
+_active_requests = 0
+
+# Interpreter -> its PEP 508 marker environment, or None if it can't be run.
+_marker_environments = {}
+
+# Run by a target interpreter to print its marker environment as JSON, the
+# way `packaging.markers.default_environment` works it out. It must also run
+# on Python 2.7, which has no sys.implementation.
+_MARKER_ENVIRONMENT_SCRIPT = r'''
+import json, os, platform, sys
+def format_version(info):
+  version = '%d.%d.%d' % (info[0], info[1], info[2])
+  if info[3] != 'final':
+    version += info[3][0] + str(info[4])
+  return version
+implementation = getattr(sys, 'implementation', None)
+print(json.dumps({
+    'implementation_name': (implementation.name if implementation else
+                            platform.python_implementation().lower()),
+    'implementation_version': format_version(
+        implementation.version if implementation else sys.version_info),
+    'os_name': os.name,
+    'platform_machine': platform.machine(),
+    'platform_release': platform.release(),
+    'platform_system': platform.system(),
+    'platform_version': platform.version(),
+    'python_full_version': platform.python_version(),
+    'platform_python_implementation': platform.python_implementation(),
+    'python_version': '.'.join(platform.python_version_tuple()[:2]),
+    'sys_platform': sys.platform,
+}))
+'''
+
+
+class VendorError(Exception):
+  """Some packages failed to be looked up, vendored or probed."""
+
+  def __init__(self, failures):
+    super(VendorError, self).__init__(
+        '%d packages failed' % len(failures))
+    self.failures = failures
+
 
 def _load_package_map():
-  """Loads package map from JSON file."""
-  with open(PACKAGE_MAP_FILE) as package_map_file:
-    return json.loads(package_map_file.read())
+  """Opens the package map; entries are read as they are looked up."""
+  return package_map_store.open_package_map(PACKAGE_MAP_FILE)
+
+
+def _get_package_map():
+  global _package_map
+  with _package_map_lock:
+    if _package_map is None:
+      _package_map = _load_package_map()
+    return _package_map
 
 
 def _save_package_map(package_map):
-  with open(PACKAGE_MAP_FILE, 'w') as package_map_file:
-    json.dump(package_map, package_map_file, sort_keys=True, indent=2)
-
-
-def _get_git_url(package):
-  """Retrieves GitHub page if specified for given PyPi package via PyPi API."""
-  data = request.urlopen(
-      'https://pypi.python.org/pypi/%s/json' % package).read()
-  data_parsed = json.loads(data)
-  info = data_parsed['info']
-  home_page = info.get('home_page')
-  if home_page.startswith('http://github.com'):
-    home_page = home_page.replace('http://github.com', 'https://github.com')
-  if re.match('^https://github.com/', home_page):
-    return home_page
-  description = info.get('description')
-  match = re.search('github.com\/[^\/]+/[a-zA-Z-_]+', description)
+  package_map.save()
+
+
+def _marker_environment(python_bin):
+  """Returns the environment markers of a target interpreter evaluate in.
+
+  Returns None, so that markers are evaluated for the interpreter running
+  pipsource, if python_bin can't be run.
+  """
+  with _package_map_lock:
+    if python_bin in _marker_environments:
+      return _marker_environments[python_bin]
+  try:
+    output = subprocess.check_output(
+        [python_bin, '-c', _MARKER_ENVIRONMENT_SCRIPT])
+    environment = json.loads(output.decode())
+  except (OSError, subprocess.CalledProcessError, ValueError):
+    pipeline.log('Could not run %s; evaluating environment markers for this '
+                 'interpreter instead' % python_bin)
+    environment = None
+  with _package_map_lock:
+    _marker_environments[python_bin] = environment
+  return environment
+
+
+def _python_major_version(python_bin):
+  """Returns the major version of an interpreter, e.g. 3, or None."""
+  match = re.match(r'python(\d)', os.path.basename(python_bin))
   if match:
-    return 'https://%s' % match.group(0)
-  return None
+    return int(match.group(1))
+  environment = _marker_environment(python_bin)
+  if environment is None:
+    return None
+  return int(environment['python_version'].split('.')[0])
 
 
 def _should_vendor(package, package_map, python_bin):
   package_info = package_map.get(package)
   if not package_info:
     return True
-  if python_bin == 'python3' and package_info.get('skip-vendor-python3'):
+  if package_info.get('skip-vendor'):
     return False
-  return not package_info.get('skip-vendor')
+  if not any(package_info.get('skip-vendor-python%d' % major)
+             for major in (2, 3)):
+    return True
+  major = _python_major_version(python_bin)
+  return not package_info.get('skip-vendor-python%s' % major)
 
 
 def _get_packages_and_versions(graph, package_map, python_bin):
-  """Gets list of packages given `pipenv graph --reverse --bare` string.
+  """Gets list of packages given nodes parsed by `pipenv_graph`.
 
-  It returns them such that packages with dependencies are listed after the
-  packages that depend on them.
+  It returns them such that packages are listed after the packages they
+  depend on.
   """
-  lines = graph.split('\n')
-  packages = set()
-  max_depths = {}
-  for line in lines:
-    if not line:
-      continue
-    package_match = re.search('(\s*)-?\s*([^=]+)==(\d+\.\d+(?:\.\d+)*)', line)
-    whitespace, package, version = package_match.groups()
-    depth = len(whitespace) / 2
-    max_depths[package] = max(depth, max_depths.get(package, 0))
-    packages.add((package, version))
   # Sort by max depth then by package name
-  packages = sorted(list(packages), key=lambda p: (max_depths[p[0]], p[0]))
+  packages = [(package, node.version) for package, node in sorted(
+      graph.items(), key=lambda item: (item[1].depth, item[0]))]
   packages = [
       p for p in packages if _should_vendor(p[0], package_map, python_bin)
   ]
   return packages
 
 
-def _add_packages_to_map(packages, package_map):
-  """Tries to find given packages' git paths and adds to package_map."""
-  found_all = True
-  for package in packages:
+def _get_pinned_packages(pipenv_dir, package_map, python_bin):
+  """Reads the project's pinned packages from Pipfile.lock/requirements.txt.
+
+  Returns None if the project has neither file. Names are matched to the
+  package map's spelling since lockfiles use normalized lowercase names.
+  """
+  lock_path = os.path.join(pipenv_dir, 'Pipfile.lock')
+  requirements_path = os.path.join(pipenv_dir, 'requirements.txt')
+  if not os.path.isfile(lock_path) and not os.path.isfile(requirements_path):
+    return None
+  environment = _marker_environment(python_bin)
+  if os.path.isfile(lock_path):
+    pins = resolver.read_pipfile_lock(lock_path, environment)
+  else:
+    pins = [(r.package, r.version)
+            for r in requirements.parse(requirements_path)
+            if requirements.applies(r, environment)]
+  pins = [(package_map.find(p) or p, v) for p, v in pins]
+  return [p for p in pins if _should_vendor(p[0], package_map, python_bin)]
+
+
+def _order_install_lines(packages_and_versions, install_lines, package_map,
+                         python_bin, versioned=()):
+  """Orders install lines by dependency level, dependencies first."""
+  with tracing.span('resolve'):
+    return _resolve_install_order(
+        packages_and_versions, install_lines, package_map,
+        _marker_environment(python_bin), versioned)
+
+
+def _resolve_install_order(packages_and_versions, install_lines, package_map,
+                           environment, versioned=()):
+  vendor_manifest = _get_manifest()
+  package_dirs = {}
+  cache_keys = {}
+  extra_requires = {}
+  for package, version in packages_and_versions:
+    name = _vendor_name(package, version,
+                        versioned=(package, version) in versioned)
+    package_dirs[package] = _get_package_dir(name)
+    entry = vendor_manifest.get(name)
+    if entry:
+      cache_keys[package] = entry.tree
+    extra_requires[package] = package_map.get(package, {}).get(
+        'install_requires', [])
+  dep_resolver = _get_resolver()
+  levels = dep_resolver.resolve(packages_and_versions, package_dirs,
+                                cache_keys, extra_requires, environment)
+  dep_resolver.save()
+
+  lines_by_package = {
+      package: line
+      for (package, _), line in zip(packages_and_versions, install_lines)
+  }
+  ordered_lines = []
+  for index, level in enumerate(levels):
+    ordered_lines.append('# Dependency level %d' % index)
+    ordered_lines += [lines_by_package[package] for package, _ in level]
+  return ordered_lines
+
+
+def _add_package_to_map(package, package_map):
+  """Looks up the package's git path and adds it to package_map if missing."""
+  with _package_map_lock:
     if package in package_map:
-      continue
-    git_page = _get_git_url(package)
-    if git_page:
-      package_map[package] = {'git': git_page}
-    else:
-      print("Git page not found for package: %s" % package)
-      found_all = False
-  return found_all
+      return
+  git_page = pypi_util.get_git_url(package, client=_pypi_client)
+  if not git_page:
+    raise LookupError("Git page not found for package: %s" % package)
+  with _package_map_lock:
+    package_map.setdefault(package, {'git': git_page})
+
 
+def _vendor_name(package, version, versioned=False):
+  """Returns the name of the package's dir in the vendor dir.
 
-def _get_package_dir(package, version):
+  versioned is for a version that projects vendored together need besides
+  the package's main one; it gets a dir of its own, e.g. "six@1.11.0".
+  """
+  return '%s@%s' % (package, version) if versioned else package
+
+
+def _get_package_dir(name):
   # I used to use "os.path.join(PIP_VENDOR_DIR, package, version)" in case I
   # would need more than one version of a particular package at a given time,
   # but I later decided that I would try to avoid that to simplify the process
-  # of reviewing updates to packages.
-  del version  # Unused
-  return os.path.join(PIP_VENDOR_DIR, package)
+  # of reviewing updates to packages. Other versions that were vendored before
+  # stay in the content store, so switching back to them is cheap. Only when
+  # projects vendored together need different versions do the others get
+  # their own dirs (see _vendor_name).
+  return os.path.join(PIP_VENDOR_DIR, name)
+
+
+def _get_mirror_cache():
+  global _mirror_cache
+  with _package_map_lock:
+    if _mirror_cache is None:
+      _mirror_cache = mirror_cache.MirrorCache(
+          MIRROR_CACHE_DIR, MIRROR_CACHE_MAX_BYTES)
+    return _mirror_cache
+
+
+def _get_content_store():
+  global _content_store
+  with _package_map_lock:
+    if _content_store is None:
+      _content_store = content_store.ContentStore(
+          CONTENT_STORE_DIR, CONTENT_STORE_LINK_MODE)
+    return _content_store
+
+
+def _get_manifest():
+  global _manifest
+  with _package_map_lock:
+    if _manifest is None:
+      _manifest = manifest.Manifest(
+          os.path.join(PIP_VENDOR_DIR, manifest.MANIFEST_FILE_NAME))
+    return _manifest
+
+
+def _get_integrity_record():
+  global _integrity_record
+  with _package_map_lock:
+    if _integrity_record is None:
+      _integrity_record = integrity.IntegrityRecord(
+          os.path.join(PIP_VENDOR_DIR, integrity.RECORD_FILE_NAME))
+    return _integrity_record
+
 
+def _get_version_probe():
+  global _version_probe
+  with _package_map_lock:
+    if _version_probe is None:
+      _version_probe = version_probe.VersionProbe(VERSION_CACHE_FILE)
+    return _version_probe
 
-def _vendor_hg_package(package, version, label, hg_url):
+
+def _get_resolver():
+  global _resolver
+  with _package_map_lock:
+    if _resolver is None:
+      _resolver = resolver.Resolver(DEPENDENCY_CACHE_FILE)
+    return _resolver
+
+
+def _get_remote_refs():
+  global _remote_refs
+  with _package_map_lock:
+    if _remote_refs is None:
+      _remote_refs = remote_refs.RemoteRefs(REMOTE_REFS_CACHE_FILE)
+    return _remote_refs
+
+
+def _get_package_dir_lock(package):
+  with _package_map_lock:
+    return _package_dir_locks.setdefault(package, threading.Lock())
+
+
+def _git_output(args, cwd):
+  return tracing.check_output(['git'] + args, cwd=cwd).decode().strip()
+
+
+def _vendor_hg_package(package, version, label, hg_url, package_dir):
+  """Checks out the hg tag into package_dir and returns its node id."""
   label_type, label_value = label
   if label_type != 'tag':
     raise ValueError('hg vendoring expects a tag')
   hg_tag = label_value
-  package_dir = _get_package_dir(package, version)
   if (os.path.isdir(package_dir) and
       os.path.isdir(os.path.join(package_dir, '.hg'))):
-    tag = subprocess.check_output(
+    tag = tracing.check_output(
         ['hg', 'log', '-r', '.', '--template', '{latesttag}'], cwd=package_dir)
     tag = tag.decode().strip()
-    if tag == hg_tag:
-      return
-    setup_py_version = subprocess.check_output(
-        ['python', 'setup.py', '--version'], cwd=package_dir)
-    setup_py_version = setup_py_version.decode().strip()
-    if setup_py_version == version:
-      return
-  subprocess.run(['rm', '-rf', package_dir])
-  hg_cmd = ['hg', 'clone', '-r', hg_tag, hg_url, package_dir]
-  subprocess.run(hg_cmd, check=True)
+    if (tag == hg_tag or
+        _get_version_probe().probe(package_dir).version == version):
+      # Bring back files an earlier run pruned.
+      pipeline.run_command(['hg', 'revert', '--quiet', '--all', '--no-backup'],
+                           check=True, cwd=package_dir)
+      return _hg_node(package_dir)
+  pipeline.run_command(['rm', '-rf', package_dir])
+  with _get_mirror_cache().hg_mirror(hg_url, hg_tag) as mirror_dir:
+    hg_cmd = ['hg', 'clone', '-r', hg_tag, mirror_dir, package_dir]
+    with tracing.span('checkout'):
+      pipeline.run_command(hg_cmd, check=True)
+  # Point the checkout back at the real source rather than the local mirror.
+  with open(os.path.join(package_dir, '.hg', 'hgrc'), 'w') as hgrc:
+    hgrc.write('[paths]\ndefault = %s\n' % hg_url)
+  return _hg_node(package_dir)
+
+
+def _hg_node(package_dir):
+  node = tracing.check_output(
+      ['hg', 'log', '-r', '.', '--template', '{node}'], cwd=package_dir)
+  return node.decode().strip()
 
 
-def _vendor_git_package(package, version, label, git_url):
+def _vendor_git_package(package, version, label, git_url, package_dir):
+  """Checks out the git label into package_dir and returns its commit."""
   label_type, label_value = label
-  package_dir = _get_package_dir(package, version)
-  git_dir = os.path.join(package_dir, '.git')
-  git_moved_dir = os.path.join(package_dir, '.git-moved')
   clone_needed = True
 
   if os.path.isdir(package_dir):
-    subprocess.run(['mv', git_moved_dir, git_dir], stderr=subprocess.DEVNULL)
-    if os.path.isdir(os.path.join(package_dir, '.git')):
+    if prune.restore_git_dir(package_dir, GIT_DIR_CACHE_DIR):
       if label_type == 'tag':
-        tag = subprocess.check_output(
-            ['git', 'describe', '--tags', '--exact-match'], cwd=package_dir)
-        tag = tag.decode().strip()
+        tag = tracing.run_subprocess(
+            ['git', 'describe', '--tags', '--exact-match'], cwd=package_dir,
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        tag = tag.stdout.decode().strip()
         clone_needed = tag != label_value
       elif label_type == 'commit':
-        commit = subprocess.check_output(
+        commit = tracing.check_output(
             ['git', 'rev-parse', '--verify', 'HEAD'], cwd=package_dir)
         commit = commit.decode().strip()
         clone_needed = commit != label_value
@@ -160,105 +467,385 @@ def _vendor_git_package(package, version, label, git_url):
         raise ValueError('Unexpected label type %s' % label_type)
 
   if clone_needed:
-    # Remove the directory contents to make cloning easy (could do a git fetch
-    # / checkout but this is simpler and easier).
-    subprocess.run(['rm', '-rf', package_dir])
-    os.makedirs(package_dir, exist_ok=True)
-    git_cmd = ['git', 'clone']
-    if label_type == 'tag':
-      git_cmd += ['--depth', '1', '--branch', label_value]
-    git_cmd += [git_url, package_dir]
-    subprocess.run(git_cmd, check=True)
-    if label_type == 'commit':
-      subprocess.run(
-          ['git', 'checkout', label_value], check=True, cwd=package_dir)
+    # Remove the directory contents to make fetching easy. Only the one
+    # commit is fetched, from the local mirror, so only the mirror update (if
+    # any) touches the network.
+    pipeline.run_command(['rm', '-rf', package_dir])
+    pipeline.run_command(['git', 'init', '--quiet', package_dir], check=True)
+    with _get_mirror_cache().git_mirror(git_url, label_value) as mirror_dir:
+      if label_type == 'tag':
+        refspec = '+refs/tags/%s:refs/tags/%s' % (label_value, label_value)
+      else:
+        # Resolve abbreviated hashes, which can't be fetched directly.
+        refspec = _git_output(
+            ['rev-parse', '--verify', label_value + '^{commit}'], mirror_dir)
+      with tracing.span('clone'):
+        pipeline.run_command(
+            ['git', 'fetch', '--quiet', '--depth', '1', mirror_dir, refspec],
+            check=True, cwd=package_dir)
+    with tracing.span('checkout'):
+      pipeline.run_command(
+          ['git', 'checkout', '--quiet', 'FETCH_HEAD'], check=True,
+          cwd=package_dir)
+    pipeline.run_command(
+        ['git', 'remote', 'add', 'origin', git_url], check=True,
+        cwd=package_dir)
+  else:
+    # Bring back files an earlier run pruned.
+    pipeline.run_command(['git', 'checkout', '--quiet', 'HEAD', '--', '.'],
+                         check=True, cwd=package_dir)
+  commit = _git_output(['rev-parse', '--verify', 'HEAD'], package_dir)
   # This makes git think this is just a regular directory so I can check it in,
   # but it preserves the .git folder in another location so I can move it back
   # to check the revision it's at.
-  subprocess.run(['mv', git_dir, git_moved_dir], stderr=subprocess.DEVNULL)
+  prune.stash_git_dir(package_dir, GIT_DIR_CACHE_DIR)
+  return commit
+
+
+def _vendor_git_subdir_package(package, version, label, git_url, subdir,
+                               package_dir):
+  """Copies subdir of the git label into package_dir; returns its commit.
+
+  The repo is checked out once per commit, sparsely, and shared with the
+  other packages vendored from it.
+  """
+  label_value = label[1]
+  with _get_mirror_cache().git_mirror(git_url, label_value) as mirror_dir:
+    commit = _git_output(
+        ['rev-parse', '--verify', label_value + '^{commit}'], mirror_dir)
+    with shared_checkout.ensure(SHARED_CHECKOUT_DIR, git_url, commit, subdir,
+                                mirror_dir) as source_dir:
+      pipeline.run_command(['rm', '-rf', package_dir])
+      # The store import replaces the files with links to its own copies, so
+      # linking them from the checkout costs no extra disk until then.
+      with tracing.span('checkout'):
+        shutil.copytree(
+            source_dir, package_dir, symlinks=True,
+            copy_function=lambda src, dest: content_store.link_file(
+                src, dest, CONTENT_STORE_LINK_MODE))
+  shared_checkout.evict(SHARED_CHECKOUT_DIR, SHARED_CHECKOUT_MAX_BYTES)
+  prune.discard_git_dir(package_dir, GIT_DIR_CACHE_DIR)
+  return commit
 
 
 def _get_version_label(package, version, package_info):
+  """Returns the label the package map gives version, or None if it has none.
+
+  A commit pinned for this exact version wins over a tag format.
+  """
+  version_commits = package_info.get('version-commits', {})
+  if version in version_commits:
+    return ('commit', version_commits[version])
   if 'version-tag-format' in package_info:
     version_tag_format = package_info['version-tag-format']
     return ('tag', version_tag_format % version)
   elif 'version-tags' in package_info:
     version_tags = package_info['version-tags']
     return ('tag', version_tags.get(version, version))
-  elif 'version-commits' in package_info:
-    version_commits = package_info['version-commits']
-    return ('commit', version_commits[version])
-  return ('tag', version)
+  return None
 
 
-def _vendor_package(package, version, package_info):
-  print("Vendoring %s version %s" % (package, version))
-  label = _get_version_label(package, version, package_info)
+def _head_has_version(git_url, head, version, subdir=None):
+  """Whether the default branch HEAD statically declares version."""
+  with _get_mirror_cache().git_mirror(git_url, head) as mirror_dir:
+    export_dir = tempfile.mkdtemp(prefix='pipsource-head-')
+    try:
+      remote_refs.export_commit(mirror_dir, head, export_dir, subdir)
+      info = version_probe.detect(export_dir)
+    finally:
+      shutil.rmtree(export_dir, ignore_errors=True)
+  return info is not None and info.version == version
+
+
+def _detect_version_label(package, version, package_info):
+  """Finds version's label from the repo's tags, or failing that its HEAD.
+
+  Returns the label and the package map fields that record how it was found.
+  """
   git_url = package_info.get('git')
+  refs_cache = _get_remote_refs()
   if git_url:
-    _vendor_git_package(package, version, label, git_url)
-    return
+    refs = refs_cache.git_refs(git_url)
+    tag_format = remote_refs.find_tag_format(package, version, refs.tags)
+    if tag_format is None:
+      # The cached listing may predate the release.
+      refs = refs_cache.git_refs(git_url, refresh=True)
+      tag_format = remote_refs.find_tag_format(package, version, refs.tags)
+  else:
+    hg_url = package_info['hg']
+    with _get_mirror_cache().hg_mirror(hg_url) as mirror_dir:
+      refs = refs_cache.hg_refs(hg_url, mirror_dir, refresh=True)
+    tag_format = remote_refs.find_tag_format(package, version, refs.tags)
+
+  if tag_format is not None:
+    pipeline.log('Detected tag format "%s" for %s' % (tag_format, package))
+    return ('tag', tag_format % version), {'version-tag-format': tag_format}
+  if git_url and refs.head and _head_has_version(
+      git_url, refs.head, version, shared_checkout.subdir_for(package_info)):
+    pipeline.log('No tag for %s version %s, using default branch commit %s' %
+                 (package, version, refs.head))
+    version_commits = dict(package_info.get('version-commits', {}))
+    version_commits[version] = refs.head
+    return ('commit', refs.head), {'version-commits': version_commits}
+  raise LookupError('No tag or default branch commit for %s version %s' %
+                    (package, version))
+
+
+def _resolve_version_label(package, version, package_map):
+  """Returns version's label, writing any detected format to package_map."""
+  with _package_map_lock:
+    package_info = dict(package_map[package])
+  label = _get_version_label(package, version, package_info)
+  if label is not None:
+    return label
+  with tracing.span('detect-label'):
+    label, fields = _detect_version_label(package, version, package_info)
+  with _package_map_lock:
+    package_map[package].update(fields)
+  return label
+
+
+def _vendor_package(package, version, package_info, label, name=None):
+  """Vendors the package; returns what pruning its checkout removed, if any.
+
+  name is its dir in the vendor dir, by default the package's own.
+  """
+  pipeline.log("Vendoring %s version %s" % (package, version))
+  name = name or package
+  package_dir = _get_package_dir(name)
+  git_url = package_info.get('git')
   hg_url = package_info.get('hg')
-  if hg_url:
-    _vendor_hg_package(package, version, label, hg_url)
-    return
-  print("No hg or git URL for package %s" % package)
-  sys.exit(1)
+  source = git_url or hg_url
+  if not source:
+    raise ValueError("No hg or git URL for package %s" % package)
+  subdir = shared_checkout.subdir_for(package_info)
+  if subdir and not git_url:
+    raise ValueError('"subdir" is only supported for git packages')
+  rules = prune.rules_for(package_info)
+  # Trees are recorded under the prune rules and subdir too, so that changing
+  # either vendors the package again.
+  tree_label = prune.label_with_rules(label, rules)
+  if subdir:
+    tree_label.append('subdir:%s' % subdir)
 
+  vendor_manifest = _get_manifest()
+  if vendor_manifest.is_current(name, version, source, tree_label,
+                                package_dir):
+    pipeline.log("%s version %s is up to date" % (package, version))
+    _get_content_store().touch_ref(package, version)
+    entry = vendor_manifest.get(name)
+    _record_integrity(name, entry.tree, entry.commit)
+    return None
 
-def _vendor_packages(packages_and_versions, package_map):
-  for package, version in packages_and_versions:
-    package_info = package_map[package]
-    _vendor_package(package, version, package_info)
+  stats = None
+  store = _get_content_store()
+  ref = store.get_ref(package, version, tree_label)
+  if ref:
+    store.touch_ref(package, version)
+    # This version was vendored before, so switching to it is just relinking
+    # its files from the store.
+    if store.checkout_tree(package_dir) != ref.tree:
+      pipeline.log("Linking %s version %s from the content store" %
+                   (package, version))
+      with tracing.span('materialize'):
+        store.materialize(ref.tree, package_dir)
+      # The stashed .git no longer matches the files.
+      prune.discard_git_dir(package_dir, GIT_DIR_CACHE_DIR)
+    tree, commit = ref
+  else:
+    if subdir:
+      commit = _vendor_git_subdir_package(package, version, label, git_url,
+                                          subdir, package_dir)
+    elif git_url:
+      commit = _vendor_git_package(package, version, label, git_url,
+                                   package_dir)
+    else:
+      commit = _vendor_hg_package(package, version, label, hg_url,
+                                  package_dir)
+    if rules is not None:
+      with tracing.span('prune'):
+        stats = prune.prune(package_dir, rules)
+      pipeline.log("Pruned %d files (%s) from %s" % (
+          stats.files, mirror_cache.format_size(stats.bytes), name))
+    with tracing.span('store-import'):
+      tree = store.import_tree(package_dir)
+    store.set_ref(package, version, tree_label, tree, commit)
+    store.record_checkout(package_dir, tree)
+  vendor_manifest.record(name, version, source, tree_label, commit, tree,
+                         package_dir)
+  _record_integrity(name, tree, commit)
+  return stats
 
 
-def _get_install_line(package, version):
-  package_dir = _get_package_dir(package, version)
-  need_git_tag = False
+def _record_integrity(name, tree, commit):
+  """Records the file hashes of a vendored tree for `pipsource verify`."""
+  record = _get_integrity_record()
+  entry = record.get(name)
+  if entry and entry['tree'] == tree and entry['commit'] == commit:
+    return
   try:
-    print("Checking if git version tag needed for %s" % package)
-    subprocess.run(
-        ['python', 'setup.py', '--version'],
-        cwd=package_dir,
-        check=True,
-        stdout=subprocess.DEVNULL,
-        stderr=subprocess.DEVNULL)
-  except subprocess.CalledProcessError:
-    need_git_tag = True
-  line = 'pip_install_vendored %s "%s"' % (package, version)
+    stored_tree = _get_content_store().read_tree(tree)
+  except OSError:
+    pipeline.log("Tree of %s is not in the content store; not recording its "
+                 "file hashes" % name)
+    return
+  record.record(name, tree, commit, stored_tree)
+
+
+def _get_install_line(package, version, name=None, python_bin='python'):
+  name = name or package
+  package_dir = _get_package_dir(name)
+  entry = _get_manifest().get(name)
+  tree = entry.tree if entry and entry.version == version else None
+  pipeline.log("Checking if git version tag needed for %s" % package)
+  # Packages that take their version from VCS metadata can't work it out
+  # once .git is moved away, so the install needs to supply the tag.
+  with tracing.span('version-probe'):
+    need_git_tag = _get_version_probe().probe(
+        package_dir, tree, python_bin).scm
+  key = wheel_cache.source_key(
+      package, version, tree, entry.commit if entry else None)
+  line = 'pip_wheel_vendored %s "%s" %s' % (name, version, key)
   if need_git_tag:
     line += ' git_version_tag'
   return line
 
 
-def _write_install_script(packages_and_versions, pipenv_dir, python_bin):
+def _write_install_script(install_lines, pipenv_dir, python_bin,
+                          script_name=INSTALL_SCRIPT_NAME,
+                          venv_name=VENV_NAME):
+  with tracing.span('write-script'):
+    script_path = _write_script_file(
+        install_lines, pipenv_dir, python_bin, script_name, venv_name)
+  print('Wrote install script %s' % script_path)
+  return script_path
+
+
+def _write_script_file(install_lines, pipenv_dir, python_bin,
+                       script_name=INSTALL_SCRIPT_NAME, venv_name=VENV_NAME):
+  snapshot_packages = venv_snapshot.packages_from_install_lines(install_lines)
   script_lines = [
       '#!/usr/bin/env bash',
       'set -e',
-      'source ~/ndotfiles/scripts/venv_vendor_util.sh',
-      'virtualenv --no-download .venv-vendored --python=$(which %s)' %
-      python_bin,
-      'source .venv-vendored/bin/activate',
+      'PIP_VENDOR_DIR="%s"' % os.path.abspath(PIP_VENDOR_DIR),
+      'PIP_WHEEL_CACHE="%s"' % os.path.abspath(WHEEL_CACHE_DIR),
+      'PIPSOURCE_PYTHON=$(which %s)' % python_bin,
+      'PIPSOURCE_VENV="$PWD/%s"' % venv_name,
+      'PIPSOURCE_SNAPSHOTS="%s"' % (
+          os.path.abspath(VENV_SNAPSHOT_DIR) if VENV_SNAPSHOT_DIR else ''),
+      'PIPSOURCE_SNAPSHOT_TOOL="%s"' % os.path.abspath(venv_snapshot.__file__),
+      'PIPSOURCE_TOOL_PYTHON="%s"' % sys.executable,
+      'PIPSOURCE_LINK_MODE=%s' % CONTENT_STORE_LINK_MODE,
+      'PIPSOURCE_PACKAGES=(%s)' % ' '.join(snapshot_packages),
   ]
-  for package, version in packages_and_versions:
-    script_lines.append(_get_install_line(package, version))
+  script_lines += wheel_cache.script_functions()
+  script_lines += venv_snapshot.script_functions()
+  script_lines.append('pipsource_prepare_venv')
+  script_lines.append('source "$PIPSOURCE_VENV/bin/activate"')
+  script_lines += install_lines
+  script_lines.append('pip_install_vendored_wheels')
+  script_lines.append('pipsource_save_venv')
+  script_lines.append('pipsource_timing_report')
   script_lines.append('deactivate')
-  script_path = os.path.join(pipenv_dir, INSTALL_SCRIPT_NAME)
+  script_path = os.path.join(pipenv_dir, script_name)
   with open(script_path, 'w') as script_file:
     script_file.write('\n'.join(script_lines))
   script_stat = os.stat(script_path)
   os.chmod(script_path, script_stat.st_mode | stat.S_IEXEC)
-  print('Wrote install script %s' % script_path)
+  return script_path
 
 
-def main():
-  """Runs the vendor utility."""
-  pipenv_dir = sys.argv[1]
-  if len(sys.argv) > 2:
-    python_bin = sys.argv[2]
-  else:
-    python_bin = 'python'
+def _fetch_package(package, version, package_map, name):
+  label = _resolve_version_label(package, version, package_map)
+  with _package_map_lock:
+    package_info = dict(package_map[package])
+  # Another run in the daemon may be vendoring a different version.
+  with _get_package_dir_lock(name):
+    return _vendor_package(package, version, package_info, label, name)
+
+
+def _run_pipeline(packages_and_versions, package_map, jobs, versioned=(),
+                  output=print, python_bins=None):
+  """Looks up, vendors and probes each package, returning install lines.
+
+  The (package, version) pairs in versioned are vendored into dirs of their
+  own (see _vendor_name). python_bins maps pairs to the interpreter a target
+  installs them with, for probes that have to run setup.py. Progress lines are
+  passed to output. Raises VendorError if any package fails; the
+  package map is saved either way so that successful lookups are not
+  repeated on the next run. Work that a concurrent run is already doing for
+  the same package is shared.
+  """
+
+  def name_of(package_and_version):
+    return _vendor_name(*package_and_version,
+                        versioned=package_and_version in versioned)
 
+  def lookup(package_and_version):
+    package = package_and_version[0]
+    _lookup_flights.do(
+        package, lambda: _add_package_to_map(package, package_map))
+    return package_and_version
+
+  pruned = []
+
+  def fetch(package_and_version):
+    package, version = package_and_version
+    name = name_of(package_and_version)
+    stats = _fetch_flights.do(
+        (package, version, name),
+        lambda: _fetch_package(package, version, package_map, name))
+    if stats is not None:
+      pruned.append(stats)
+    return package_and_version
+
+  def probe(package_and_version):
+    name = name_of(package_and_version)
+    python_bin = (python_bins or {}).get(package_and_version, 'python')
+    return _probe_flights.do(
+        package_and_version + (name,),
+        lambda: _get_install_line(*package_and_version, name=name,
+                                  python_bin=python_bin))
+
+  stages = [
+      pipeline.Stage('lookup', lookup, jobs['lookup']),
+      pipeline.Stage('fetch', fetch, jobs['fetch']),
+      pipeline.Stage('probe', probe, jobs['probe']),
+  ]
+  results = pipeline.run(packages_and_versions, stages, label=lambda p: p[0],
+                         output=output)
+  _save_package_map(package_map)
+  _get_manifest().save()
+  _get_integrity_record().save()
+  _get_version_probe().save()
+  _get_remote_refs().save()
+  if pruned:
+    output('Pruned %d files (%s) from %d packages' % (
+        sum(s.files for s in pruned),
+        mirror_cache.format_size(sum(s.bytes for s in pruned)), len(pruned)))
+
+  failures = [r for r in results if r.error is not None]
+  for result in failures:
+    output('Failed to %s %s: %s' %
+           (result.failed_stage, result.item[0], result.error))
+  if any(r.failed_stage == 'lookup' for r in failures):
+    output("Could not find git links for all packages in graph")
+  if failures:
+    raise VendorError(failures)
+  return [r.value for r in results]
+
+
+def _report_timing(trace_file):
+  """Prints where the run spent its time and exports the trace if asked."""
+  for line in tracing.tracer().summary_lines():
+    print(line)
+  if trace_file:
+    tracing.tracer().write_chrome_trace(trace_file)
+    print('Wrote trace %s' % trace_file)
+
+
+def _get_pipenv_graph_packages(pipenv_dir, package_map, python_bin):
+  """Falls back to pipenv for projects without a lockfile to read."""
   # Do a pipenv install first if needed.
   if not os.path.isdir(os.path.join(pipenv_dir, '.venv')):
     pipenv_env = os.environ.copy()
@@ -268,22 +855,330 @@ def main():
         cwd=pipenv_dir,
         env=pipenv_env)
 
-  package_map = _load_package_map()
+  graph = pipenv_graph.read_pipenv_graph(pipenv_dir)
+  return _get_packages_and_versions(graph, package_map, python_bin)
 
-  graph = subprocess.check_output(
-      ['pipenv', 'graph', '--reverse', '--bare'], cwd=pipenv_dir)
-  graph = graph.decode()
-  packages_and_versions = _get_packages_and_versions(graph, package_map,
-                                                     python_bin)
-  packages = [p[0] for p in packages_and_versions]
-  all_packages_in_map = _add_packages_to_map(packages, package_map)
-  _save_package_map(package_map)
-  if not all_packages_in_map:
-    print("Could not find git links for all packages in graph")
+
+def plan_project(pipenv_dir, python_bin):
+  """Returns the (package, version) pairs the project needs vendored."""
+  package_map = _get_package_map()
+  packages_and_versions = _get_pinned_packages(
+      pipenv_dir, package_map, python_bin)
+  if packages_and_versions is None:
+    packages_and_versions = _get_pipenv_graph_packages(
+        pipenv_dir, package_map, python_bin)
+  return packages_and_versions
+
+
+def read_batch_file(path):
+  """Reads (project dir, interpreter) targets from a batch file.
+
+  Each line names a project dir, relative to the batch file, and the
+  interpreters to vendor it for, e.g. "services/api python2 python3". Without
+  interpreters, "python" is used.
+  """
+  base_dir = os.path.dirname(os.path.abspath(path))
+  targets = []
+  with open(path) as batch_file:
+    for line in batch_file:
+      parts = line.split('#', 1)[0].split()
+      if not parts:
+        continue
+      project_dir = os.path.join(base_dir, os.path.expanduser(parts[0]))
+      for python_bin in parts[1:] or ['python']:
+        targets.append((project_dir, python_bin))
+  return targets
+
+
+def _script_and_venv_names(targets):
+  """Names each target's install script and venv.
+
+  Projects vendored for several interpreters get one script and venv per
+  interpreter, e.g. install_venv_vendored_python3.sh.
+  """
+  interpreters = {}
+  for pipenv_dir, python_bin in targets:
+    interpreters.setdefault(os.path.abspath(pipenv_dir), []).append(python_bin)
+  names = {}
+  for pipenv_dir, python_bin in targets:
+    if len(interpreters[os.path.abspath(pipenv_dir)]) == 1:
+      names[(pipenv_dir, python_bin)] = (INSTALL_SCRIPT_NAME, VENV_NAME)
+      continue
+    suffix = re.sub(r'[^\w.-]', '_', os.path.basename(python_bin))
+    names[(pipenv_dir, python_bin)] = (
+        '%s_%s.sh' % (os.path.splitext(INSTALL_SCRIPT_NAME)[0], suffix),
+        '%s-%s' % (VENV_NAME, suffix))
+  return names
+
+
+def _union_of_plans(plans):
+  """Merges the targets' package lists, settling conflicting versions.
+
+  When targets need different versions of a package, the version most of
+  them need (the first seen on a tie) gets the package's dir and the others
+  get dirs of their own. Returns the union of the targets' packages, in
+  first-seen order, their plans with each package spelled the same way
+  throughout, and the set of (package, version) pairs vendored into dirs of
+  their own.
+  """
+  spellings = {}
+  versions = {}
+  for target, plan in plans.items():
+    for package, version in plan:
+      key = resolver.canonical_name(package)
+      spellings.setdefault(key, package)
+      versions.setdefault(key, {}).setdefault(version, []).append(target)
+  versioned = set()
+  for key, needed_by in versions.items():
+    # Sorting is stable, so ties keep first-seen order.
+    ranked = sorted(needed_by, key=lambda version: -len(needed_by[version]))
+    versioned.update((spellings[key], version) for version in ranked[1:])
+  plans = {
+      target: [(spellings[resolver.canonical_name(p)], v) for p, v in plan]
+      for target, plan in plans.items()
+  }
+  union = []
+  for plan in plans.values():
+    for package_and_version in plan:
+      if package_and_version not in union:
+        union.append(package_and_version)
+  return union, plans, versioned
+
+
+def vendor_batch(targets, jobs, output=print):
+  """Vendors the packages of several (project dir, interpreter) targets.
+
+  Every package version any target needs is vendored once, then each target
+  gets its own install script. Returns the script paths in target order.
+  Progress lines are passed to output.
+  """
+  package_map = _get_package_map()
+  plans = {}
+  for target in targets:
+    plans[target] = plan_project(*target)
+  union, plans, versioned = _union_of_plans(plans)
+  for package, version in sorted(versioned):
+    output('Vendoring %s %s into %s, as projects need different versions' % (
+        package, version, _vendor_name(package, version, versioned=True)))
+  python_bins = {}
+  for target in targets:
+    for package_and_version in plans[target]:
+      python_bins.setdefault(package_and_version, target[1])
+  install_lines = dict(zip(union, _run_pipeline(
+      union, package_map, jobs, versioned, output, python_bins)))
+  names = _script_and_venv_names(targets)
+  script_paths = []
+  for target in targets:
+    plan = plans[target]
+    ordered_lines = _order_install_lines(
+        plan, [install_lines[p] for p in plan], package_map, target[1],
+        versioned)
+    script_name, venv_name = names[target]
+    script_paths.append(_write_install_script(
+        ordered_lines, target[0], target[1], script_name, venv_name))
+  return script_paths
+
+
+def vendor_project(pipenv_dir, python_bin, jobs):
+  """Vendors the project's packages and returns its install script path."""
+  return vendor_batch([(pipenv_dir, python_bin)], jobs)[0]
+
+
+def _settings():
+  """The settings a daemon must share with a client to serve it."""
+  return {
+      'package_map': os.path.abspath(PACKAGE_MAP_FILE),
+      'vendor_dir': os.path.abspath(PIP_VENDOR_DIR),
+      'mirror_cache': os.path.abspath(MIRROR_CACHE_DIR),
+      'store': os.path.abspath(CONTENT_STORE_DIR),
+      'link_mode': CONTENT_STORE_LINK_MODE,
+      'wheel_cache': os.path.abspath(WHEEL_CACHE_DIR),
+      'git_dir_cache': os.path.abspath(GIT_DIR_CACHE_DIR),
+      'shared_checkouts': os.path.abspath(SHARED_CHECKOUT_DIR),
+      'venv_snapshots': VENV_SNAPSHOT_DIR,
+      'pypi_url': _pypi_client.index_url if _pypi_client else None,
+  }
+
+
+def _check_settings(message):
+  if message.get('settings') != _settings():
+    raise daemon.Unavailable('The daemon runs with different settings')
+
+
+def _revalidate():
+  """Picks up the changes other processes made since the last request.
+
+  The package map re-reads entries whose files changed. The manifest and
+  integrity record are re-read; saving merges this process's changes in.
+  """
+  _get_package_map().refresh()
+  _get_manifest().reload()
+  _get_integrity_record().reload()
+
+
+def _serve_vendor(message):
+  global _active_requests
+  _check_settings(message)
+  try:
+    jobs = pipeline.parse_jobs(
+        message.get('jobs', ''), PIPELINE_STAGES, DEFAULT_JOBS)
+  except ValueError as e:
+    raise daemon.Unavailable(str(e))
+  with _package_map_lock:
+    _active_requests += 1
+  _revalidate()
+  targets = [tuple(target) for target in message['targets']]
+  # Relayed to the client, which prints it in place of its own progress.
+  output = []
+  try:
+    script_paths = vendor_batch(targets, jobs, output.append)
+  except VendorError as e:
+    return {'scripts': [], 'output': output, 'failures': [
+        [r.failed_stage, r.item[0], str(r.error)] for r in e.failures]}
+  finally:
+    with _package_map_lock:
+      _active_requests -= 1
+      idle = not _active_requests
+    if idle:
+      # Spans would otherwise pile up for as long as the daemon runs.
+      _report_timing('')
+      tracing.reset()
+  return {'scripts': script_paths, 'output': output, 'failures': []}
+
+
+def _vendor_with_daemon(targets, jobs_spec):
+  """Has the daemon vendor the targets; exits if any package failed.
+
+  The daemon's progress output for the request is printed here, and already
+  names any failed packages.
+  """
+  result = daemon.request(DAEMON_SOCKET, {
+      'op': 'vendor',
+      'targets': [[os.path.abspath(pipenv_dir), python_bin]
+                  for pipenv_dir, python_bin in targets],
+      'jobs': jobs_spec,
+      'settings': _settings(),
+  })
+  for line in result['output']:
+    print(line)
+  if result['failures']:
     sys.exit(1)
+  for script_path in result['scripts']:
+    print('Wrote install script %s' % script_path)
+
 
-  _vendor_packages(packages_and_versions, package_map)
-  _write_install_script(packages_and_versions, pipenv_dir, python_bin)
+parser = argparse.ArgumentParser(
+    description='Vendor the packages of a pipenv project from source.')
+parser.add_argument('pipenv_dir', type=str, nargs='?',
+                    help='Project directory with a Pipfile.lock or '
+                    'requirements.txt (or a Pipfile, resolved with pipenv)')
+parser.add_argument('python_bin', type=str, nargs='?', default='python',
+                    help='Python interpreter the install script should use')
+parser.add_argument('--batch', type=str, default='',
+                    help='File listing many projects to vendor together, one '
+                    '"project_dir [python_bin ...]" per line')
+parser.add_argument('--jobs', type=str, default='',
+                    help='Concurrent workers, either one number for every '
+                    'stage or per stage, e.g. "lookup=16,fetch=4,probe=8"')
+parser.add_argument('--package-map', type=str, default=PACKAGE_MAP_FILE,
+                    help='Package map: a JSON file, or a directory of '
+                    'per-package JSON files for large, shared maps')
+parser.add_argument('--pypi-url', type=str, default=pypi_util.DEFAULT_INDEX_URL,
+                    help='Base URL of the PyPI JSON API to look packages up in')
+parser.add_argument('--mirror-cache', type=str, default=MIRROR_CACHE_DIR,
+                    help='Directory for the cached git/hg source mirrors')
+parser.add_argument('--mirror-cache-size', type=str, default='10G',
+                    help='Size cap for the mirror cache, e.g. "500M" or "20G"')
+parser.add_argument('--store', type=str, default=CONTENT_STORE_DIR,
+                    help='Directory of the content-addressed source store')
+parser.add_argument('--wheel-cache', type=str, default=WHEEL_CACHE_DIR,
+                    help='Directory the install script caches built wheels in')
+parser.add_argument('--git-dir-cache', type=str, default=GIT_DIR_CACHE_DIR,
+                    help='Directory the .git dirs of vendored checkouts are '
+                    'kept in, out of the vendor dir')
+parser.add_argument('--shared-checkouts', type=str,
+                    default=SHARED_CHECKOUT_DIR,
+                    help='Directory of the sparse checkouts shared by '
+                    'packages vendored from subdirs of one repo')
+parser.add_argument('--shared-checkouts-size', type=str, default='5G',
+                    help='Size cap for the shared checkouts, e.g. "500M"')
+parser.add_argument('--venv-snapshots', type=str, default=VENV_SNAPSHOT_DIR,
+                    help='Directory the install script keeps snapshots of '
+                    'installed venvs in, to start later installs from; '
+                    'empty to always install into a new venv')
+parser.add_argument('--link-mode', type=str, default=CONTENT_STORE_LINK_MODE,
+                    choices=content_store.LINK_MODES,
+                    help='How vendored files are materialized from the store')
+parser.add_argument('--trace', type=str, default='',
+                    help='Write a Chrome trace (JSON) of the run to this file')
+parser.add_argument('--daemon-socket', type=str, default=DAEMON_SOCKET,
+                    help='Unix socket of the pipsource daemon to send the '
+                    'run to, if one is running')
+parser.add_argument('--no-daemon', action='store_true',
+                    help='Always vendor in this process')
+parser.add_argument('--serve', action='store_true',
+                    help='Run as a daemon serving vendor requests on '
+                    '--daemon-socket, keeping caches in memory')
+
+
+def main():
+  """Runs the vendor utility."""
+  global MIRROR_CACHE_DIR, MIRROR_CACHE_MAX_BYTES, _pypi_client
+  global CONTENT_STORE_DIR, CONTENT_STORE_LINK_MODE, WHEEL_CACHE_DIR
+  global VENV_SNAPSHOT_DIR, GIT_DIR_CACHE_DIR, SHARED_CHECKOUT_DIR
+  global SHARED_CHECKOUT_MAX_BYTES
+  global TRACE_FILE, PACKAGE_MAP_FILE, DAEMON_SOCKET
+  args = parser.parse_args()
+  pipenv_dir = args.pipenv_dir
+  python_bin = args.python_bin
+  try:
+    jobs = pipeline.parse_jobs(args.jobs, PIPELINE_STAGES, DEFAULT_JOBS)
+    MIRROR_CACHE_MAX_BYTES = mirror_cache.parse_size(args.mirror_cache_size)
+    SHARED_CHECKOUT_MAX_BYTES = mirror_cache.parse_size(
+        args.shared_checkouts_size)
+  except ValueError as e:
+    parser.error(str(e))
+  MIRROR_CACHE_DIR = os.path.expanduser(args.mirror_cache)
+  CONTENT_STORE_DIR = os.path.expanduser(args.store)
+  CONTENT_STORE_LINK_MODE = args.link_mode
+  WHEEL_CACHE_DIR = os.path.expanduser(args.wheel_cache)
+  VENV_SNAPSHOT_DIR = os.path.expanduser(args.venv_snapshots)
+  GIT_DIR_CACHE_DIR = os.path.expanduser(args.git_dir_cache)
+  SHARED_CHECKOUT_DIR = os.path.expanduser(args.shared_checkouts)
+  TRACE_FILE = args.trace
+  PACKAGE_MAP_FILE = os.path.expanduser(args.package_map)
+  DAEMON_SOCKET = os.path.expanduser(args.daemon_socket)
+  tracing.reset()
+  _pypi_client = pypi_util.PypiClient(
+      index_url=args.pypi_url, max_workers=jobs['lookup'])
+
+  if args.serve:
+    daemon.serve(DAEMON_SOCKET, {
+        'vendor': _serve_vendor,
+    })
+    return
+  if args.batch:
+    targets = read_batch_file(os.path.expanduser(args.batch))
+  elif pipenv_dir:
+    targets = [(pipenv_dir, python_bin)]
+  else:
+    parser.error('pipenv_dir or --batch is required unless running with '
+                 '--serve')
+
+  if (not args.no_daemon and not TRACE_FILE and
+      os.path.exists(DAEMON_SOCKET)):
+    try:
+      _vendor_with_daemon(targets, args.jobs)
+      sys.exit(0)
+    except (daemon.DaemonUnavailable, daemon.DaemonError) as e:
+      print('Vendoring in-process: %s' % e)
+
+  try:
+    vendor_batch(targets, jobs)
+  except VendorError:
+    _report_timing(TRACE_FILE)
+    sys.exit(1)
+  _report_timing(TRACE_FILE)
 
   sys.exit(0)
 
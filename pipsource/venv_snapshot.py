@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+"""Snapshots of installed vendored venvs, reused across checkouts.
+
+After the install script has installed every vendored wheel into its venv,
+it saves a snapshot of the venv keyed by the interpreter and the ordered list
+of `package@source key` it holds. The next install with that interpreter
+clones the snapshot with the most of the wanted packages instead of starting
+from an empty venv. Cloned files are hardlinked or reflinked, and the scripts
+and config files that embed the venv's path are rewritten for the new
+location. Packages the snapshot has but the install doesn't want are
+uninstalled, and only the missing ones are built and installed.
+
+The install script runs this module as a tool (`restore` and `save`), so that
+it also works for venvs of interpreters pipsource itself can't run on.
+"""
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+from typing import Iterable
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+
+try:
+  from . import content_store
+except ImportError:
+  import content_store
+
+DEFAULT_SNAPSHOT_DIR = os.path.expanduser('~/.pipsource/venvs')
+
+# Snapshots kept per interpreter; the least recently used are removed.
+DEFAULT_MAX_SNAPSHOTS = 5
+
+METADATA_FILE_NAME = 'snapshot.json'
+
+# The package name leaves out the "@version" of a version's own vendor dir.
+_INSTALL_LINE_RE = re.compile(
+    r'pip_wheel_vendored ([^\s@]+)(?:@\S+)? "[^"]*" (\S+)')
+
+# Files that may embed the venv's absolute path, relative to the venv.
+_PREFIX_FILE_GLOBS = ('bin/*', 'pyvenv.cfg', 'lib/*/site-packages/*.pth',
+                      'lib/*/site-packages/*.egg-link')
+
+_SCRIPT_FUNCTIONS = r'''
+# Recreates $PIPSOURCE_VENV from the closest venv snapshot, or empty if there
+# is none. Packages already installed from the snapshot are added to
+# PIPSOURCE_HAVE, and ones it has but that aren't wanted are uninstalled.
+pipsource_prepare_venv() {
+  local start kind rest stale=""
+  start=$(_pipsource_now)
+  rm -rf "$PIPSOURCE_VENV"
+  if [ -n "$PIPSOURCE_SNAPSHOTS" ] && [ -f "$PIPSOURCE_SNAPSHOT_TOOL" ]; then
+    while read -r kind rest; do
+      case "$kind" in
+        have) PIPSOURCE_HAVE="$PIPSOURCE_HAVE $rest " ;;
+        stale) stale="$rest" ;;
+      esac
+    done < <("$PIPSOURCE_TOOL_PYTHON" "$PIPSOURCE_SNAPSHOT_TOOL" restore \
+      --link-mode "$PIPSOURCE_LINK_MODE" "$PIPSOURCE_SNAPSHOTS" "$PIPSOURCE_PYTHON" "$PIPSOURCE_ABI" \
+      "$PIPSOURCE_VENV" "${PIPSOURCE_PACKAGES[@]}" || true)
+  fi
+  if [ ! -d "$PIPSOURCE_VENV" ]; then
+    virtualenv --no-download "$PIPSOURCE_VENV" --python="$PIPSOURCE_PYTHON"
+  fi
+  if [ -n "$stale" ]; then
+    # shellcheck disable=SC2086
+    "$PIPSOURCE_VENV/bin/pip" uninstall --yes $stale
+  fi
+  _pipsource_record_time venv "$PIPSOURCE_VENV" "" "$start"
+}
+
+# Saves the installed venv as a snapshot for later installs to start from.
+pipsource_save_venv() {
+  if [ -n "$PIPSOURCE_SNAPSHOTS" ] && [ -f "$PIPSOURCE_SNAPSHOT_TOOL" ]; then
+    "$PIPSOURCE_TOOL_PYTHON" "$PIPSOURCE_SNAPSHOT_TOOL" save \
+      --link-mode "$PIPSOURCE_LINK_MODE" "$PIPSOURCE_SNAPSHOTS" "$PIPSOURCE_PYTHON" "$PIPSOURCE_ABI" \
+      "$PIPSOURCE_VENV" "${PIPSOURCE_PACKAGES[@]}" ||
+      echo "Could not save a snapshot of $PIPSOURCE_VENV"
+  fi
+}
+'''.strip('\n')
+
+
+class Snapshot(NamedTuple):
+  path: str
+  python: str
+  abi: str
+  # Absolute path of the venv the snapshot was taken from.
+  prefix: str
+  # package@source key of every vendored package, in install order.
+  packages: List[str]
+  last_used: float
+
+
+def script_functions() -> List[str]:
+  """Returns the bash lines defining the install script's snapshot helpers."""
+  return _SCRIPT_FUNCTIONS.split('\n')
+
+
+def packages_from_install_lines(install_lines: Iterable[str]) -> List[str]:
+  """Returns package@source key for each wheel the install lines install."""
+  packages = []
+  for line in install_lines:
+    match = _INSTALL_LINE_RE.match(line)
+    if match:
+      packages.append('%s@%s' % match.groups())
+  return packages
+
+
+def snapshot_id(python: str, abi: str, packages: List[str]) -> str:
+  key = json.dumps([os.path.realpath(python), abi, packages])
+  return hashlib.sha256(key.encode()).hexdigest()[:32]
+
+
+def _read_snapshot(path: str) -> Optional[Snapshot]:
+  try:
+    with open(os.path.join(path, METADATA_FILE_NAME)) as metadata_file:
+      return Snapshot(path=path, **json.loads(metadata_file.read()))
+  except (OSError, ValueError, TypeError):
+    return None
+
+
+def _write_metadata(snapshot: Snapshot):
+  metadata = snapshot._asdict()
+  del metadata['path']
+  path = os.path.join(snapshot.path, METADATA_FILE_NAME)
+  tmp_path = '%s.tmp.%d' % (path, os.getpid())
+  with open(tmp_path, 'w') as metadata_file:
+    json.dump(metadata, metadata_file, sort_keys=True, indent=2)
+  os.replace(tmp_path, path)
+
+
+def list_snapshots(snapshot_dir: str, python: str, abi: str) -> List[Snapshot]:
+  """Returns the snapshots for the interpreter, most recently used first."""
+  if not os.path.isdir(snapshot_dir):
+    return []
+  python = os.path.realpath(python)
+  snapshots = []
+  for name in os.listdir(snapshot_dir):
+    snapshot = _read_snapshot(os.path.join(snapshot_dir, name))
+    if snapshot and snapshot.python == python and snapshot.abi == abi:
+      snapshots.append(snapshot)
+  return sorted(snapshots, key=lambda s: -s.last_used)
+
+
+def closest_snapshot(snapshots: List[Snapshot],
+                     packages: List[str]) -> Optional[Snapshot]:
+  """Picks the snapshot that leaves the least to install and uninstall."""
+  wanted = set(packages)
+  best = None
+  best_score = 0
+  for snapshot in snapshots:
+    have = wanted.intersection(snapshot.packages)
+    stale = len(snapshot.packages) - len(have)
+    score = len(have) - stale
+    if have and score > best_score:
+      best, best_score = snapshot, score
+  return best
+
+
+def _clone_tree(src: str, dest: str, link_mode: str):
+  for root, dirs, files in os.walk(src):
+    rel_dir = os.path.relpath(root, src)
+    dest_dir = os.path.normpath(os.path.join(dest, rel_dir))
+    os.makedirs(dest_dir, exist_ok=True)
+    shutil.copymode(root, dest_dir)
+    for name in dirs + files:
+      path = os.path.join(root, name)
+      if os.path.islink(path):
+        os.symlink(os.readlink(path), os.path.join(dest_dir, name))
+      elif name in files:
+        content_store.link_file(path, os.path.join(dest_dir, name), link_mode)
+
+
+def _fix_prefix(venv_dir: str, old_prefix: str, new_prefix: str):
+  """Rewrites the venv's path in its scripts (e.g. shebangs) and config."""
+  if old_prefix == new_prefix:
+    return
+  old = old_prefix.encode()
+  new = new_prefix.encode()
+  for pattern in _PREFIX_FILE_GLOBS:
+    for path in glob.glob(os.path.join(venv_dir, pattern)):
+      if os.path.islink(path) or not os.path.isfile(path):
+        continue
+      with open(path, 'rb') as f:
+        data = f.read()
+      if old not in data or b'\0' in data:
+        continue
+      # Replace rather than edit the file, which may be linked to the
+      # snapshot.
+      tmp_path = path + '.pipsource-tmp'
+      with open(tmp_path, 'wb') as f:
+        f.write(data.replace(old, new))
+      shutil.copymode(path, tmp_path)
+      os.replace(tmp_path, path)
+
+
+def restore(snapshot_dir: str, python: str, abi: str, dest: str,
+            packages: List[str],
+            link_mode: str = 'hardlink') -> Optional[Snapshot]:
+  """Clones the closest snapshot to dest, which must not exist yet.
+
+  Returns the snapshot used, or None if there is none to start from.
+  """
+  snapshot = closest_snapshot(
+      list_snapshots(snapshot_dir, python, abi), packages)
+  if snapshot is None:
+    return None
+  dest = os.path.abspath(dest)
+  os.makedirs(os.path.dirname(dest), exist_ok=True)
+  tmp_dest = tempfile.mkdtemp(dir=os.path.dirname(dest),
+                              prefix='.%s.' % os.path.basename(dest))
+  try:
+    _clone_tree(os.path.join(snapshot.path, 'venv'), tmp_dest, link_mode)
+    _fix_prefix(tmp_dest, snapshot.prefix, dest)
+    os.rename(tmp_dest, dest)
+  except BaseException:
+    shutil.rmtree(tmp_dest, ignore_errors=True)
+    raise
+  _write_metadata(snapshot._replace(last_used=time.time()))
+  return snapshot
+
+
+def save(snapshot_dir: str, python: str, abi: str, venv_dir: str,
+         packages: List[str], link_mode: str = 'hardlink',
+         max_snapshots: int = DEFAULT_MAX_SNAPSHOTS) -> Snapshot:
+  """Snapshots venv_dir, which holds packages, and prunes old snapshots."""
+  path = os.path.join(snapshot_dir, snapshot_id(python, abi, packages))
+  snapshot = Snapshot(path=path, python=os.path.realpath(python), abi=abi,
+                      prefix=os.path.abspath(venv_dir),
+                      packages=list(packages), last_used=time.time())
+  existing = _read_snapshot(path)
+  if existing is None:
+    os.makedirs(snapshot_dir, exist_ok=True)
+    tmp_path = tempfile.mkdtemp(dir=snapshot_dir, prefix='.tmp.')
+    try:
+      _clone_tree(venv_dir, os.path.join(tmp_path, 'venv'), link_mode)
+      _write_metadata(snapshot._replace(path=tmp_path))
+      shutil.rmtree(path, ignore_errors=True)
+      os.rename(tmp_path, path)
+    except OSError:
+      # Another install saved the same snapshot first.
+      shutil.rmtree(tmp_path, ignore_errors=True)
+      if _read_snapshot(path) is None:
+        raise
+  else:
+    snapshot = existing._replace(last_used=time.time())
+    _write_metadata(snapshot)
+  for old in list_snapshots(snapshot_dir, python, abi)[max_snapshots:]:
+    shutil.rmtree(old.path, ignore_errors=True)
+  return snapshot
+
+
+def main(argv: List[str]):
+  parser = argparse.ArgumentParser(
+      description='Restore or save vendored venv snapshots.')
+  parser.add_argument('command', choices=('restore', 'save'))
+  parser.add_argument('snapshot_dir')
+  parser.add_argument('python', help='Base interpreter of the venv')
+  parser.add_argument('abi', help='ABI tag of the interpreter')
+  parser.add_argument('venv', help='The venv to restore or save')
+  parser.add_argument('packages', nargs='*', help='package@source key list')
+  parser.add_argument('--link-mode', default='hardlink',
+                      choices=content_store.LINK_MODES)
+  args = parser.parse_args(argv)
+  if args.command == 'save':
+    save(args.snapshot_dir, args.python, args.abi, args.venv, args.packages,
+         args.link_mode)
+    return
+  snapshot = restore(args.snapshot_dir, args.python, args.abi, args.venv,
+                     args.packages, args.link_mode)
+  if snapshot is None:
+    return
+  print('have %s' % ' '.join(set(args.packages) & set(snapshot.packages)))
+  stale = [p.split('@', 1)[0] for p in snapshot.packages
+           if p not in set(args.packages)]
+  if stale:
+    print('stale %s' % ' '.join(stale))
+
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
@@ -0,0 +1,308 @@
+"""Works out a source tree's package version without running setup.py.
+
+The version is read statically from pyproject.toml, setup.cfg or the AST of
+setup.py. Trees that derive their version from VCS metadata (setuptools_scm,
+hatch-vcs and similar) are recognized as such, since they need a git version
+tag to build once `.git` has been moved away. Only trees none of these rules
+can decide fall back to `python setup.py --version`.
+"""
+
+import ast
+import configparser
+import json
+import os
+import re
+import subprocess
+import threading
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+
+try:
+  import tomllib
+except ImportError:
+  tomllib = None
+
+try:
+  from . import tracing
+except ImportError:
+  import tracing
+
+SCM_REQUIREMENTS = ('setuptools_scm', 'setuptools-scm', 'hatch-vcs',
+                    'hatch_vcs', 'setuptools-git-versioning', 'pbr',
+                    'versioneer', 'dunamai', 'poetry-dynamic-versioning')
+
+_VERSION_ASSIGN_RE = re.compile(
+    r'''^__version__\s*=\s*['"]([^'"]+)['"]''', re.MULTILINE)
+
+
+class VersionInfo(NamedTuple):
+  version: Optional[str]
+  # True when the version comes from VCS metadata rather than the sources.
+  scm: bool
+
+
+def _read(path: str) -> Optional[str]:
+  try:
+    with open(path, encoding='utf-8') as f:
+      return f.read()
+  except (OSError, UnicodeDecodeError):
+    return None
+
+
+def _mentions_scm(requirements: Any) -> bool:
+  if isinstance(requirements, str):
+    requirements = [requirements]
+  if not isinstance(requirements, (list, tuple)):
+    return False
+  for requirement in requirements:
+    if not isinstance(requirement, str):
+      continue
+    name = re.split(r'[\s<>=!~;\[]', requirement.strip(), 1)[0].lower()
+    if name in SCM_REQUIREMENTS:
+      return True
+  return False
+
+
+def _version_from_module(package_dir: str, attr: str) -> Optional[str]:
+  """Resolves a "package.module.__version__" style attr to a literal."""
+  module, _, name = attr.strip().rpartition('.')
+  if not module:
+    return None
+  parts = module.split('.')
+  candidates = []
+  for root in ('', 'src'):
+    base = os.path.join(package_dir, root, *parts)
+    candidates += [os.path.join(base, '__init__.py'), base + '.py']
+  for candidate in candidates:
+    source = _read(candidate)
+    if source is None:
+      continue
+    try:
+      tree = ast.parse(source)
+    except SyntaxError:
+      return None
+    version = _module_constants(tree).get(name)
+    return version if isinstance(version, str) else None
+  return None
+
+
+def _version_from_file(package_dir: str, path: str) -> Optional[str]:
+  source = _read(os.path.join(package_dir, path.strip()))
+  if source is None:
+    return None
+  match = _VERSION_ASSIGN_RE.search(source)
+  return match.group(1) if match else (source.strip() or None)
+
+
+def _module_constants(tree: ast.Module) -> Dict[str, Any]:
+  """Returns the module level `NAME = <literal>` assignments."""
+  constants = {}
+  for node in tree.body:
+    if (isinstance(node, ast.Assign) and len(node.targets) == 1 and
+        isinstance(node.targets[0], ast.Name)):
+      try:
+        value = ast.literal_eval(node.value)
+      except (ValueError, TypeError, SyntaxError):
+        continue
+      constants[node.targets[0].id] = value
+  return constants
+
+
+def _from_pyproject(package_dir: str) -> Optional[VersionInfo]:
+  source = _read(os.path.join(package_dir, 'pyproject.toml'))
+  if source is None or tomllib is None:
+    return None
+  try:
+    pyproject = tomllib.loads(source)
+  except tomllib.TOMLDecodeError:
+    return None
+  tool = pyproject.get('tool', {})
+  if 'setuptools_scm' in tool or 'setuptools-scm' in tool:
+    return VersionInfo(None, True)
+  if tool.get('hatch', {}).get('version', {}).get('source') == 'vcs':
+    return VersionInfo(None, True)
+
+  project = pyproject.get('project', {})
+  if isinstance(project.get('version'), str):
+    return VersionInfo(project['version'], False)
+  poetry_version = tool.get('poetry', {}).get('version')
+  if isinstance(poetry_version, str) and poetry_version != '0.0.0':
+    return VersionInfo(poetry_version, False)
+
+  if 'version' in project.get('dynamic', []):
+    dynamic = tool.get('setuptools', {}).get('dynamic', {}).get('version', {})
+    if 'attr' in dynamic:
+      version = _version_from_module(package_dir, dynamic['attr'])
+      if version:
+        return VersionInfo(version, False)
+    elif 'file' in dynamic:
+      files = dynamic['file']
+      version = _version_from_file(
+          package_dir, files[0] if isinstance(files, list) else files)
+      if version:
+        return VersionInfo(version, False)
+    hatch_path = tool.get('hatch', {}).get('version', {}).get('path')
+    if hatch_path:
+      version = _version_from_file(package_dir, hatch_path)
+      if version:
+        return VersionInfo(version, False)
+    requires = pyproject.get('build-system', {}).get('requires', [])
+    if _mentions_scm(requires):
+      return VersionInfo(None, True)
+  return None
+
+
+def _from_setup_cfg(package_dir: str) -> Optional[VersionInfo]:
+  source = _read(os.path.join(package_dir, 'setup.cfg'))
+  if source is None:
+    return None
+  parser = configparser.ConfigParser(interpolation=None)
+  try:
+    parser.read_string(source)
+  except configparser.Error:
+    return None
+  if parser.has_option('options', 'setup_requires') and _mentions_scm(
+      parser.get('options', 'setup_requires').split('\n')):
+    return VersionInfo(None, True)
+  if not parser.has_option('metadata', 'version'):
+    return None
+  version = parser.get('metadata', 'version').strip()
+  if version.startswith('attr:'):
+    version = _version_from_module(package_dir, version[len('attr:'):])
+  elif version.startswith('file:'):
+    version = _version_from_file(package_dir, version[len('file:'):])
+  return VersionInfo(version, False) if version else None
+
+
+def _is_setup_call(node: ast.AST) -> bool:
+  if not isinstance(node, ast.Call):
+    return False
+  func = node.func
+  return ((isinstance(func, ast.Name) and func.id == 'setup') or
+          (isinstance(func, ast.Attribute) and func.attr == 'setup'))
+
+
+def _literal(node: ast.AST, constants: Dict[str, Any]) -> Any:
+  if isinstance(node, ast.Name) and node.id in constants:
+    return constants[node.id]
+  try:
+    return ast.literal_eval(node)
+  except (ValueError, TypeError, SyntaxError):
+    return None
+
+
+def setup_py_keywords(package_dir: str) -> Optional[Dict[str, Any]]:
+  """Returns the keyword arguments of setup.py's setup() call.
+
+  Values are the literals they evaluate to, or None where they can't be
+  evaluated statically. Returns None if there is no parseable setup() call.
+  """
+  source = _read(os.path.join(package_dir, 'setup.py'))
+  if source is None:
+    return None
+  try:
+    tree = ast.parse(source)
+  except SyntaxError:
+    return None
+  constants = _module_constants(tree)
+  for node in ast.walk(tree):
+    if _is_setup_call(node):
+      return {k.arg: _literal(k.value, constants)
+              for k in node.keywords if k.arg}
+  return None
+
+
+def _from_setup_py(package_dir: str) -> Optional[VersionInfo]:
+  keywords = setup_py_keywords(package_dir)
+  if keywords is None:
+    return None
+  if 'use_scm_version' in keywords:
+    if keywords['use_scm_version'] is not False:
+      return VersionInfo(None, True)
+  if _mentions_scm(keywords.get('setup_requires')):
+    return VersionInfo(None, True)
+  if isinstance(keywords.get('version'), str):
+    return VersionInfo(keywords['version'], False)
+  return None
+
+
+def detect(package_dir: str) -> Optional[VersionInfo]:
+  """Statically detects the version, or returns None if it can't decide."""
+  for detector in (_from_pyproject, _from_setup_cfg, _from_setup_py):
+    info = detector(package_dir)
+    if info is not None:
+      return info
+  return None
+
+
+def _run_setup_py(package_dir: str, python_bin: str) -> VersionInfo:
+  result = tracing.run_subprocess(
+      [python_bin, 'setup.py', '--version'],
+      cwd=package_dir,
+      stdout=subprocess.PIPE,
+      stderr=subprocess.DEVNULL)
+  if result.returncode != 0:
+    # setup.py only fails here when it needs VCS metadata it can't find.
+    return VersionInfo(None, True)
+  lines = result.stdout.decode().strip().splitlines()
+  return VersionInfo(lines[-1].strip() if lines else None, False)
+
+
+class VersionProbe(object):
+  """Detects package versions, memoized on disk by content tree hash."""
+
+  def __init__(self, cache_path: Optional[str] = None,
+               python_bin: str = 'python'):
+    self.cache_path = cache_path
+    self.python_bin = python_bin
+    self.subprocess_probes = 0
+    self._lock = threading.Lock()
+    self._cache = self._load()
+    self._dirty = False
+
+  def _load(self) -> Dict[str, List]:
+    if not self.cache_path or not os.path.isfile(self.cache_path):
+      return {}
+    try:
+      with open(self.cache_path) as cache_file:
+        return json.loads(cache_file.read())
+    except ValueError:
+      return {}
+
+  def probe(self, package_dir: str, tree: Optional[str] = None,
+            python_bin: Optional[str] = None) -> VersionInfo:
+    """Returns the version info of package_dir, whose content is tree.
+
+    setup.py, if it has to be run, is run with python_bin, by default the
+    probe's own.
+    """
+    if tree:
+      with self._lock:
+        cached = self._cache.get(tree)
+      if cached is not None:
+        return VersionInfo(*cached)
+    info = detect(package_dir)
+    if info is None:
+      with self._lock:
+        self.subprocess_probes += 1
+      info = _run_setup_py(package_dir, python_bin or self.python_bin)
+    if tree:
+      with self._lock:
+        self._cache[tree] = list(info)
+        self._dirty = True
+    return info
+
+  def save(self):
+    with self._lock:
+      if not self.cache_path or not self._dirty:
+        return
+      os.makedirs(os.path.dirname(os.path.abspath(self.cache_path)),
+                  exist_ok=True)
+      tmp_path = '%s.tmp.%d' % (self.cache_path, os.getpid())
+      with open(tmp_path, 'w') as cache_file:
+        json.dump(self._cache, cache_file, sort_keys=True, indent=2)
+      os.replace(tmp_path, self.cache_path)
+      self._dirty = False
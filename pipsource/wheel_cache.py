@@ -0,0 +1,147 @@
+"""Local cache of wheels built from vendored sources.
+
+Wheels live in `<cache>/<source key>/<abi tag>/`, where the source key is the
+content tree hash (or commit) a package was vendored as and the ABI tag names
+the interpreter and platform they were built for. A package is therefore built
+once per interpreter no matter how many venvs or CI jobs install it.
+
+The install script also records how long each package took to build (or that
+it came from the cache) and how long the final install took, in
+`$PIPSOURCE_TIMINGS`, and prints the slowest builds when it finishes.
+"""
+
+import glob
+import os
+import subprocess
+from typing import Dict
+from typing import List
+from typing import Optional
+
+DEFAULT_CACHE_DIR = os.path.expanduser('~/.pipsource/wheels')
+
+# Prints e.g. "cpython-37-linux_x86_64" for the interpreter that runs it.
+# Python 2.7 has no sys.implementation, so its tag is built the same way from
+# the implementation name and version.
+ABI_TAG_SNIPPET = (
+    'import platform, sys, sysconfig; '
+    'impl = getattr(sys, "implementation", None); '
+    'print((impl.cache_tag if impl else "%s-%d%d" % ('
+    '(platform.python_implementation().lower(),) + '
+    'tuple(sys.version_info[:2]))) + "-" + '
+    'sysconfig.get_platform().replace("-", "_").replace(".", "_"))')
+
+_SCRIPT_FUNCTIONS = r'''
+PIPSOURCE_ABI=$("${PIPSOURCE_PYTHON:-python}" -c '%(abi_snippet)s')
+PIPSOURCE_WHEELS=()
+# " package@key " of each package the venv already has, e.g. from a snapshot.
+PIPSOURCE_HAVE=" "
+PIPSOURCE_TIMINGS="${PIPSOURCE_TIMINGS:-$PWD/.pipsource-install-times.tsv}"
+: > "$PIPSOURCE_TIMINGS"
+
+_pipsource_now() {
+  if [ -n "$EPOCHREALTIME" ]; then echo "${EPOCHREALTIME/,/.}"; else date +%%s; fi
+}
+
+# Appends "<step>\t<package>\t<version>\t<seconds>" to the timings file.
+_pipsource_record_time() {
+  local step=$1 package=$2 version=$3 start=$4
+  awk -v s="$step" -v p="$package" -v v="$version" -v a="$start" \
+    -v b="$(_pipsource_now)" \
+    'BEGIN { printf "%%s\t%%s\t%%s\t%%.3f\n", s, p, v, b - a }' \
+    >> "$PIPSOURCE_TIMINGS"
+}
+
+# Adds the wheel for a vendored package to PIPSOURCE_WHEELS, building it into
+# the cache first unless the same source was already built for this ABI. The
+# first argument is the package's dir in the vendor dir: its name, or e.g.
+# "six@1.11.0" for a version vendored alongside the package's main one.
+pip_wheel_vendored() {
+  local name=$1 version=$2 key=$3 version_tag=$4
+  local package=${name%%%%@*}
+  local wheel_dir="$PIP_WHEEL_CACHE/$key/$PIPSOURCE_ABI"
+  local start
+  start=$(_pipsource_now)
+  case "$PIPSOURCE_HAVE" in
+    *" $package@$key "*)
+      _pipsource_record_time snapshot "$package" "$version" "$start"
+      return ;;
+  esac
+  if ! ls "$wheel_dir"/*.whl >/dev/null 2>&1; then
+    echo "Building wheel for $package $version"
+    local tmp_dir="$wheel_dir.tmp.$$"
+    rm -rf "$tmp_dir"
+    mkdir -p "$tmp_dir"
+    if [ "$version_tag" = git_version_tag ]; then
+      SETUPTOOLS_SCM_PRETEND_VERSION="$version" PBR_VERSION="$version" \
+        pip wheel --quiet --no-deps --no-index --no-build-isolation \
+        --wheel-dir "$tmp_dir" "$PIP_VENDOR_DIR/$name"
+    else
+      pip wheel --quiet --no-deps --no-index --no-build-isolation \
+        --wheel-dir "$tmp_dir" "$PIP_VENDOR_DIR/$name"
+    fi
+    rm -rf "$wheel_dir"
+    mv "$tmp_dir" "$wheel_dir"
+    _pipsource_record_time build "$package" "$version" "$start"
+  else
+    _pipsource_record_time cached "$package" "$version" "$start"
+  fi
+  PIPSOURCE_WHEELS+=("$wheel_dir"/*.whl)
+}
+
+# Installs every collected wheel with one offline pip invocation.
+pip_install_vendored_wheels() {
+  if [ ${#PIPSOURCE_WHEELS[@]} -gt 0 ]; then
+    local start
+    start=$(_pipsource_now)
+    pip install --no-index --no-deps "${PIPSOURCE_WHEELS[@]}"
+    _pipsource_record_time install "${#PIPSOURCE_WHEELS[@]} wheels" "" "$start"
+  fi
+}
+
+# Prints the slowest steps recorded in the timings file.
+pipsource_timing_report() {
+  echo "Slowest install steps (seconds, step, package, version):"
+  sort -t "$(printf '\t')" -k4,4 -rn "$PIPSOURCE_TIMINGS" | head -n 10 |
+    awk -F '\t' '{ printf "  %%8.2f  %%-7s %%s %%s\n", $4, $1, $2, $3 }'
+  echo "Full timings in $PIPSOURCE_TIMINGS"
+}
+'''.strip('\n')
+
+
+def script_functions() -> List[str]:
+  """Returns the bash lines defining the install script's wheel helpers."""
+  return (_SCRIPT_FUNCTIONS % {'abi_snippet': ABI_TAG_SNIPPET}).split('\n')
+
+
+def source_key(package: str, version: str, tree: Optional[str] = None,
+               commit: Optional[str] = None) -> str:
+  """Returns the cache key for a vendored source tree."""
+  if tree:
+    return tree
+  if commit:
+    return 'commit-%s' % commit
+  # Without a hash the key can't tell rebuilt sources apart, so at least keep
+  # it specific to the package version.
+  return '%s-%s' % (package, version)
+
+
+_abi_tags = {}  # type: Dict[str, str]
+
+
+def abi_tag(python_bin: str) -> str:
+  """Returns the ABI tag for python_bin, matching the install script's."""
+  if python_bin not in _abi_tags:
+    output = subprocess.check_output([python_bin, '-c', ABI_TAG_SNIPPET])
+    _abi_tags[python_bin] = output.decode().strip()
+  return _abi_tags[python_bin]
+
+
+def wheel_dir(cache_dir: str, key: str, abi: str) -> str:
+  return os.path.join(cache_dir, key, abi)
+
+
+def cached_wheel(cache_dir: str, key: str, abi: str) -> Optional[str]:
+  """Returns the path of the cached wheel for key and abi, if there is one."""
+  wheels = sorted(glob.glob(os.path.join(wheel_dir(cache_dir, key, abi),
+                                         '*.whl')))
+  return wheels[0] if wheels else None
@@ -0,0 +1,128 @@
+import importlib
+import json
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import unittest
+import zipfile
+
+from pipsource import archive
+from pipsource import manifest
+
+
+class TestArchive(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.vendor_dir = os.path.join(self.tmp_dir, 'vendor')
+    self._write('six/six.py', 'VALUE = "six"\n')
+    self._write('six/setup.py', '')
+    self._write('six/.git-moved/HEAD', 'ref: refs/heads/master\n')
+    self._write('attrs/src/pipsource_test_attrs/__init__.py',
+                'from .sub import VALUE\n')
+    self._write('attrs/src/pipsource_test_attrs/sub.py', 'VALUE = 1\n')
+    self._write('attrs/bin/run', '#!/bin/sh\n')
+    os.chmod(os.path.join(self.vendor_dir, 'attrs/bin/run'), 0o755)
+    os.symlink('bin/run', os.path.join(self.vendor_dir, 'attrs', 'run'))
+    vendor_manifest = manifest.Manifest(
+        os.path.join(self.vendor_dir, manifest.MANIFEST_FILE_NAME))
+    vendor_manifest.record('six', '1.12.0', 'https://github.com/six',
+                           ['tag', '1.12.0'], 'abc', 'tree',
+                           os.path.join(self.vendor_dir, 'six'))
+    vendor_manifest.save()
+    self.archive_path = os.path.join(self.tmp_dir, 'vendor.zip')
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def _write(self, name, content):
+    path = os.path.join(self.vendor_dir, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+      f.write(content)
+
+  def test_pack_is_reproducible_and_skips_vcs_dirs(self):
+    self.assertEqual(archive.pack(self.vendor_dir, self.archive_path), 2)
+    with open(self.archive_path, 'rb') as f:
+      first = f.read()
+    archive.pack(self.vendor_dir, self.archive_path)
+    with open(self.archive_path, 'rb') as f:
+      self.assertEqual(f.read(), first)
+
+    with archive.Archive(self.archive_path) as packed:
+      self.assertEqual(packed.packages(), ['attrs', 'six'])
+      self.assertEqual(packed.names('six'), ['setup.py', 'six.py'])
+      self.assertEqual(packed.read('six', 'six.py'), b'VALUE = "six"\n')
+      self.assertEqual(
+          packed.index['packages']['six']['manifest']['commit'], 'abc')
+
+  def test_unpack_for_install_script(self):
+    archive.pack(self.vendor_dir, self.archive_path)
+    script = os.path.join(self.tmp_dir, 'install.sh')
+    with open(script, 'w') as f:
+      f.write('pip_install_vendored attrs "19.1.0"\n')
+    dest = os.path.join(self.tmp_dir, 'dest')
+
+    self.assertEqual(
+        archive.unpack_for_scripts(self.archive_path, dest, [script]),
+        ['attrs'])
+    self.assertEqual(sorted(os.listdir(dest)),
+                     ['.pipsource-lock.json', 'attrs'])
+    self.assertTrue(os.access(os.path.join(dest, 'attrs/bin/run'), os.X_OK))
+    self.assertEqual(os.readlink(os.path.join(dest, 'attrs/run')), 'bin/run')
+
+    archive.unpack(self.archive_path, dest, ['Six'])
+    restored = manifest.Manifest(
+        os.path.join(dest, manifest.MANIFEST_FILE_NAME)).get('six')
+    self.assertEqual(restored.commit, 'abc')
+    with self.assertRaises(LookupError):
+      archive.unpack(self.archive_path, dest, ['yaml'])
+
+  def _write_archive(self, members):
+    with zipfile.ZipFile(self.archive_path, 'w') as packed:
+      for name, content, mode in members:
+        info = zipfile.ZipInfo(name)
+        info.external_attr = mode << 16
+        packed.writestr(info, content)
+      packed.writestr(archive.INDEX_NAME, json.dumps(
+          {'version': archive.ARCHIVE_FORMAT_VERSION, 'packages': {}}))
+
+  def test_unpack_rejects_members_leading_outside_the_package(self):
+    link = stat.S_IFLNK | 0o777
+    dest = os.path.join(self.tmp_dir, 'dest')
+    for members in (
+        [('evil/../../escaped', 'x', 0o644)],
+        [('evil//abs', 'x', 0o644)],
+        [('evil/up', '../..', link)],
+        [('evil/abs', '/etc', link)],
+        [('evil/here', '.', link), ('evil/d/up', '../here/..', link)],
+        [('evil/out', 'sub', link), ('evil/out/x', 'x', 0o644)],
+    ):
+      self._write_archive(members + [('evil/ok.py', '', 0o644)])
+      with self.assertRaises(ValueError):
+        archive.unpack(self.archive_path, dest)
+      self.assertEqual(os.listdir(dest), [])
+    self.assertFalse(os.path.exists(os.path.join(self.tmp_dir, 'escaped')))
+
+    self._write_archive([('fine/a/b.py', '', 0o644),
+                         ('fine/link', 'a/../a/b.py', link)])
+    self.assertEqual(archive.unpack(self.archive_path, dest), ['fine'])
+
+  def test_import_from_archive(self):
+    archive.pack(self.vendor_dir, self.archive_path)
+    importer = archive.install_importer(self.archive_path, ['attrs'])
+    try:
+      module = importlib.import_module('pipsource_test_attrs')
+      self.assertEqual(module.VALUE, 1)
+      self.assertTrue(module.__file__.startswith(self.archive_path))
+    finally:
+      sys.meta_path.remove(importer)
+      for name in ('pipsource_test_attrs', 'pipsource_test_attrs.sub'):
+        sys.modules.pop(name, None)
+      importer.archive.close()
+
+
+if __name__ == '__main__':
+  unittest.main()
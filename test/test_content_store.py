@@ -0,0 +1,110 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from pipsource import content_store
+
+
+def _write(path, contents, mode=0o644):
+  # Replace rather than rewrite files, like a fresh checkout does, since
+  # imported files are hardlinks to the shared objects.
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  if os.path.exists(path):
+    os.remove(path)
+  with open(path, 'w') as f:
+    f.write(contents)
+  os.chmod(path, mode)
+
+
+def _read(path):
+  with open(path) as f:
+    return f.read()
+
+
+class TestContentStore(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    self.store = content_store.ContentStore(os.path.join(self.tmp, 'store'))
+    self.src = os.path.join(self.tmp, 'vendor', 'pkg')
+    _write(os.path.join(self.src, 'setup.py'), 'setup()')
+    _write(os.path.join(self.src, 'pkg', '__init__.py'), 'VERSION = 1')
+    _write(os.path.join(self.src, 'bin', 'tool'), '#!/bin/sh', 0o755)
+    _write(os.path.join(self.src, '.git-moved', 'HEAD'), 'ref')
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp)
+
+  def test_import_is_deterministic_and_skips_vcs_dirs(self):
+    tree = self.store.import_tree(self.src)
+    self.assertEqual(self.store.import_tree(self.src), tree)
+    dest = os.path.join(self.tmp, 'copy')
+    self.store.materialize(tree, dest)
+    self.assertFalse(os.path.exists(os.path.join(dest, '.git-moved')))
+    self.assertEqual(_read(os.path.join(dest, 'pkg', '__init__.py')),
+                     'VERSION = 1')
+    self.assertTrue(os.access(os.path.join(dest, 'bin', 'tool'), os.X_OK))
+
+  def test_versions_share_unchanged_files(self):
+    tree_1 = self.store.import_tree(self.src)
+    self.store.set_ref('pkg', '1', ('tag', '1'), tree_1)
+    _write(os.path.join(self.src, 'pkg', '__init__.py'), 'VERSION = 2')
+    tree_2 = self.store.import_tree(self.src)
+    self.store.set_ref('pkg', '2', ('tag', '2'), tree_2)
+    self.assertNotEqual(tree_1, tree_2)
+
+    self.store.materialize(tree_1, self.src)
+    self.assertEqual(self.store.checkout_tree(self.src), tree_1)
+    self.assertEqual(_read(os.path.join(self.src, 'pkg', '__init__.py')),
+                     'VERSION = 1')
+    setup_py = os.path.join(self.src, 'setup.py')
+    self.assertGreater(os.stat(setup_py).st_nlink, 1)
+
+  def test_ref_requires_matching_label(self):
+    tree = self.store.import_tree(self.src)
+    self.store.set_ref('pkg', '1', ('tag', 'v1'), tree, commit='abc123')
+    self.assertEqual(self.store.get_ref('pkg', '1', ('tag', 'v1')),
+                     content_store.Ref(tree=tree, commit='abc123'))
+    self.assertIsNone(self.store.get_ref('pkg', '1', ('tag', '1')))
+    self.assertIsNone(self.store.get_ref('pkg', '2', ('tag', 'v1')))
+
+  def test_reimport_keeps_objects_from_sweep(self):
+    self.store.import_tree(self.src)
+    old = time.time() - 2 * content_store.SWEEP_GRACE_SECONDS
+    for dirpath, _, filenames in os.walk(self.store.root):
+      for name in filenames:
+        os.utime(os.path.join(dirpath, name), (old, old))
+    tree = self.store.import_tree(self.src, relink=False)
+    self.assertEqual(self.store.sweep().objects, 0)
+    dest = os.path.join(self.tmp, 'copy')
+    self.store.materialize(tree, dest)
+    self.assertEqual(_read(os.path.join(dest, 'setup.py')), 'setup()')
+
+  def test_concurrent_checkouts_are_all_recorded(self):
+    tree = self.store.import_tree(self.src)
+    dests = [os.path.join(self.tmp, 'copy%d' % i) for i in range(8)]
+    # Separate store instances stand in for separate processes.
+    threads = [threading.Thread(
+        target=content_store.ContentStore(self.store.root).materialize,
+        args=(tree, dest)) for dest in dests]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(self.store.checkouts(),
+                     {os.path.abspath(dest): tree for dest in dests})
+
+  def test_copy_mode_does_not_link(self):
+    store = content_store.ContentStore(
+        os.path.join(self.tmp, 'copies'), link_mode='copy')
+    tree = store.import_tree(self.src)
+    dest = os.path.join(self.tmp, 'copy')
+    store.materialize(tree, dest)
+    self.assertEqual(os.stat(os.path.join(dest, 'setup.py')).st_nlink, 1)
+
+
+if __name__ == '__main__':
+  unittest.main()
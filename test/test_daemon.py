@@ -0,0 +1,61 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from pipsource import daemon
+
+
+class TestDaemon(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.socket_path = os.path.join(self.tmp_dir, 'daemon.sock')
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def _start(self, handlers):
+    thread = threading.Thread(
+        target=daemon.serve, args=(self.socket_path, handlers), daemon=True)
+    thread.start()
+    for _ in range(100):
+      if os.path.exists(self.socket_path):
+        break
+      time.sleep(0.01)
+    return thread
+
+  def test_no_daemon_is_unavailable(self):
+    with self.assertRaises(daemon.DaemonUnavailable):
+      daemon.request(self.socket_path, {'op': 'ping'})
+
+  def test_requests(self):
+    def echo(message):
+      return {'pipenv_dir': message['pipenv_dir']}
+
+    def fail(message):
+      raise ValueError('broken')
+
+    def decline(message):
+      raise daemon.Unavailable('different settings')
+
+    self._start({'vendor': echo, 'fail': fail, 'decline': decline})
+    self.assertEqual(daemon.request(self.socket_path, {'op': 'ping'}),
+                     os.getpid())
+    self.assertEqual(
+        daemon.request(self.socket_path,
+                       {'op': 'vendor', 'pipenv_dir': '/project'}),
+        {'pipenv_dir': '/project'})
+    with self.assertRaisesRegex(daemon.DaemonError, 'broken'):
+      daemon.request(self.socket_path, {'op': 'fail'})
+    for op in ('decline', 'unknown'):
+      with self.assertRaises(daemon.DaemonUnavailable):
+        daemon.request(self.socket_path, {'op': op})
+    with self.assertRaises(RuntimeError):
+      daemon.serve(self.socket_path, {})
+
+
+if __name__ == '__main__':
+  unittest.main()
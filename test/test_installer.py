@@ -0,0 +1,121 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+import venv
+
+from pipsource import installer
+from pipsource import manifest
+
+# An in-tree PEP 517 backend that zips up the package's module as a wheel.
+_BACKEND = '''
+import os, zipfile
+NAME, VERSION = open('NAME').read().split()
+for dep in open('BUILD_IMPORTS').read().split():
+  __import__(dep)
+
+
+def build_wheel(wheel_directory, config_settings=None,
+                metadata_directory=None):
+  if os.path.exists('FAIL'):
+    raise RuntimeError('broken build for ' + NAME)
+  wheel = '%s-%s-py3-none-any.whl' % (NAME, VERSION)
+  info = '%s-%s.dist-info/' % (NAME, VERSION)
+  with zipfile.ZipFile(os.path.join(wheel_directory, wheel), 'w') as f:
+    f.write('%s.py' % NAME)
+    f.writestr(info + 'METADATA', 'Metadata-Version: 2.1\\nName: %s\\n'
+               'Version: %s\\n' % (NAME, VERSION))
+    f.writestr(info + 'WHEEL', 'Wheel-Version: 1.0\\nGenerator: test\\n'
+               'Root-Is-Purelib: true\\nTag: py3-none-any\\n')
+    f.writestr(info + 'RECORD', '')
+  return wheel
+'''
+
+
+class TestInstaller(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.vendor_dir = os.path.join(self.tmp_dir, 'vendor')
+    self.cache_dir = os.path.join(self.tmp_dir, 'wheels')
+    self.venv_dir = os.path.join(self.tmp_dir, 'venv')
+    # pip comes from the outer environment's site-packages.
+    venv.create(self.venv_dir, system_site_packages=True, with_pip=False)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def _vendor(self, name, build_imports=(), fail=False):
+    package_dir = os.path.join(self.vendor_dir, name)
+    os.makedirs(package_dir)
+    files = {
+        'pyproject.toml': '[build-system]\nrequires = []\n'
+                          'build-backend = "backend"\nbackend-path = ["."]\n',
+        'backend.py': _BACKEND,
+        'NAME': '%s 1.0' % name,
+        'BUILD_IMPORTS': ' '.join(build_imports),
+        '%s.py' % name: 'NAME = %r\n' % name,
+    }
+    if fail:
+      files['FAIL'] = ''
+    for file_name, content in files.items():
+      with open(os.path.join(package_dir, file_name), 'w') as f:
+        f.write(content)
+
+  def _importable(self, name):
+    return subprocess.run(
+        [installer.venv_python(self.venv_dir), '-c', 'import %s' % name],
+        stderr=subprocess.DEVNULL).returncode == 0
+
+  def test_install_by_level(self):
+    # base_pkg must be installed before top_pkg can build.
+    self._vendor('base_pkg')
+    self._vendor('top_pkg', build_imports=['base_pkg'])
+    self._vendor('broken_pkg', fail=True)
+    self._vendor('needs_broken')
+    packages = [(name, '1.0') for name in
+                ('top_pkg', 'base_pkg', 'broken_pkg', 'needs_broken')]
+    graph = {'top_pkg': {'base_pkg'}, 'needs_broken': {'broken_pkg'}}
+
+    package_installer = installer.Installer(
+        self.vendor_dir, self.venv_dir, self.cache_dir, jobs=4)
+    outcomes = {o.package: o for o in package_installer.install(
+        packages, graph)}
+
+    self.assertEqual(
+        {p: o.status for p, o in outcomes.items()},
+        {'top_pkg': 'built', 'base_pkg': 'built', 'broken_pkg': 'failed',
+         'needs_broken': 'skipped'})
+    self.assertIn('broken build for broken_pkg', outcomes['broken_pkg'].error)
+    self.assertIn('broken_pkg', outcomes['needs_broken'].error)
+    self.assertTrue(self._importable('top_pkg'))
+    self.assertFalse(self._importable('needs_broken'))
+
+    outcomes = package_installer.install(packages[:2], graph)
+    self.assertEqual([o.status for o in outcomes], ['cached', 'cached'])
+
+  def test_reinstalls_changed_source_of_same_version(self):
+    self._vendor('pinned_pkg')
+    package_dir = os.path.join(self.vendor_dir, 'pinned_pkg')
+    for tree, name in (('tree1', 'old'), ('tree2', 'new')):
+      with open(os.path.join(package_dir, 'pinned_pkg.py'), 'w') as f:
+        f.write('NAME = %r\n' % name)
+      vendor_manifest = manifest.Manifest(
+          os.path.join(self.vendor_dir, manifest.MANIFEST_FILE_NAME))
+      vendor_manifest.record('pinned_pkg', '1.0', 'url', ['commit', tree],
+                             tree, tree, package_dir)
+      vendor_manifest.save()
+      outcomes = installer.Installer(
+          self.vendor_dir, self.venv_dir, self.cache_dir).install(
+              [('pinned_pkg', '1.0')], {})
+      self.assertEqual([o.status for o in outcomes], ['built'])
+    output = subprocess.check_output(
+        [installer.venv_python(self.venv_dir), '-c',
+         'import pinned_pkg; print(pinned_pkg.NAME)'])
+    self.assertEqual(output.decode().strip(), 'new')
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,125 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from pipsource import content_store
+from pipsource import integrity
+from pipsource import manifest
+
+
+class TestIntegrity(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.vendor_dir = os.path.join(self.tmp_dir, 'vendor')
+    self.package_dir = os.path.join(self.vendor_dir, 'six')
+    self.stat_cache = os.path.join(self.tmp_dir, 'stats.json')
+    self._write('six.py', 'VALUE = 1\n')
+    self._write('bin/run', '#!/bin/sh\n')
+    os.chmod(os.path.join(self.package_dir, 'bin/run'), 0o755)
+    os.symlink('bin/run', os.path.join(self.package_dir, 'run'))
+    self._write('.git-moved/HEAD', 'ref: refs/heads/master\n')
+
+    self.store_dir = os.path.join(self.tmp_dir, 'store')
+    store = content_store.ContentStore(self.store_dir, 'copy')
+    tree_hash = store.import_tree(self.package_dir)
+    store.set_ref('six', '1.12.0', ['tag', '1.12.0'], tree_hash, 'abc')
+    vendor_manifest = manifest.Manifest(
+        os.path.join(self.vendor_dir, manifest.MANIFEST_FILE_NAME))
+    vendor_manifest.record('six', '1.12.0', 'https://github.com/six',
+                           ['tag', '1.12.0'], 'abc', tree_hash,
+                           self.package_dir)
+    vendor_manifest.save()
+    self.record = integrity.IntegrityRecord(
+        os.path.join(self.vendor_dir, integrity.RECORD_FILE_NAME))
+    self.record.record('six', tree_hash, 'abc', store.read_tree(tree_hash))
+    self.record.save()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def _write(self, name, content):
+    path = os.path.join(self.package_dir, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+      f.write(content)
+
+  def _verify(self, **kwargs):
+    return integrity.verify(self.vendor_dir, stat_cache_path=self.stat_cache,
+                            **kwargs)
+
+  def test_hash_file_matches_content_store(self):
+    path = os.path.join(self.package_dir, 'six.py')
+    self.assertEqual(integrity.hash_file(path), content_store.hash_file(path))
+    empty = os.path.join(self.tmp_dir, 'empty')
+    open(empty, 'w').close()
+    self.assertEqual(integrity.hash_file(empty),
+                     content_store.hash_file(empty))
+
+  def test_intact_tree_then_only_changed_files_are_rehashed(self):
+    self.assertEqual(self._verify(), [])
+    with mock.patch.object(integrity, 'hash_file',
+                           wraps=integrity.hash_file) as hash_file:
+      self.assertEqual(self._verify(), [])
+      self.assertEqual(hash_file.call_count, 0)
+      self._write('six.py', 'VALUE = 2\n')
+      self.assertEqual(self._verify(), [
+          integrity.Drift('six', 'six.py', 'contents changed')])
+      self.assertEqual(hash_file.call_count, 1)
+
+  def test_reports_drift(self):
+    os.remove(os.path.join(self.package_dir, 'six.py'))
+    self._write('extra.py', '')
+    os.chmod(os.path.join(self.package_dir, 'bin/run'), 0o644)
+    os.remove(os.path.join(self.package_dir, 'run'))
+    os.symlink('six.py', os.path.join(self.package_dir, 'run'))
+    self.assertEqual(self._verify(packages=['six', 'attrs']), [
+        integrity.Drift('attrs', '', 'not in the integrity record'),
+        integrity.Drift('six', 'bin/run', 'executable bit changed'),
+        integrity.Drift('six', 'extra.py', 'unexpected file'),
+        integrity.Drift('six', 'run', 'symlink target changed'),
+        integrity.Drift('six', 'six.py', 'file is missing'),
+    ])
+
+  def test_tampered_record(self):
+    record_path = os.path.join(self.vendor_dir, integrity.RECORD_FILE_NAME)
+    with open(record_path) as f:
+      record_json = json.load(f)
+    self._write('six.py', 'VALUE = 2\n')
+    for entry in record_json['packages']['six']['files']:
+      if entry[0] == 'six.py':
+        entry[1] = integrity.hash_file(
+            os.path.join(self.package_dir, 'six.py'))
+    with open(record_path, 'w') as f:
+      json.dump(record_json, f)
+    self.assertEqual(self._verify(), [
+        integrity.Drift('six', '', 'record does not match its tree hash')])
+
+  def test_record_and_manifest_rewritten_together(self):
+    self._write('six.py', 'VALUE = 2\n')
+    store = content_store.ContentStore(self.store_dir, 'copy')
+    tree_hash = store.import_tree(self.package_dir)
+    self.record.record('six', tree_hash, 'abc', store.read_tree(tree_hash))
+    self.record.save()
+    vendor_manifest = manifest.Manifest(
+        os.path.join(self.vendor_dir, manifest.MANIFEST_FILE_NAME))
+    vendor_manifest.record('six', '1.12.0', 'https://github.com/six',
+                           ['tag', '1.12.0'], 'abc', tree_hash,
+                           self.package_dir)
+    vendor_manifest.save()
+    self.assertEqual(self._verify(), [])
+    self.assertEqual(self._verify(store_dir=self.store_dir), [
+        integrity.Drift('six', '', 'record does not match the content store')])
+
+  def test_process_pool(self):
+    self._write('six.py', 'VALUE = 2\n')
+    with mock.patch.object(integrity, '_POOL_MIN_BYTES', 0):
+      self.assertEqual(self._verify(jobs=2), [
+          integrity.Drift('six', 'six.py', 'contents changed')])
+
+
+if __name__ == '__main__':
+  unittest.main()
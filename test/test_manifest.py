@@ -0,0 +1,99 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from pipsource import manifest
+
+URL = 'https://github.com/yaml/pyyaml'
+
+
+class TestManifest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    self.package_dir = os.path.join(self.tmp, 'PyYAML')
+    os.makedirs(self.package_dir)
+    with open(os.path.join(self.package_dir, 'setup.py'), 'w') as f:
+      f.write('setup()')
+    self.path = os.path.join(self.tmp, manifest.MANIFEST_FILE_NAME)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp)
+
+  def _record(self, lock):
+    lock.record('PyYAML', '5.1.1', URL, ('tag', '5.1.1'), 'abc', 'tree',
+                self.package_dir)
+
+  def test_round_trip(self):
+    lock = manifest.Manifest(self.path)
+    self._record(lock)
+    lock.save()
+    reloaded = manifest.Manifest(self.path)
+    self.assertEqual(reloaded.get('PyYAML').commit, 'abc')
+    self.assertTrue(reloaded.is_current(
+        'PyYAML', '5.1.1', URL, ['tag', '5.1.1'], self.package_dir))
+
+  def test_detects_changed_request(self):
+    lock = manifest.Manifest(self.path)
+    self._record(lock)
+    self.assertFalse(lock.is_current(
+        'PyYAML', '5.2', URL, ('tag', '5.2'), self.package_dir))
+    self.assertFalse(lock.is_current(
+        'PyYAML', '5.1.1', URL, ('tag', 'v5.1.1'), self.package_dir))
+    self.assertFalse(lock.is_current(
+        'other', '5.1.1', URL, ('tag', '5.1.1'), self.package_dir))
+
+  def test_detects_replaced_tree(self):
+    lock = manifest.Manifest(self.path)
+    self._record(lock)
+    setup_py = os.path.join(self.package_dir, 'setup.py')
+    os.remove(setup_py)
+    with open(setup_py, 'w') as f:
+      f.write('setup(version="6")')
+    self.assertFalse(lock.is_current(
+        'PyYAML', '5.1.1', URL, ('tag', '5.1.1'), self.package_dir))
+
+  def test_fresh_checkout_and_builds_stay_current(self):
+    lock = manifest.Manifest(self.path)
+    self._record(lock)
+    clone_dir = self.package_dir + '.clone'
+    shutil.copytree(self.package_dir, clone_dir)
+    shutil.rmtree(self.package_dir)
+    os.rename(clone_dir, self.package_dir)
+    os.makedirs(os.path.join(self.package_dir, 'build', 'lib'))
+    os.makedirs(os.path.join(self.package_dir, 'PyYAML.egg-info'))
+    self.assertTrue(lock.is_current(
+        'PyYAML', '5.1.1', URL, ('tag', '5.1.1'), self.package_dir))
+
+  def test_save_merges_other_processes_changes(self):
+    daemon_lock = manifest.Manifest(self.path)
+    self._record(daemon_lock)
+    cli_lock = manifest.Manifest(self.path)
+    cli_lock.record('six', '1.12.0', URL, ('tag', '1.12.0'), 'def', 'tree',
+                    self.package_dir)
+    cli_lock.save()
+    daemon_lock.save()
+    self.assertEqual(sorted(manifest.Manifest(self.path).packages()),
+                     ['PyYAML', 'six'])
+
+    cli_lock.reload()
+    cli_lock.remove('six')
+    cli_lock.save()
+    daemon_lock.reload()
+    self.assertEqual(list(daemon_lock.packages()), ['PyYAML'])
+
+  def test_missing_dir_is_not_current(self):
+    lock = manifest.Manifest(self.path)
+    self._record(lock)
+    shutil.rmtree(self.package_dir)
+    self.assertFalse(lock.is_current(
+        'PyYAML', '5.1.1', URL, ('tag', '5.1.1'), self.package_dir))
+    with self.assertRaises(ValueError):
+      self._record(lock)
+    self.assertFalse(lock.is_current(
+        'PyYAML', '5.1.1', URL, ('tag', '5.1.1'), self.package_dir))
+
+
+if __name__ == '__main__':
+  unittest.main()
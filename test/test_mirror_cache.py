@@ -0,0 +1,172 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+from unittest import mock
+
+from pipsource import locking
+from pipsource import mirror_cache
+
+GIT = ['git', '-c', 'user.name=test', '-c', 'user.email=test@example.com']
+
+
+def _commit_and_tag(repo, tag):
+  with open(os.path.join(repo, 'version.txt'), 'w') as f:
+    f.write(tag)
+  subprocess.run(GIT + ['add', '.'], cwd=repo, check=True)
+  subprocess.run(GIT + ['commit', '-qm', tag], cwd=repo, check=True)
+  subprocess.run(GIT + ['tag', tag], cwd=repo, check=True)
+
+
+class TestMirrorCache(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    self.repo = os.path.join(self.tmp, 'repo')
+    subprocess.run(['git', 'init', '-q', self.repo], check=True)
+    _commit_and_tag(self.repo, '1.0')
+    self.url = 'file://' + self.repo
+    self.cache = mirror_cache.MirrorCache(os.path.join(self.tmp, 'cache'))
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp)
+
+  def _tags(self, mirror):
+    return subprocess.check_output(
+        ['git', 'tag'], cwd=mirror).decode().split()
+
+  def test_fetches_only_when_ref_missing(self):
+    with self.cache.git_mirror(self.url, '1.0') as mirror:
+      self.assertEqual(self._tags(mirror), ['1.0'])
+    _commit_and_tag(self.repo, '1.1')
+    with self.cache.git_mirror(self.url, '1.0') as mirror:
+      self.assertEqual(self._tags(mirror), ['1.0'])
+    with self.cache.git_mirror(self.url, '1.1') as mirror:
+      self.assertEqual(self._tags(mirror), ['1.0', '1.1'])
+
+  def _history(self, mirror, ref):
+    return subprocess.check_output(
+        ['git', 'rev-list', ref], cwd=mirror).decode().split()
+
+  def _old_commit(self):
+    for tag in ('1.1', '1.2', '1.3'):
+      _commit_and_tag(self.repo, tag)
+    return subprocess.check_output(
+        ['git', 'rev-parse', '1.0^{commit}'], cwd=self.repo).decode().strip()
+
+  def test_fetches_one_commit_by_hash(self):
+    commit = self._old_commit()
+    with self.cache.git_mirror(self.url, commit) as mirror:
+      self.assertEqual(self._history(mirror, '--all'), [commit])
+      self.assertTrue(os.path.exists(os.path.join(mirror, 'shallow')))
+
+  def test_tag_fetch_is_shallow(self):
+    _commit_and_tag(self.repo, '1.1')
+    with self.cache.git_mirror(self.url, '1.1') as mirror:
+      self.assertEqual(len(self._history(mirror, '1.1')), 1)
+      self.assertEqual(self._tags(mirror), ['1.1'])
+
+  def test_deepens_when_server_refuses_hash(self):
+    commit = self._old_commit()
+    # Protocol v0 servers only hand out advertised refs by default.
+    git_env = {'GIT_CONFIG_COUNT': '1', 'GIT_CONFIG_KEY_0': 'protocol.version',
+               'GIT_CONFIG_VALUE_0': '0'}
+    with mock.patch.dict(os.environ, git_env):
+      with self.cache.git_mirror(self.url, commit) as mirror:
+        self.assertIn(commit, self._history(mirror, '--all'))
+        ref = mirror_cache.COMMIT_REF_PREFIX + commit
+        self.assertEqual(self._history(mirror, ref), [commit])
+
+  def test_deepens_only_the_default_branch(self):
+    commit = self._old_commit()
+    default_branch = subprocess.check_output(
+        ['git', 'symbolic-ref', 'HEAD'], cwd=self.repo).decode().strip()
+    subprocess.run(GIT + ['checkout', '-qb', 'other'], cwd=self.repo,
+                   check=True)
+    _commit_and_tag(self.repo, '2.0')
+    subprocess.run(GIT + ['checkout', '-q', '-'], cwd=self.repo, check=True)
+    git_fetch = mirror_cache._git_fetch
+
+    def refuse_hash(mirror, args, check=False):
+      if args[-1].startswith(commit):
+        return False
+      return git_fetch(mirror, args, check)
+
+    with mock.patch.object(mirror_cache, '_git_fetch', refuse_hash):
+      with self.cache.git_mirror(self.url, commit) as mirror:
+        self.assertIn(commit, self._history(mirror, '--all'))
+        self.assertEqual(self._tags(mirror), [])
+        self.assertEqual(subprocess.check_output(
+            ['git', 'for-each-ref', '--format=%(refname)', 'refs/heads'],
+            cwd=mirror).decode().split(), [default_branch])
+
+  def test_abbreviated_hash(self):
+    commit = self._old_commit()
+    with self.cache.git_mirror(self.url, commit[:10]) as mirror:
+      self.assertIn(commit, self._history(mirror, '--all'))
+    with self.assertRaises(LookupError):
+      with self.cache.git_mirror(self.url, 'f' * 12):
+        pass
+
+  def test_branch_is_not_a_tag(self):
+    subprocess.run(GIT + ['branch', '2.0'], cwd=self.repo, check=True)
+    with self.assertRaises(LookupError):
+      with self.cache.git_mirror(self.url, '2.0'):
+        pass
+
+  def test_cache_hit_skips_size_and_index(self):
+    with self.cache.git_mirror(self.url, '1.0') as mirror:
+      pass
+    os.utime(mirror + '.lock', (0, 0))
+    with mock.patch.object(mirror_cache, 'dir_size') as dir_size, \
+        mock.patch.object(self.cache, '_save_index') as save_index:
+      with self.cache.git_mirror(self.url, '1.0'):
+        pass
+    dir_size.assert_not_called()
+    save_index.assert_not_called()
+    self.assertGreater(os.stat(mirror + '.lock').st_mtime, 0)
+
+  def test_index_survives_reload(self):
+    with self.cache.git_mirror(self.url) as mirror:
+      pass
+    reloaded = mirror_cache.MirrorCache(self.cache.cache_dir)
+    self.assertGreater(reloaded.total_bytes(), 0)
+    self.assertEqual(reloaded.mirror_path(self.url), mirror)
+
+  def test_evicts_least_recently_used(self):
+    other_repo = os.path.join(self.tmp, 'other')
+    subprocess.run(['git', 'init', '-q', other_repo], check=True)
+    _commit_and_tag(other_repo, '2.0')
+    other_url = 'file://' + other_repo
+
+    with self.cache.git_mirror(self.url) as old_mirror:
+      pass
+    # Another process sharing the cache dir adds a mirror to the index.
+    other_cache = mirror_cache.MirrorCache(self.cache.cache_dir)
+    with other_cache.git_mirror(other_url) as new_mirror:
+      pass
+    self.cache.max_bytes = self.cache.total_bytes() - 1
+    self.cache.evict()
+    self.assertFalse(os.path.exists(old_mirror))
+    self.assertTrue(os.path.exists(new_mirror))
+
+    # Mirrors in use elsewhere are never removed.
+    self.cache.max_bytes = 0
+    with locking.file_lock(new_mirror + '.lock'):
+      self.cache.evict()
+      self.assertTrue(os.path.exists(new_mirror))
+    self.cache.evict()
+    self.assertFalse(os.path.exists(new_mirror))
+
+  def test_parse_size(self):
+    self.assertEqual(mirror_cache.parse_size('512'), 512)
+    self.assertEqual(mirror_cache.parse_size('1.5K'), 1536)
+    self.assertEqual(mirror_cache.parse_size('10G'), 10 * 1024 ** 3)
+    self.assertEqual(mirror_cache.parse_size('5 GB'), 5 * 1024 ** 3)
+    with self.assertRaises(ValueError):
+      mirror_cache.parse_size('lots')
+
+
+if __name__ == '__main__':
+  unittest.main()
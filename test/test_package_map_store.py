@@ -0,0 +1,137 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from pipsource import config
+from pipsource import package_map_store
+
+
+class TestPackageMapStore(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    self.json_path = os.path.join(self.tmp, 'package_map.json')
+    self.dir_path = os.path.join(self.tmp, 'package_map')
+    with open(self.json_path, 'w') as f:
+      json.dump({
+          'PyYAML': {'git': 'https://github.com/yaml/pyyaml'},
+          'six': {'git': 'https://github.com/benjaminp/six',
+                  'version-tag-format': '%s'},
+      }, f)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp)
+
+  def _read_json(self, path):
+    with open(path) as f:
+      return json.load(f)
+
+  def test_open_picks_backend(self):
+    self.assertIsInstance(package_map_store.open_package_map(self.json_path),
+                          package_map_store.JsonPackageMap)
+    self.assertIsInstance(package_map_store.open_package_map(self.dir_path),
+                          package_map_store.ShardedPackageMap)
+
+  def test_backend_must_implement_every_hook(self):
+
+    class NoStamp(package_map_store.ShardedPackageMap):
+      _stamp = package_map_store.PackageMap._stamp
+
+    with self.assertRaises(TypeError):
+      package_map_store.PackageMap(self.dir_path)
+    with self.assertRaises(TypeError):
+      NoStamp(self.dir_path)
+
+  def test_json_map_lookup_and_save(self):
+    package_map = package_map_store.open_package_map(self.json_path)
+    self.assertIn('pyyaml', package_map)
+    self.assertEqual(package_map.find('pyYAML'), 'PyYAML')
+    self.assertIsNone(package_map.find('attrs'))
+    self.assertEqual(package_map.save(), 0)
+
+    package_map['pyyaml']['version-tag-format'] = '%s'
+    package_map.setdefault('attrs', {'git': 'https://github.com/attrs/attrs'})
+    self.assertEqual(sorted(package_map.dirty()), ['attrs', 'pyyaml'])
+    self.assertEqual(package_map.save(), 2)
+    saved = self._read_json(self.json_path)
+    self.assertEqual(sorted(saved), ['PyYAML', 'attrs', 'six'])
+    self.assertEqual(saved['PyYAML']['version-tag-format'], '%s')
+    self.assertEqual(package_map.dirty(), {})
+
+  def test_sharded_map_loads_and_writes_single_entries(self):
+    package_map_store.convert(self.json_path, self.dir_path)
+    six_path = os.path.join(self.dir_path, 'si', 'six.json')
+    yaml_path = os.path.join(self.dir_path, 'py', 'pyyaml.json')
+    self.assertTrue(os.path.isfile(six_path))
+    # A lookup only reads that package's file.
+    with open(six_path, 'w') as f:
+      f.write('not json')
+    package_map = package_map_store.open_package_map(self.dir_path)
+    self.assertEqual(package_map['PyYAML']['git'],
+                     'https://github.com/yaml/pyyaml')
+
+    package_map['pyyaml']['version-commits'] = {'5.1': 'abc'}
+    package_map.save()
+    with open(six_path) as f:
+      self.assertEqual(f.read(), 'not json')
+    self.assertEqual(self._read_json(yaml_path)['info']['version-commits'],
+                     {'5.1': 'abc'})
+
+    del package_map['pyyaml']
+    package_map.save()
+    self.assertFalse(os.path.exists(yaml_path))
+
+  def test_concurrent_writers_keep_each_others_updates(self):
+    package_map_store.convert(self.json_path, self.dir_path)
+    for path in (self.json_path, self.dir_path):
+      first = package_map_store.open_package_map(path)
+      second = package_map_store.open_package_map(path)
+      first['six']['version-commits'] = {'1.0': 'abc'}
+      second['six']['version-tag-format'] = 'v%s'
+      second['attrs'] = {'git': 'https://github.com/attrs/attrs'}
+      second.save()
+      first.save()
+
+      reloaded = package_map_store.open_package_map(path)
+      self.assertEqual(reloaded['six']['version-commits'], {'1.0': 'abc'})
+      self.assertEqual(reloaded['six']['version-tag-format'], 'v%s')
+      self.assertIn('attrs', reloaded)
+      self.assertEqual(first['six']['version-tag-format'], 'v%s')
+
+  def test_refresh_rereads_entries_changed_on_disk(self):
+    package_map_store.convert(self.json_path, self.dir_path)
+    for path in (self.json_path, self.dir_path):
+      daemon_map = package_map_store.open_package_map(path)
+      self.assertEqual(daemon_map['six']['git'],
+                       'https://github.com/benjaminp/six')
+      daemon_map['pyyaml']['version-tag-format'] = '%s'
+      editor = package_map_store.open_package_map(path)
+      editor['six']['git'] = 'https://example.com/six'
+      editor['six']['prune'] = False
+      editor.save()
+
+      daemon_map.refresh()
+      self.assertEqual(daemon_map['six']['git'], 'https://example.com/six')
+      self.assertIs(daemon_map['six']['prune'], False)
+      # Unsaved changes survive a refresh.
+      self.assertEqual(daemon_map['pyyaml']['version-tag-format'], '%s')
+
+  def test_convert_round_trip(self):
+    package_map_store.convert(self.json_path, self.dir_path)
+    exported = os.path.join(self.tmp, 'exported.json')
+    package_map_store.convert(self.dir_path, exported)
+    self.assertEqual(self._read_json(exported),
+                     self._read_json(self.json_path))
+
+  def test_config_parse_reads_directory(self):
+    package_map_store.convert(self.json_path, self.dir_path)
+    packages = config.parse(self.dir_path)
+    self.assertEqual(sorted(packages), ['PyYAML', 'six'])
+    self.assertEqual(packages['six'].git_path,
+                     'https://github.com/benjaminp/six')
+
+
+if __name__ == '__main__':
+  unittest.main()
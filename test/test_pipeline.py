@@ -0,0 +1,112 @@
+import threading
+import time
+import unittest
+
+from pipsource import pipeline
+
+
+class TestPipeline(unittest.TestCase):
+
+  def test_results_keep_input_order(self):
+    def slow_for_early_items(n):
+      time.sleep(0.01 * (5 - n))
+      return n
+
+    stages = [
+        pipeline.Stage('first', slow_for_early_items, 5),
+        pipeline.Stage('second', lambda n: n * 10, 2),
+    ]
+    results = pipeline.run([0, 1, 2, 3, 4], stages)
+    self.assertEqual([r.value for r in results], [0, 10, 20, 30, 40])
+    self.assertTrue(all(r.error is None for r in results))
+
+  def test_failed_item_stops_at_its_stage(self):
+    seen = []
+
+    def fail_on_two(n):
+      if n == 2:
+        raise ValueError('bad item')
+      return n
+
+    stages = [
+        pipeline.Stage('check', fail_on_two, 2),
+        pipeline.Stage('record', seen.append, 1),
+    ]
+    results = pipeline.run([1, 2, 3], stages)
+    self.assertEqual(sorted(seen), [1, 3])
+    self.assertEqual(results[1].failed_stage, 'check')
+    self.assertIsInstance(results[1].error, ValueError)
+
+  def test_stage_concurrency_is_bounded(self):
+    lock = threading.Lock()
+    running = [0]
+    peak = [0]
+
+    def track(n):
+      with lock:
+        running[0] += 1
+        peak[0] = max(peak[0], running[0])
+      time.sleep(0.01)
+      with lock:
+        running[0] -= 1
+      return n
+
+    pipeline.run(list(range(12)), [pipeline.Stage('track', track, 3)])
+    self.assertLessEqual(peak[0], 3)
+
+  def test_stage_output_goes_to_run_output(self):
+    lines = []
+
+    def say_hello(n):
+      pipeline.log('hello %d' % n)
+      return n
+
+    pipeline.run([1], [pipeline.Stage('greet', say_hello, 1)],
+                 label=lambda n: 'item%d' % n, output=lines.append)
+    self.assertEqual(lines, ['[item1] hello 1'])
+
+  def test_single_flight_shares_concurrent_calls(self):
+    flights = pipeline.SingleFlight()
+    calls = []
+    started = threading.Event()
+    release = threading.Event()
+
+    def work():
+      calls.append(1)
+      started.set()
+      release.wait(5)
+      return 'done'
+
+    results = []
+    leader = threading.Thread(
+        target=lambda: results.append(flights.do('six', work)))
+    leader.start()
+    started.wait(5)
+    follower = threading.Thread(
+        target=lambda: results.append(flights.do('six', work)))
+    follower.start()
+    time.sleep(0.05)
+    release.set()
+    leader.join()
+    follower.join()
+    self.assertEqual(results, ['done', 'done'])
+    self.assertEqual(len(calls), 1)
+    # Once finished, the next call runs again.
+    self.assertEqual(flights.do('six', lambda: 'again'), 'again')
+
+  def test_parse_jobs(self):
+    defaults = {'lookup': 8, 'fetch': 4}
+    self.assertEqual(
+        pipeline.parse_jobs('', ('lookup', 'fetch'), defaults), defaults)
+    self.assertEqual(
+        pipeline.parse_jobs('2', ('lookup', 'fetch'), defaults),
+        {'lookup': 2, 'fetch': 2})
+    self.assertEqual(
+        pipeline.parse_jobs('fetch=1', ('lookup', 'fetch'), defaults),
+        {'lookup': 8, 'fetch': 1})
+    with self.assertRaises(ValueError):
+      pipeline.parse_jobs('probe=1', ('lookup', 'fetch'), defaults)
+
+
+if __name__ == '__main__':
+  unittest.main()
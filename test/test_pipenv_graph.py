@@ -0,0 +1,88 @@
+import io
+import json
+import unittest
+
+from pipsource import pipenv_graph
+from pipsource.pipenv_graph import Node
+
+_TEXT_GRAPH = '''\
+certifi==2020.4.5.1
+  - requests==2.23.0 [requires: certifi>=2017.4.17]
+    - pynvim==0.4.1 [requires: requests]
+idna==2.9
+  - requests==2.23.0 [requires: idna>=2.5,<3]
+    - pynvim==0.4.1 [requires: requests]
+Warning: something pipenv printed
+six==1.15.0
+  - pynvim==0.4.1 [requires: six]
+'''
+
+_FLAT_GRAPH = [
+    {'package': {'key': 'pynvim', 'package_name': 'pynvim',
+                 'installed_version': '0.4.1'},
+     'dependencies': [{'key': 'requests', 'package_name': 'requests',
+                       'installed_version': '2.23.0'},
+                      {'key': 'six', 'package_name': 'six',
+                       'installed_version': '1.15.0'}]},
+    {'package': {'key': 'requests', 'package_name': 'requests',
+                 'installed_version': '2.23.0'},
+     'dependencies': [{'key': 'certifi', 'package_name': 'certifi',
+                       'installed_version': '2020.4.5.1'},
+                      {'key': 'idna', 'package_name': 'idna',
+                       'installed_version': '2.9'}]},
+    {'package': {'key': 'six', 'package_name': 'six',
+                 'installed_version': '1.15.0'},
+     'dependencies': []},
+]
+
+_EXPECTED = {
+    'certifi': Node('2020.4.5.1', 0),
+    'idna': Node('2.9', 0),
+    'six': Node('1.15.0', 0),
+    'requests': Node('2.23.0', 1),
+    'pynvim': Node('0.4.1', 2),
+}
+
+
+class TestPipenvGraph(unittest.TestCase):
+
+  def test_text_graph(self):
+    with self.assertLogs(level='WARNING') as logs:
+      nodes = pipenv_graph.parse(io.StringIO(_TEXT_GRAPH))
+    self.assertEqual(nodes, _EXPECTED)
+    self.assertIn('Warning: something pipenv printed', logs.output[0])
+
+  def test_flat_json_graph_in_small_chunks(self):
+    text = json.dumps(_FLAT_GRAPH, indent=2)
+    chunks = [text[i:i + 7] for i in range(0, len(text), 7)]
+    self.assertEqual(pipenv_graph.parse_json(chunks), _EXPECTED)
+    self.assertEqual(pipenv_graph.parse(io.StringIO('\n' + text)), _EXPECTED)
+
+  def test_json_tree_graph(self):
+    tree = [{'package_name': 'pynvim', 'installed_version': '0.4.1',
+             'dependencies': [
+                 {'package_name': 'requests', 'installed_version': '2.23.0',
+                  'dependencies': [
+                      {'package_name': 'certifi',
+                       'installed_version': '2020.4.5.1', 'dependencies': []},
+                      {'package_name': 'idna', 'installed_version': '2.9',
+                       'dependencies': []}]},
+                 {'package_name': 'six', 'installed_version': '1.15.0',
+                  'dependencies': []}]}]
+    self.assertEqual(pipenv_graph.parse_json([json.dumps(tree)]), _EXPECTED)
+
+  def test_cycles_and_truncation(self):
+    cycle = [{'package': {'package_name': 'a', 'installed_version': '1'},
+              'dependencies': [{'package_name': 'b',
+                                'installed_version': '2'}]},
+             {'package': {'package_name': 'b', 'installed_version': '2'},
+              'dependencies': [{'package_name': 'a',
+                                'installed_version': '1'}]}]
+    nodes = pipenv_graph.parse_json([json.dumps(cycle)])
+    self.assertEqual(sorted(nodes), ['a', 'b'])
+    with self.assertRaises(ValueError):
+      pipenv_graph.parse_json([json.dumps(cycle)[:-5]])
+
+
+if __name__ == '__main__':
+  unittest.main()
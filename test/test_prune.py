@@ -0,0 +1,99 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from pipsource import prune
+
+
+class TestPrune(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.package_dir = os.path.join(self.tmp_dir, 'six')
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def _write(self, rel_path, content='x'):
+    path = os.path.join(self.package_dir, rel_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+      f.write(content)
+
+  def _files(self):
+    files = []
+    for root, _, names in os.walk(self.package_dir):
+      for name in names:
+        files.append(os.path.relpath(os.path.join(root, name),
+                                     self.package_dir))
+    return sorted(files)
+
+  def test_default_and_package_rules(self):
+    self._write('setup.py', 'setup(name="six")')
+    self._write('six.py')
+    self._write('README.rst')
+    self._write('tests/test_six.py', '12345')
+    self._write('tests/data/fixture.bin', '123')
+    self._write('docs/index.rst')
+    self._write('.github/workflows/ci.yml')
+    self._write('tox.ini')
+    self._write('six/tests/test_inner.py')
+    self._write('six/__pycache__/six.cpython-311.pyc')
+    self._write('data/big/blob.bin')
+    self._write('.git/HEAD')
+    rules = prune.rules_for({'prune': {'exclude': ['data/big/'],
+                                       'include': ['tests/data/']}})
+
+    stats = prune.prune(self.package_dir, rules)
+
+    self.assertEqual(self._files(), [
+        '.git/HEAD', 'README.rst', 'setup.py', 'six.py',
+        'six/tests/test_inner.py', 'tests/data/fixture.bin'])
+    self.assertEqual(stats, prune.PruneStats(files=6, bytes=10))
+
+  def test_keeps_dirs_the_build_refers_to(self):
+    self._write('setup.py',
+                'long_description = open(os.path.join(here, "docs", '
+                '"index.rst")).read()\ndata_files=["examples/demo.py"]\n')
+    self._write('docs/index.rst')
+    self._write('examples/demo.py')
+    self._write('tests/test_six.py')
+    prune.prune(self.package_dir, prune.rules_for({}))
+    self.assertEqual(self._files(),
+                     ['docs/index.rst', 'examples/demo.py', 'setup.py'])
+
+  def test_rules_and_labels(self):
+    self.assertIsNone(prune.rules_for({'prune': False}))
+    self.assertEqual(prune.label_with_rules(['tag', 'v1'], None),
+                     ['tag', 'v1'])
+    default_label = prune.label_with_rules(['tag', 'v1'], prune.rules_for({}))
+    self.assertEqual(default_label[:2], ['tag', 'v1'])
+    self.assertNotEqual(
+        default_label,
+        prune.label_with_rules(
+            ['tag', 'v1'], prune.rules_for({'prune': {'include': ['docs/']}})))
+    for bad in ({'exclude': 'docs/'}, {'excludes': []}, {'include': ['a//b']}):
+      with self.assertRaises(ValueError):
+        prune.rules_for({'prune': bad})
+
+  def test_git_dir_kept_out_of_tree(self):
+    cache_dir = os.path.join(self.tmp_dir, 'git-dirs')
+    self._write('.git/HEAD', 'ref')
+    prune.stash_git_dir(self.package_dir, cache_dir)
+    self.assertEqual(self._files(), [])
+    self.assertTrue(prune.restore_git_dir(self.package_dir, cache_dir))
+    self.assertEqual(self._files(), ['.git/HEAD'])
+
+    # A .git-moved dir from older versions takes over.
+    prune.stash_git_dir(self.package_dir, cache_dir)
+    self._write('.git-moved/HEAD', 'legacy')
+    self.assertTrue(prune.restore_git_dir(self.package_dir, cache_dir))
+    with open(os.path.join(self.package_dir, '.git', 'HEAD')) as f:
+      self.assertEqual(f.read(), 'legacy')
+    self.assertFalse(os.path.exists(
+        prune.git_dir_path(cache_dir, self.package_dir)))
+
+
+if __name__ == '__main__':
+  unittest.main()
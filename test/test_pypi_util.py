@@ -2,33 +2,117 @@ import unittest
 import os
 import urllib
 import urllib.request
+import urllib.response
 import io
+import http.server
+import shutil
+import tempfile
+import threading
 
 from pipsource import pypi_util
 
+PYNVIM_JSON = '{"info":{"home_page":"http://github.com/neovim/python-client"}}'
+
 
 class FakePypiHandler(urllib.request.HTTPHandler):
 
+  # Run before the default handlers so https requests are intercepted too.
+  handler_order = 100
+  requests = []
+
   def http_open(self, req):
-    resp = urllib.addinfourl(
-        io.StringIO('{"info":{"home_page":"http://github.com/neovim/python-client"}}'), "mock message", req.get_full_url())
+    FakePypiHandler.requests.append(req)
+    if req.get_header('If-none-match') == '"v1"':
+      resp = urllib.response.addinfourl(io.BytesIO(b''), {}, req.get_full_url())
+      resp.code = 304
+      resp.msg = "Not Modified"
+      return resp
+    resp = urllib.response.addinfourl(
+        io.StringIO(PYNVIM_JSON), {'ETag': '"v1"'}, req.get_full_url())
     resp.code = 200
     resp.msg = "OK"
     return resp
 
+  https_open = http_open
+
+
+class _PypiJsonHandler(http.server.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+  connections = set()
+
+  def do_GET(self):
+    _PypiJsonHandler.connections.add(self.client_address)
+    body = PYNVIM_JSON.encode()
+    self.send_response(200)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, *args):
+    pass
+
 
 class TestPypiUtil(unittest.TestCase):
 
   def setUp(self):
-    opener = urllib.request.build_opener(FakePypiHandler)
-    urllib.request.install_opener(opener)
+    FakePypiHandler.requests = []
+    self.cache_dir = tempfile.mkdtemp()
+    self.client = pypi_util.PypiClient(
+        cache_dir=self.cache_dir,
+        opener=urllib.request.build_opener(FakePypiHandler))
 
   def tearDown(self):
-    urllib._opener = None
+    shutil.rmtree(self.cache_dir)
 
   def test_get_git_url_makes_it_https(self):
     self.assertEqual(pypi_util.get_git_url(
-        'pynvim'), 'https://github.com/neovim/python-client')
+        'pynvim', client=self.client), 'https://github.com/neovim/python-client')
+
+  def test_fresh_cache_skips_request(self):
+    self.client.get_git_url('pynvim')
+    self.client.get_git_url('pynvim')
+    self.assertEqual(len(FakePypiHandler.requests), 1)
+
+  def test_stale_cache_revalidates_with_etag(self):
+    self.client.ttl = 0
+    self.client.get_git_url('pynvim')
+    self.assertEqual(
+        self.client.get_git_url('pynvim'),
+        'https://github.com/neovim/python-client')
+    self.assertEqual(len(FakePypiHandler.requests), 2)
+    self.assertEqual(
+        FakePypiHandler.requests[1].get_header('If-none-match'), '"v1"')
+
+  def test_get_git_urls(self):
+    urls = self.client.get_git_urls(['pynvim', 'neovim'])
+    self.assertEqual(urls, {
+        'pynvim': 'https://github.com/neovim/python-client',
+        'neovim': 'https://github.com/neovim/python-client',
+    })
+
+  def test_git_url_from_description(self):
+    info = {'home_page': None,
+            'description': 'Source: https://github.com/yaml/pyyaml'}
+    self.assertEqual(
+        pypi_util.git_url_from_info(info), 'https://github.com/yaml/pyyaml')
+
+  def test_keep_alive_reuses_connection(self):
+    _PypiJsonHandler.connections = set()
+    server = http.server.ThreadingHTTPServer(
+        ('127.0.0.1', 0), _PypiJsonHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+      client = pypi_util.PypiClient(
+          index_url='http://127.0.0.1:%d/pypi' % server.server_port,
+          cache_dir=None)
+      for package in ['a', 'b', 'c']:
+        client.get_git_url(package)
+    finally:
+      server.shutdown()
+      server.server_close()
+    self.assertEqual(len(_PypiJsonHandler.connections), 1)
 
 if __name__ == '__main__':
   unittest.main()
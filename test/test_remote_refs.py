@@ -0,0 +1,79 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from pipsource import remote_refs
+
+GIT = ['git', '-c', 'user.name=test', '-c', 'user.email=test@example.com']
+
+
+class TestRemoteRefs(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    self.repo = os.path.join(self.tmp, 'repo')
+    subprocess.run(['git', 'init', '-q', self.repo], check=True)
+    self._commit('setup.py', "from setuptools import setup\n"
+                 "setup(name='foo', version='1.0')\n")
+    self.url = 'file://' + self.repo
+    self.cache_path = os.path.join(self.tmp, 'refs.json')
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp)
+
+  def _commit(self, name, content):
+    with open(os.path.join(self.repo, name), 'w') as f:
+      f.write(content)
+    subprocess.run(GIT + ['add', '.'], cwd=self.repo, check=True)
+    subprocess.run(GIT + ['commit', '-qm', name], cwd=self.repo, check=True)
+    return subprocess.check_output(
+        ['git', 'rev-parse', 'HEAD'], cwd=self.repo).decode().strip()
+
+  def test_parse_ls_remote_peels_annotated_tags(self):
+    refs = remote_refs.parse_ls_remote('\n'.join([
+        'aaa\tHEAD',
+        'bbb\trefs/tags/v1.0',
+        'ccc\trefs/tags/v1.0^{}',
+        'ddd\trefs/tags/v1.1',
+    ]))
+    self.assertEqual(refs.head, 'aaa')
+    self.assertEqual(refs.tags, {'v1.0': 'ccc', 'v1.1': 'ddd'})
+
+  def test_find_tag_format(self):
+    find = remote_refs.find_tag_format
+    self.assertEqual(find('six', '1.0', {'1.0', 'v1.0'}), '%s')
+    self.assertEqual(find('six', '1.0', {'v0.9', 'v1.0'}), 'v%s')
+    self.assertEqual(find('Foo_Bar', '2.1', {'foo-bar-2.1'}), 'foo-bar-%s')
+    self.assertEqual(find('foo', '2.1', {'stable/2.1'}), 'stable/%s')
+    # A different version that happens to end with the same digits.
+    self.assertIsNone(find('foo', '2.1', {'12.1'}))
+    self.assertIsNone(find('foo', '3.0', {'v2.1'}))
+
+  def test_git_refs_are_cached(self):
+    head = self._commit('a.txt', 'a')
+    subprocess.run(GIT + ['tag', '-a', '-m', 'v1.0', 'v1.0'], cwd=self.repo,
+                   check=True)
+    refs = remote_refs.RemoteRefs(self.cache_path)
+    self.assertEqual(refs.git_refs(self.url),
+                     remote_refs.Refs(head, {'v1.0': head}))
+    refs.save()
+
+    subprocess.run(GIT + ['tag', 'v1.1'], cwd=self.repo, check=True)
+    reloaded = remote_refs.RemoteRefs(self.cache_path)
+    self.assertNotIn('v1.1', reloaded.git_refs(self.url).tags)
+    self.assertIn('v1.1', reloaded.git_refs(self.url, refresh=True).tags)
+    # Refreshing again in the same run reuses that listing.
+    subprocess.run(GIT + ['tag', 'v1.2'], cwd=self.repo, check=True)
+    self.assertNotIn('v1.2', reloaded.git_refs(self.url, refresh=True).tags)
+
+  def test_export_commit(self):
+    head = self._commit('a.txt', 'a')
+    export_dir = os.path.join(self.tmp, 'export')
+    remote_refs.export_commit(self.repo, head, export_dir)
+    self.assertEqual(sorted(os.listdir(export_dir)), ['a.txt', 'setup.py'])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,10 +1,27 @@
 import unittest
 import os
+import shutil
+import tempfile
+from unittest import mock
 
 from pipsource import requirements
+from pipsource import resolver
 
 class TestRequirements(unittest.TestCase):
 
+    def setUp(self):
+      self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+      shutil.rmtree(self.tmp)
+
+    def _write(self, name, content):
+      path = os.path.join(self.tmp, name)
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+      with open(path, 'w') as f:
+        f.write(content)
+      return path
+
     def test_parse(self):
       script_dir = os.path.abspath(os.path.dirname(__file__))
       req_file = os.path.join(script_dir, "fixtures/requirements.txt")
@@ -16,5 +33,67 @@ class TestRequirements(unittest.TestCase):
         requirements.Requirement(package='autopep8', version='1.4.4'),
         ])
 
+    def test_hashes_markers_and_comments(self):
+      path = self._write('requirements.txt', '\n'.join([
+          '--index-url https://pypi.org/simple',
+          'six==1.12.0 \\',
+          '    --hash=sha256:aaa \\',
+          '    --hash sha256:bbb  # via pynvim',
+          'requests[security] == 2.22.0',
+          'enum34==1.1.6 ; python_version < "3.4"',
+          '',
+      ]))
+
+      self.assertEqual(requirements.load(path), [
+          requirements.Requirement('six', '1.12.0', None,
+                                   ('sha256:aaa', 'sha256:bbb')),
+          requirements.Requirement('requests', '2.22.0'),
+          requirements.Requirement('enum34', '1.1.6',
+                                   'python_version < "3.4"'),
+      ])
+      self.assertFalse(requirements.applies(requirements.load(path)[2]))
+      self.assertTrue(requirements.applies(requirements.load(path)[0]))
+      # The same without the optional packaging library, as on CI.
+      with mock.patch.object(resolver, 'Marker', None):
+        self.assertFalse(requirements.applies(requirements.load(path)[2]))
+        self.assertTrue(requirements.applies(requirements.load(path)[0]))
+
+    def test_includes_and_constraints(self):
+      self._write('base/common.txt', 'attrs==19.1.0\n')
+      self._write('constraints.txt', 'six==1.12.0 --hash=sha256:aaa\n')
+      path = self._write('requirements.txt', '\n'.join([
+          '-r base/common.txt',
+          '--constraint=constraints.txt',
+          'six',
+          'attrs==19.1.0',
+      ]))
+
+      self.assertEqual(requirements.load(path), [
+          requirements.Requirement('attrs', '19.1.0'),
+          requirements.Requirement('six', '1.12.0', None, ('sha256:aaa',)),
+      ])
+
+    def test_errors(self):
+      for content in ('six>=1.0\n', 'six\n', 'six==1.0\nsix==1.1\n',
+                      '--no-deps\n'):
+        path = self._write('requirements.txt', content)
+        with self.assertRaises(ValueError):
+          requirements.load(path)
+
+    def test_memoized_by_mtime(self):
+      self._write('common.txt', 'attrs==19.1.0\n')
+      path = self._write('requirements.txt', '-r common.txt\n')
+      self.assertEqual(requirements.load(path),
+                       [requirements.Requirement('attrs', '19.1.0')])
+      cached = requirements._cache[path]
+      requirements.load(path)
+      self.assertIs(requirements._cache[path], cached)
+
+      common = self._write('common.txt', 'attrs==19.3.0\n')
+      stat = os.stat(common)
+      os.utime(common, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+      self.assertEqual(requirements.load(path),
+                       [requirements.Requirement('attrs', '19.3.0')])
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,147 @@
+import json
+import os
+import shutil
+import tempfile
+import textwrap
+import unittest
+from unittest import mock
+
+from pipsource import resolver
+
+
+class TestResolver(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp)
+
+  def _package(self, name, setup_py):
+    package_dir = os.path.join(self.tmp, name)
+    os.makedirs(package_dir)
+    with open(os.path.join(package_dir, 'setup.py'), 'w') as f:
+      f.write(textwrap.dedent(setup_py))
+    return package_dir
+
+  def test_requirement_name(self):
+    self.assertEqual(resolver.requirement_name('PyYAML>=5.1'), 'pyyaml')
+    self.assertEqual(
+        resolver.requirement_name('msgpack_python[x] (>=0.5)'),
+        'msgpack-python')
+    self.assertIsNone(resolver.requirement_name('# just a comment'))
+
+  def test_requirement_marker(self):
+    env = {'python_version': '3.7'}
+    self.assertIsNone(resolver.requirement_name(
+        'trollius; python_version < "3.4"', env))
+    self.assertEqual(resolver.requirement_name(
+        'greenlet; python_version >= "3.4"', env), 'greenlet')
+
+  def test_markers_without_packaging(self):
+    python2 = {'python_version': '2.7', 'python_full_version': '2.7.18',
+               'sys_platform': 'linux2'}
+    with mock.patch.object(resolver, 'Marker', None):
+      applies = resolver.marker_applies
+      self.assertFalse(applies('sys_platform == "win32"', python2))
+      self.assertTrue(applies("python_version < '3.4'", python2))
+      self.assertFalse(applies('python_version >= "3"', python2))
+      self.assertTrue(applies('python_full_version ~= "2.7.1"', python2))
+      self.assertTrue(applies('python_version == "2.*"', python2))
+      self.assertTrue(applies(
+          '(sys_platform == "win32" or python_version < "3") and '
+          '"linux" in sys_platform', python2))
+      self.assertFalse(applies(
+          'python_version > "2.7" or sys_platform != "linux2"', python2))
+      self.assertTrue(applies('python_version >= "3.4"'))
+      with self.assertLogs(level='WARNING'):
+        self.assertTrue(applies('extra == "socks"', python2))
+
+  def test_levels(self):
+    graph = {
+        'pynvim': {'msgpack', 'greenlet'},
+        'msgpack': set(),
+        'greenlet': set(),
+        'app': {'pynvim'},
+    }
+    self.assertEqual(resolver.levels(graph),
+                     [['greenlet', 'msgpack'], ['pynvim'], ['app']])
+
+  def test_levels_with_cycle(self):
+    self.assertEqual(resolver.levels({'a': {'b'}, 'b': {'a'}, 'c': set()}),
+                     [['c'], ['a', 'b']])
+
+  def test_resolve_reads_vendored_sources(self):
+    pynvim = self._package('pynvim', '''
+        from setuptools import setup
+        REQUIRES = ['msgpack>=0.5.0', 'greenlet']
+        setup(name='pynvim', install_requires=REQUIRES)
+        ''')
+    msgpack = self._package('msgpack', '''
+        from setuptools import setup
+        setup(name='msgpack')
+        ''')
+    levels = resolver.Resolver().resolve(
+        [('pynvim', '0.3.2'), ('msgpack', '0.6.1'), ('greenlet', '0.4.15')],
+        {'pynvim': pynvim, 'msgpack': msgpack},
+        extra_requires={'greenlet': []})
+    self.assertEqual(levels, [
+        [('greenlet', '0.4.15'), ('msgpack', '0.6.1')],
+        [('pynvim', '0.3.2')],
+    ])
+
+  def test_extra_requires_from_config(self):
+    levels = resolver.Resolver().resolve(
+        [('a', '1'), ('B_pkg', '2')], {}, extra_requires={'a': ['b-pkg']})
+    self.assertEqual(levels, [[('B_pkg', '2')], [('a', '1')]])
+
+  def test_setup_cfg_install_requires(self):
+    package_dir = os.path.join(self.tmp, 'cfg')
+    os.makedirs(package_dir)
+    with open(os.path.join(package_dir, 'setup.cfg'), 'w') as f:
+      f.write('[options]\ninstall_requires =\n    six\n    attrs>=19\n')
+    self.assertEqual(resolver.read_install_requires(package_dir),
+                     ['six', 'attrs>=19'])
+
+  def test_cache_by_key(self):
+    package_dir = self._package('a', '''
+        from setuptools import setup
+        setup(name='a', install_requires=['b'])
+        ''')
+    cache_path = os.path.join(self.tmp, 'deps.json')
+    dep_resolver = resolver.Resolver(cache_path)
+    self.assertEqual(dep_resolver.install_requires(package_dir, 'tree'), ['b'])
+    dep_resolver.save()
+    shutil.rmtree(package_dir)
+    reloaded = resolver.Resolver(cache_path)
+    self.assertEqual(reloaded.install_requires(package_dir, 'tree'), ['b'])
+
+  def test_read_pipfile_lock(self):
+    path = os.path.join(self.tmp, 'Pipfile.lock')
+    with open(path, 'w') as f:
+      json.dump({'default': {
+          'pyyaml': {'version': '==5.1.1'},
+          'pynvim': {'version': '==0.3.2'},
+          'unpinned': {'version': '*'},
+      }}, f)
+    self.assertEqual(resolver.read_pipfile_lock(path),
+                     [('pynvim', '0.3.2'), ('pyyaml', '5.1.1')])
+
+  def test_read_pipfile_lock_markers(self):
+    path = os.path.join(self.tmp, 'Pipfile.lock')
+    with open(path, 'w') as f:
+      json.dump({'default': {
+          'enum34': {'version': '==1.1.6',
+                     'markers': "python_version < '3.4'"},
+          'six': {'version': '==1.12.0'},
+      }}, f)
+    python2 = {'python_version': '2.7', 'python_full_version': '2.7.18'}
+    python3 = {'python_version': '3.11', 'python_full_version': '3.11.4'}
+    self.assertEqual(resolver.read_pipfile_lock(path, python2),
+                     [('enum34', '1.1.6'), ('six', '1.12.0')])
+    self.assertEqual(resolver.read_pipfile_lock(path, python3),
+                     [('six', '1.12.0')])
+
+
+if __name__ == '__main__':
+  unittest.main()
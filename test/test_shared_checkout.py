@@ -0,0 +1,97 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from pipsource import locking
+from pipsource import shared_checkout
+
+GIT = ['git', '-c', 'user.name=test', '-c', 'user.email=test@example.com']
+
+
+class TestSharedCheckout(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    self.repo = os.path.join(self.tmp, 'mono')
+    for path in ('client/setup.py', 'server/setup.py', 'server/client/x.py',
+                 'big/blob.bin'):
+      os.makedirs(os.path.dirname(os.path.join(self.repo, path)),
+                  exist_ok=True)
+      with open(os.path.join(self.repo, path), 'w') as f:
+        f.write(path)
+    subprocess.run(['git', 'init', '-q', self.repo], check=True)
+    subprocess.run(GIT + ['add', '.'], cwd=self.repo, check=True)
+    subprocess.run(GIT + ['commit', '-qm', 'init'], cwd=self.repo, check=True)
+    self.commit = subprocess.check_output(
+        ['git', 'rev-parse', 'HEAD'], cwd=self.repo).decode().strip()
+    self.cache_dir = os.path.join(self.tmp, 'checkouts')
+    self.url = 'https://example.com/mono.git'
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp)
+
+  def _files(self, path):
+    files = []
+    for root, dirs, names in os.walk(path):
+      dirs[:] = [d for d in dirs if d != '.git']
+      files += [os.path.relpath(os.path.join(root, name), path)
+                for name in names]
+    return sorted(files)
+
+  def _ensure(self, subdir, url=None):
+    with shared_checkout.ensure(self.cache_dir, url or self.url, self.commit,
+                                subdir, self.repo) as source_dir:
+      return source_dir
+
+  def test_siblings_share_one_sparse_checkout(self):
+    client = self._ensure('client')
+    checkout = shared_checkout.checkout_path(self.cache_dir, self.url,
+                                             self.commit)
+    self.assertEqual(client, os.path.join(checkout, 'client'))
+    self.assertEqual(self._files(checkout), ['client/setup.py'])
+
+    server = self._ensure('server')
+    self.assertEqual(server, os.path.join(checkout, 'server'))
+    self.assertEqual(self._files(checkout), [
+        'client/setup.py', 'server/client/x.py', 'server/setup.py'])
+    self.assertEqual(shared_checkout.sparse_dirs(checkout),
+                     ['client', 'server'])
+    self.assertEqual(
+        [name for name in os.listdir(self.cache_dir)
+         if not name.endswith('.lock') and
+         name != shared_checkout.INDEX_FILE_NAME],
+        [os.path.basename(checkout)])
+
+    with self.assertRaises(ValueError):
+      self._ensure('missing')
+
+  def test_evicts_least_recently_used(self):
+    other_url = 'https://example.com/fork/mono.git'
+    old = os.path.dirname(self._ensure('client'))
+    new = os.path.dirname(self._ensure('client', other_url))
+    total = shared_checkout.total_bytes(self.cache_dir)
+    self.assertGreater(total, 0)
+    shared_checkout.evict(self.cache_dir, total - 1)
+    self.assertFalse(os.path.exists(old))
+    self.assertTrue(os.path.exists(new))
+
+    # Checkouts in use elsewhere are never removed.
+    with locking.file_lock(new + '.lock'):
+      shared_checkout.evict(self.cache_dir, 0)
+      self.assertTrue(os.path.exists(new))
+    shared_checkout.evict(self.cache_dir, 0)
+    self.assertFalse(os.path.exists(new))
+    self.assertEqual(shared_checkout.total_bytes(self.cache_dir), 0)
+
+  def test_subdir_validation(self):
+    self.assertEqual(shared_checkout.subdir_for({}), None)
+    self.assertEqual(shared_checkout.subdir_for({'subdir': 'a/b/'}), 'a/b')
+    for bad in ('', '/abs', '../up', 'a/../..', '.', 'a/.git', 3):
+      with self.assertRaises(ValueError):
+        shared_checkout.subdir_for({'subdir': bad})
+
+
+if __name__ == '__main__':
+  unittest.main()
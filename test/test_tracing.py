@@ -0,0 +1,76 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+from pipsource import pipeline
+from pipsource import tracing
+
+
+class TestTracing(unittest.TestCase):
+
+  def setUp(self):
+    self.tracer = tracing.reset()
+
+  def test_nested_spans_inherit_package(self):
+    with tracing.span('fetch', package='six'):
+      with tracing.span('clone'):
+        pass
+    spans = {s.name: s for s in self.tracer.spans()}
+    self.assertEqual(spans['clone'].package, 'six')
+    self.assertEqual(spans['clone'].depth, 1)
+    self.assertEqual(spans['fetch'].depth, 0)
+    self.assertGreaterEqual(spans['fetch'].duration, spans['clone'].duration)
+
+  def test_spans_are_per_thread(self):
+    def work():
+      with tracing.span('other'):
+        pass
+
+    with tracing.span('outer', package='a'):
+      thread = threading.Thread(target=work)
+      thread.start()
+      thread.join()
+    spans = {s.name: s for s in self.tracer.spans()}
+    self.assertIsNone(spans['other'].package)
+    self.assertEqual(spans['other'].depth, 0)
+
+  def test_subprocess_time_goes_to_innermost_span(self):
+    with tracing.span('outer'):
+      with tracing.span('inner'):
+        tracing.run_subprocess([sys.executable, '-c', 'pass'])
+    spans = {s.name: s for s in self.tracer.spans()}
+    self.assertGreater(spans['inner'].subprocess_seconds, 0)
+    self.assertEqual(spans['outer'].subprocess_seconds, 0)
+
+  def test_pipeline_stages_are_traced(self):
+    stages = [pipeline.Stage('work', lambda x: x, 2)]
+    pipeline.run(['a', 'b'], stages)
+    spans = self.tracer.spans()
+    self.assertEqual(sorted(s.package for s in spans), ['a', 'b'])
+    summary = '\n'.join(self.tracer.summary_lines())
+    self.assertIn('Slowest packages:', summary)
+    self.assertIn('work', summary)
+
+  def test_chrome_trace(self):
+    with tracing.span('fetch', package='six'):
+      pass
+    trace_dir = tempfile.mkdtemp()
+    try:
+      path = os.path.join(trace_dir, 'trace.json')
+      self.tracer.write_chrome_trace(path)
+      with open(path) as trace_file:
+        events = json.load(trace_file)['traceEvents']
+    finally:
+      shutil.rmtree(trace_dir)
+    self.assertEqual(len(events), 1)
+    self.assertEqual(events[0]['name'], 'fetch')
+    self.assertEqual(events[0]['ph'], 'X')
+    self.assertEqual(events[0]['args']['package'], 'six')
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,149 @@
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+from unittest import mock
+
+from pipsource import content_store
+from pipsource import manifest
+from pipsource import vendor_gc
+
+
+class TestVendorGc(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.vendor_dir = os.path.join(self.tmp_dir, 'vendor')
+    os.makedirs(self.vendor_dir)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def _package(self, name, size, age=0):
+    package_dir = os.path.join(self.vendor_dir, name)
+    os.makedirs(os.path.join(package_dir, 'src'))
+    path = os.path.join(package_dir, 'src', 'data')
+    with open(path, 'w') as f:
+      f.write('x' * size)
+    when = 1000000000 + age
+    os.utime(path, (when, when))
+    os.utime(os.path.join(package_dir, 'src'), (when, when))
+    return package_dir
+
+  def _root(self, name, content):
+    path = os.path.join(self.tmp_dir, name)
+    with open(path, 'w') as f:
+      f.write(content)
+    return path
+
+  def test_collect_roots(self):
+    script = self._root('install.sh', '\n'.join([
+        '#!/usr/bin/env bash',
+        'pip_wheel_vendored Py_Yaml "5.1" abc',
+        'pip_install_vendored six "1.12.0"',
+    ]))
+    lock = self._root('Pipfile.lock', json.dumps(
+        {'_meta': {}, 'default': {'attrs': {'version': '==19.1.0'}}}))
+    package_map = self._root('package_map.json', json.dumps(
+        {'autoflake': {'git': 'https://github.com/myint/autoflake'}}))
+    self.assertEqual(
+        vendor_gc.collect_roots([script, lock, package_map]),
+        {'py-yaml', 'six', 'attrs', 'autoflake'})
+    vendor_manifest = self._root(manifest.MANIFEST_FILE_NAME, json.dumps(
+        {'version': manifest.MANIFEST_FORMAT_VERSION, 'packages': {}}))
+    with self.assertRaises(ValueError):
+      vendor_gc.collect_roots([script, vendor_manifest])
+
+  def test_find_garbage_oldest_first(self):
+    self._package('used', 10)
+    self._package('new', 20, age=200)
+    self._package('old', 30, age=100)
+    os.makedirs(os.path.join(self.vendor_dir, vendor_gc.TRASH_DIR_NAME))
+    garbage = vendor_gc.find_garbage(self.vendor_dir, {'used'})
+    self.assertEqual([c.package for c in garbage], ['old', 'new'])
+    self.assertEqual([c.bytes for c in garbage], [30, 20])
+
+  def test_hardlinked_files_are_not_reclaimable(self):
+    package_dir = self._package('linked', 10)
+    os.link(os.path.join(package_dir, 'src', 'data'),
+            os.path.join(self.tmp_dir, 'store-object'))
+    garbage, = vendor_gc.find_garbage(self.vendor_dir, set())
+    self.assertEqual(garbage.bytes, 10)
+    self.assertEqual(garbage.reclaimable_bytes, 0)
+
+  def test_select_with_budget(self):
+    self._package('a', 100, age=1)
+    self._package('b', 100, age=2)
+    self._package('c', 100, age=3)
+    garbage = vendor_gc.find_garbage(self.vendor_dir, set())
+    self.assertEqual(
+        [c.package for c in vendor_gc.select(garbage, 150)], ['a', 'b'])
+    self.assertEqual(len(vendor_gc.select(garbage)), 3)
+
+  def test_collect(self):
+    self._package('used', 10)
+    unused_dir = self._package('unused', 10)
+    vendor_manifest = manifest.Manifest(
+        os.path.join(self.vendor_dir, manifest.MANIFEST_FILE_NAME))
+    for package in ('used', 'unused'):
+      vendor_manifest.record(package, '1', 'url', ['tag', '1'], None, 'tree',
+                             os.path.join(self.vendor_dir, package))
+    vendor_manifest.save()
+    script = self._root('install.sh', 'pip_wheel_vendored used "1" tree\n')
+
+    with redirect_stdout(io.StringIO()):
+      removed = vendor_gc.collect(self.vendor_dir, [script], dry_run=True)
+    self.assertEqual([c.package for c in removed], ['unused'])
+    self.assertTrue(os.path.isdir(unused_dir))
+
+    with redirect_stdout(io.StringIO()):
+      vendor_gc.collect(self.vendor_dir, [script], background=False)
+    self.assertFalse(os.path.exists(unused_dir))
+    self.assertEqual(
+        os.listdir(os.path.join(self.vendor_dir, vendor_gc.TRASH_DIR_NAME)),
+        [])
+    vendor_manifest = manifest.Manifest(vendor_manifest.path)
+    self.assertEqual(list(vendor_manifest.packages()), ['used'])
+
+  def test_collects_store_objects_only_removed_packages_use(self):
+    store = content_store.ContentStore(os.path.join(self.tmp_dir, 'store'))
+    for name, size, when in (('used', 10, 3), ('old', 100, 1),
+                             ('new', 1000, 2)):
+      package_dir = self._package(name, size)
+      with open(os.path.join(package_dir, 'shared.py'), 'w') as f:
+        f.write('shared by all')
+      tree = store.import_tree(package_dir)
+      store.set_ref(name, '1', ['tag', '1'], tree)
+      store.record_checkout(package_dir, tree)
+      os.utime(store._ref_path(name, '1'), (when, when))
+    # A version of a removed package that is no longer checked out anywhere.
+    store.set_ref('old', '0', ['tag', '0'], store.import_tree(
+        self._package('scratch', 7)))
+    shutil.rmtree(os.path.join(self.vendor_dir, 'scratch'))
+    os.utime(store._ref_path('old', '0'), (1, 1))
+
+    garbage = vendor_gc.find_garbage(self.vendor_dir, {'used'}, store=store)
+    self.assertEqual([(c.package, c.reclaimable_bytes) for c in garbage],
+                     [('old', 107), ('new', 1000)])
+    self.assertEqual(
+        [c.package for c in vendor_gc.select(garbage, 50)], ['old'])
+
+    script = self._root('install.sh', 'pip_wheel_vendored used "1" tree\n')
+    with redirect_stdout(io.StringIO()), mock.patch.object(
+        content_store, 'SWEEP_GRACE_SECONDS', 0):
+      vendor_gc.collect(self.vendor_dir, [script], free_bytes=50,
+                        background=False, store_dir=store.root)
+    self.assertEqual(sorted((r.package, r.version) for r in store.list_refs()),
+                     [('new', '1'), ('used', '1')])
+    objects = [os.path.getsize(os.path.join(root, name)) for root, _, names
+               in os.walk(os.path.join(store.root, 'objects'))
+               for name in names]
+    self.assertEqual(sorted(objects), [10, 13, 1000])
+    self.assertTrue(os.path.isdir(os.path.join(self.vendor_dir, 'new')))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,184 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+from unittest import mock
+
+from pipsource import vendor_packages
+
+GIT = ['git', '-c', 'user.name=test', '-c', 'user.email=test@example.com']
+
+
+class TestBatch(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def test_read_batch_file(self):
+    path = os.path.join(self.tmp_dir, 'projects.txt')
+    with open(path, 'w') as f:
+      f.write('# services\napi python2 python3\n\nweb  # default python\n')
+    self.assertEqual(vendor_packages.read_batch_file(path), [
+        (os.path.join(self.tmp_dir, 'api'), 'python2'),
+        (os.path.join(self.tmp_dir, 'api'), 'python3'),
+        (os.path.join(self.tmp_dir, 'web'), 'python'),
+    ])
+
+  def test_script_names_per_interpreter(self):
+    names = vendor_packages._script_and_venv_names(
+        [('api', 'python2'), ('api', '/usr/bin/python3'), ('web', 'python')])
+    self.assertEqual(names[('web', 'python')],
+                     ('install_venv_vendored.sh', '.venv-vendored'))
+    self.assertEqual(names[('api', '/usr/bin/python3')],
+                     ('install_venv_vendored_python3.sh',
+                      '.venv-vendored-python3'))
+
+  def test_union_of_plans(self):
+    union, plans, versioned = vendor_packages._union_of_plans({
+        ('api', 'python3'): [('PyYAML', '5.1'), ('six', '1.12.0')],
+        ('web', 'python3'): [('pyyaml', '5.1'), ('attrs', '19.1.0')],
+    })
+    self.assertEqual(versioned, set())
+    self.assertEqual(union, [('PyYAML', '5.1'), ('six', '1.12.0'),
+                             ('attrs', '19.1.0')])
+    self.assertEqual(plans[('web', 'python3')],
+                     [('PyYAML', '5.1'), ('attrs', '19.1.0')])
+
+    union, plans, versioned = vendor_packages._union_of_plans({
+        ('web', 'python2'): [('six', '1.11.0')],
+        ('api', 'python3'): [('six', '1.12.0'), ('attrs', '19.1.0')],
+        ('cli', 'python3'): [('six', '1.12.0')],
+    })
+    self.assertEqual(versioned, {('six', '1.11.0')})
+    self.assertEqual(union, [('six', '1.11.0'), ('six', '1.12.0'),
+                             ('attrs', '19.1.0')])
+    self.assertEqual(plans[('web', 'python2')], [('six', '1.11.0')])
+    self.assertEqual(vendor_packages._vendor_name('six', '1.11.0', True),
+                     'six@1.11.0')
+
+  def test_prints_daemon_output(self):
+    result = {'scripts': [], 'output': ['[six] Cloning'],
+              'failures': [['fetch', 'six', 'no such tag']]}
+    with mock.patch.object(vendor_packages.daemon, 'request',
+                           return_value=result), \
+        mock.patch('builtins.print') as print_mock:
+      with self.assertRaises(SystemExit):
+        vendor_packages._vendor_with_daemon([('api', 'python3')], '')
+    print_mock.assert_called_once_with('[six] Cloning')
+
+  def test_falls_back_in_process_on_daemon_error(self):
+    socket_path = os.path.join(self.tmp_dir, 'daemon.sock')
+    open(socket_path, 'w').close()
+    argv = ['vendor_packages.py', self.tmp_dir, '--daemon-socket', socket_path]
+    saved = {name: getattr(vendor_packages, name) for name in [
+        'MIRROR_CACHE_DIR', 'MIRROR_CACHE_MAX_BYTES', '_pypi_client',
+        'CONTENT_STORE_DIR', 'CONTENT_STORE_LINK_MODE', 'WHEEL_CACHE_DIR',
+        'VENV_SNAPSHOT_DIR', 'GIT_DIR_CACHE_DIR', 'SHARED_CHECKOUT_DIR',
+        'SHARED_CHECKOUT_MAX_BYTES', 'TRACE_FILE', 'PACKAGE_MAP_FILE',
+        'DAEMON_SOCKET']}
+    with mock.patch.multiple(vendor_packages, **saved), \
+        mock.patch('sys.argv', argv), \
+        mock.patch.object(vendor_packages.daemon, 'request',
+                          side_effect=vendor_packages.daemon.DaemonError('x')), \
+        mock.patch.object(vendor_packages, 'vendor_batch') as vendor_batch, \
+        mock.patch.object(vendor_packages, '_report_timing'), \
+        mock.patch('builtins.print'):
+      with self.assertRaises(SystemExit) as cm:
+        vendor_packages.main()
+    self.assertEqual(cm.exception.code, 0)
+    vendor_batch.assert_called_once()
+
+  def test_should_vendor_per_interpreter(self):
+    package_map = {
+        'enum34': {'skip-vendor-python3': True},
+        'typing': {'skip-vendor-python2': True},
+        'old': {'skip-vendor': True},
+    }
+    should_vendor = vendor_packages._should_vendor
+    self.assertFalse(should_vendor('enum34', package_map, 'python3.7'))
+    self.assertTrue(should_vendor('enum34', package_map, 'python2'))
+    self.assertFalse(should_vendor('typing', package_map, 'python2.7'))
+    self.assertTrue(should_vendor('typing', package_map, 'python3'))
+    self.assertFalse(should_vendor('old', package_map, 'python3'))
+    self.assertTrue(should_vendor('six', package_map, 'python3'))
+
+
+class TestVendorPackage(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.repo = os.path.join(self.tmp_dir, 'repo')
+    os.makedirs(self.repo)
+    with open(os.path.join(self.repo, 'setup.py'), 'w') as f:
+      f.write('setup(name="pkg", version="1.0")\n')
+    subprocess.run(['git', 'init', '-q', self.repo], check=True)
+    subprocess.run(GIT + ['add', '.'], cwd=self.repo, check=True)
+    subprocess.run(GIT + ['commit', '-qm', '1.0'], cwd=self.repo, check=True)
+    subprocess.run(GIT + ['tag', '1.0'], cwd=self.repo, check=True)
+    self.vendor_dir = os.path.join(self.tmp_dir, 'vendor')
+    patcher = mock.patch.multiple(
+        vendor_packages,
+        PIP_VENDOR_DIR=self.vendor_dir,
+        MIRROR_CACHE_DIR=os.path.join(self.tmp_dir, 'mirrors'),
+        CONTENT_STORE_DIR=os.path.join(self.tmp_dir, 'store'),
+        GIT_DIR_CACHE_DIR=os.path.join(self.tmp_dir, 'git-dirs'),
+        SHARED_CHECKOUT_DIR=os.path.join(self.tmp_dir, 'checkouts'),
+        _mirror_cache=None, _content_store=None, _manifest=None,
+        _integrity_record=None)
+    patcher.start()
+    self.addCleanup(patcher.stop)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def test_restores_deleted_package_dir(self):
+    package_info = {'git': 'file://' + self.repo}
+    package_dir = os.path.join(self.vendor_dir, 'pkg')
+    setup_py = os.path.join(package_dir, 'setup.py')
+    vendor_manifest = vendor_packages._get_manifest()
+    with mock.patch.object(vendor_packages.pipeline, 'log'):
+      vendor_packages._vendor_package('pkg', '1.0', package_info,
+                                      ('tag', '1.0'))
+      label = vendor_manifest.get('pkg').label
+      shutil.rmtree(package_dir)
+      self.assertFalse(vendor_manifest.is_current(
+          'pkg', '1.0', package_info['git'], label, package_dir))
+
+      # Relinked from the content store, without fetching again.
+      vendor_packages._vendor_package('pkg', '1.0', package_info,
+                                      ('tag', '1.0'))
+    self.assertTrue(os.path.isfile(setup_py))
+    self.assertTrue(vendor_manifest.is_current(
+        'pkg', '1.0', package_info['git'], label, package_dir))
+
+  def test_other_version_gets_its_own_dir(self):
+    with open(os.path.join(self.repo, 'setup.py'), 'w') as f:
+      f.write('setup(name="pkg", version="1.1")\n')
+    subprocess.run(GIT + ['commit', '-qam', '1.1'], cwd=self.repo, check=True)
+    subprocess.run(GIT + ['tag', '1.1'], cwd=self.repo, check=True)
+    package_info = {'git': 'file://' + self.repo}
+    with mock.patch.object(vendor_packages.pipeline, 'log'):
+      vendor_packages._vendor_package('pkg', '1.0', package_info,
+                                      ('tag', '1.0'))
+      vendor_packages._vendor_package('pkg', '1.1', package_info,
+                                      ('tag', '1.1'))
+      # 1.0 is in the content store, so it is linked from there.
+      with mock.patch.object(vendor_packages, '_vendor_git_package',
+                             side_effect=AssertionError('fetched')):
+        vendor_packages._vendor_package('pkg', '1.0', package_info,
+                                        ('tag', '1.0'), 'pkg@1.0')
+
+    vendor_manifest = vendor_packages._get_manifest()
+    self.assertEqual(vendor_manifest.get('pkg').version, '1.1')
+    self.assertEqual(vendor_manifest.get('pkg@1.0').version, '1.0')
+    for name, version in (('pkg', '1.1'), ('pkg@1.0', '1.0')):
+      with open(os.path.join(self.vendor_dir, name, 'setup.py')) as f:
+        self.assertIn('version="%s"' % version, f.read())
+
+
+if __name__ == '__main__':
+  unittest.main()
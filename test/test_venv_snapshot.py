@@ -0,0 +1,92 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+import venv
+
+from pipsource import venv_snapshot
+
+
+class TestVenvSnapshot(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.snapshot_dir = os.path.join(self.tmp_dir, 'snapshots')
+    self.python = sys.executable
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def _venv(self, name):
+    venv_dir = os.path.join(self.tmp_dir, name, '.venv-vendored')
+    venv.create(venv_dir, with_pip=False)
+    with open(os.path.join(venv_dir, 'bin', 'tool'), 'w') as f:
+      f.write('#!%s/bin/python\nprint("tool")\n' % venv_dir)
+    os.chmod(os.path.join(venv_dir, 'bin', 'tool'), 0o755)
+    return venv_dir
+
+  def test_packages_from_install_lines(self):
+    self.assertEqual(venv_snapshot.packages_from_install_lines([
+        '# Dependency level 0',
+        'pip_wheel_vendored six "1.12.0" abc',
+        'pip_wheel_vendored pbr "5.4" def git_version_tag',
+        'pip_wheel_vendored six@1.11.0 "1.11.0" ghi',
+    ]), ['six@abc', 'pbr@def', 'six@ghi'])
+
+  def test_closest_snapshot(self):
+    def snapshot(name, packages):
+      return venv_snapshot.Snapshot(name, 'python', 'abi', '/venv', packages,
+                                    0.0)
+
+    snapshots = [
+        snapshot('old', ['six@1', 'attrs@1']),
+        snapshot('close', ['six@2', 'attrs@1', 'pbr@1']),
+        snapshot('unrelated', ['yaml@1']),
+    ]
+    self.assertEqual(venv_snapshot.closest_snapshot(
+        snapshots, ['six@2', 'attrs@1', 'pbr@2']).path, 'close')
+    self.assertIsNone(
+        venv_snapshot.closest_snapshot(snapshots, ['requests@1']))
+
+  def test_save_and_restore_elsewhere(self):
+    venv_dir = self._venv('first')
+    saved = venv_snapshot.save(self.snapshot_dir, self.python, 'abi',
+                               venv_dir, ['six@1'])
+    self.assertEqual(saved.prefix, venv_dir)
+
+    dest = os.path.join(self.tmp_dir, 'second', '.venv-vendored')
+    restored = venv_snapshot.restore(self.snapshot_dir, self.python, 'abi',
+                                     dest, ['six@1', 'attrs@1'])
+    self.assertEqual(restored.path, saved.path)
+    with open(os.path.join(dest, 'bin', 'activate')) as f:
+      activate = f.read()
+    self.assertIn(dest, activate)
+    self.assertNotIn(venv_dir, activate)
+    with open(os.path.join(dest, 'bin', 'tool')) as f:
+      self.assertEqual(f.readline(), '#!%s/bin/python\n' % dest)
+    output = subprocess.check_output(
+        [os.path.join(dest, 'bin', 'python'), '-c',
+         'import sys; print(sys.prefix)'])
+    self.assertEqual(output.decode().strip(), dest)
+    # The snapshot itself is untouched.
+    with open(os.path.join(saved.path, 'venv', 'bin', 'tool')) as f:
+      self.assertEqual(f.readline(), '#!%s/bin/python\n' % venv_dir)
+
+    self.assertIsNone(venv_snapshot.restore(
+        self.snapshot_dir, self.python, 'other-abi',
+        os.path.join(self.tmp_dir, 'third'), ['six@1']))
+
+  def test_old_snapshots_are_pruned(self):
+    venv_dir = self._venv('first')
+    for index in range(3):
+      venv_snapshot.save(self.snapshot_dir, self.python, 'abi', venv_dir,
+                         ['six@%d' % index], max_snapshots=2)
+    snapshots = venv_snapshot.list_snapshots(self.snapshot_dir, self.python,
+                                             'abi')
+    self.assertEqual([s.packages for s in snapshots], [['six@2'], ['six@1']])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,113 @@
+import os
+import shutil
+import sys
+import tempfile
+import textwrap
+import unittest
+
+from pipsource import version_probe
+
+
+class TestVersionProbe(unittest.TestCase):
+
+  def setUp(self):
+    self.package_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.package_dir)
+
+  def _write(self, name, contents):
+    path = os.path.join(self.package_dir, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+      f.write(textwrap.dedent(contents))
+
+  def test_setup_py_literal(self):
+    self._write('setup.py', '''
+        from setuptools import setup
+        setup(name='pynvim', version='0.3.2')
+        ''')
+    self.assertEqual(version_probe.detect(self.package_dir),
+                     version_probe.VersionInfo('0.3.2', False))
+
+  def test_setup_py_module_constant(self):
+    self._write('setup.py', '''
+        import setuptools
+        VERSION = '1.4.4'
+        setuptools.setup(name='autopep8', version=VERSION)
+        ''')
+    self.assertEqual(version_probe.detect(self.package_dir).version, '1.4.4')
+
+  def test_setup_py_scm(self):
+    self._write('setup.py', '''
+        from setuptools import setup
+        setup(name='x', use_scm_version=True, setup_requires=['setuptools_scm'])
+        ''')
+    self.assertTrue(version_probe.detect(self.package_dir).scm)
+
+  def test_setup_cfg_attr(self):
+    self._write('setup.cfg', '''
+        [metadata]
+        name = example
+        version = attr: example.__version__
+        ''')
+    self._write('src/example/__init__.py', "__version__ = '2.0.1'\n")
+    self.assertEqual(version_probe.detect(self.package_dir).version, '2.0.1')
+
+  @unittest.skipIf(version_probe.tomllib is None, 'needs tomllib')
+  def test_pyproject(self):
+    self._write('pyproject.toml', '''
+        [project]
+        name = "example"
+        version = "3.1"
+        ''')
+    self.assertEqual(version_probe.detect(self.package_dir).version, '3.1')
+
+  @unittest.skipIf(version_probe.tomllib is None, 'needs tomllib')
+  def test_pyproject_dynamic_scm(self):
+    self._write('pyproject.toml', '''
+        [build-system]
+        requires = ["setuptools>=45", "setuptools_scm[toml]>=6.2"]
+        [project]
+        name = "example"
+        dynamic = ["version"]
+        ''')
+    self.assertTrue(version_probe.detect(self.package_dir).scm)
+
+  def test_undecided(self):
+    self._write('setup.py', '''
+        from setuptools import setup
+        setup(name='x', version=open('VERSION').read().strip())
+        ''')
+    self.assertIsNone(version_probe.detect(self.package_dir))
+
+  def test_probe_memoizes_by_tree(self):
+    self._write('setup.py', '''
+        from setuptools import setup
+        setup(name='x', version=open('VERSION').read().strip())
+        ''')
+    self._write('VERSION', '4.0\n')
+    cache_path = os.path.join(self.package_dir, 'cache.json')
+    probe = version_probe.VersionProbe(cache_path)
+    self.assertEqual(probe.probe(self.package_dir, 'tree1').version, '4.0')
+    self.assertEqual(probe.subprocess_probes, 1)
+    probe.save()
+
+    reloaded = version_probe.VersionProbe(cache_path)
+    self.assertEqual(reloaded.probe(self.package_dir, 'tree1').version, '4.0')
+    self.assertEqual(reloaded.subprocess_probes, 0)
+
+  def test_probe_runs_setup_py_with_given_interpreter(self):
+    self._write('setup.py', '''
+        from setuptools import setup
+        setup(name='x', version=open('VERSION').read().strip())
+        ''')
+    self._write('VERSION', '4.0\n')
+    probe = version_probe.VersionProbe(python_bin='no-such-python')
+    self.assertEqual(
+        probe.probe(self.package_dir, python_bin=sys.executable).version,
+        '4.0')
+
+
+if __name__ == '__main__':
+  unittest.main()
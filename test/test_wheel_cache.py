@@ -0,0 +1,54 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from pipsource import wheel_cache
+
+
+class TestWheelCache(unittest.TestCase):
+
+  def setUp(self):
+    self.cache_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.cache_dir)
+
+  def test_source_key_prefers_tree_hash(self):
+    self.assertEqual(wheel_cache.source_key('a', '1', 'tree', 'abc'), 'tree')
+    self.assertEqual(
+        wheel_cache.source_key('a', '1', None, 'abc'), 'commit-abc')
+    self.assertEqual(wheel_cache.source_key('a', '1'), 'a-1')
+
+  def test_cached_wheel(self):
+    abi = wheel_cache.abi_tag(sys.executable)
+    self.assertTrue(abi.startswith(sys.implementation.cache_tag))
+    self.assertIsNone(wheel_cache.cached_wheel(self.cache_dir, 'tree', abi))
+    wheel_dir = wheel_cache.wheel_dir(self.cache_dir, 'tree', abi)
+    os.makedirs(wheel_dir)
+    wheel = os.path.join(wheel_dir, 'a-1-py3-none-any.whl')
+    open(wheel, 'w').close()
+    self.assertEqual(
+        wheel_cache.cached_wheel(self.cache_dir, 'tree', abi), wheel)
+
+  def test_abi_tag_without_sys_implementation(self):
+    # As on Python 2.7, which has no sys.implementation. The modules the
+    # snippet imports need it to load on Python 3, so they are loaded first.
+    output = subprocess.check_output([
+        sys.executable, '-c',
+        'import platform, sys, sysconfig; del sys.implementation; ' +
+        wheel_cache.ABI_TAG_SNIPPET])
+    self.assertEqual(output.decode().strip(),
+                     wheel_cache.abi_tag(sys.executable))
+
+  def test_script_functions_use_same_abi_snippet(self):
+    script = '\n'.join(wheel_cache.script_functions())
+    self.assertIn(wheel_cache.ABI_TAG_SNIPPET, script)
+    self.assertIn('pip_wheel_vendored()', script)
+    self.assertIn('pip_install_vendored_wheels()', script)
+
+
+if __name__ == '__main__':
+  unittest.main()